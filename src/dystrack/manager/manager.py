@@ -13,11 +13,20 @@ Created on Sun Jan 15 00:34:07 2017
 """
 
 import os
+import queue
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait as futures_wait
 from msvcrt import getch, kbhit
-from time import sleep
+from time import perf_counter
 
 import dystrack.manager.transmitters as trs
+import dystrack.manager.watchers as wtc
+import dystrack.pipelines.utilities.buffers as bfs
+import dystrack.pipelines.utilities.loading as ldg
+import dystrack.pipelines.utilities.timers as tmr
 
 
 def _check_fname(fname, file_start="", file_end="", file_regex=""):
@@ -53,6 +62,53 @@ def _check_fname(fname, file_start="", file_end="", file_regex=""):
     return True
 
 
+def _get_position(fname, position_regex=""):
+    """Extract the position key from a file name.
+
+    Parameters
+    ----------
+    fname : string
+        The file name to extract the position key from.
+    position_regex : string, optional, default ""
+        A regex pattern that is searched for in `fname`. If it contains a group
+        named "pos", that group is used as the key; otherwise the first group
+        is used (or the entire match if the pattern has no groups).
+
+    Returns
+    -------
+    position : string or None
+        The position key, or None if `position_regex` is an empty string or
+        is not found in `fname`.
+    """
+
+    if not position_regex:
+        return None
+
+    match = re.search(position_regex, fname)
+    if match is None:
+        return None
+    if "pos" in match.groupdict():
+        return match.group("pos")
+    if match.groups():
+        return match.group(1)
+    return match.group(0)
+
+
+def _get_position_state(session, position):
+    """Get the state (image analysis cache and coordinate history) of a given
+    position from the session, initializing it if the position is new.
+
+    New positions start from a (shallow) copy of the session's initial
+    `img_cache` and with an empty coordinate history.
+    """
+    if position not in session["positions"]:
+        session["positions"][position] = {
+            "img_cache": dict(session["img_cache"]),
+            "coordinates": [],
+        }
+    return session["positions"][position]
+
+
 def _trigger_image_analysis(
     target_path,
     image_analysis_func,
@@ -108,6 +164,39 @@ def _trigger_image_analysis(
     return (z_pos, y_pos, x_pos, img_msg, img_cache), img_error
 
 
+def _timed_image_analysis(
+    target_path,
+    image_analysis_func,
+    img_kwargs={},
+    img_cache={},
+):
+    """Calls `_trigger_image_analysis` while recording the time spent in each
+    stage of the call (see `timers` module).
+
+    Returns
+    -------
+    out, img_error
+        See `_trigger_image_analysis`.
+    stage_times : dict
+        Seconds spent waiting for the file to be written ("wait_write") and
+        decoding it ("decode"), as far as recorded by the image loader, and in
+        the remainder of the image analysis ("analysis").
+    """
+    tmr.start_frame()
+    time_start = perf_counter()
+    out, img_error = _trigger_image_analysis(
+        target_path, image_analysis_func, img_kwargs, img_cache
+    )
+    time_total = perf_counter() - time_start
+    stage_times = tmr.stop_frame()
+    stage_times["analysis"] = (
+        time_total
+        - stage_times.get("wait_write", 0.0)
+        - stage_times.get("decode", 0.0)
+    )
+    return out, img_error, stage_times
+
+
 def _trigger_coords_transmission(
     tra_method,
     z_pos,
@@ -211,6 +300,497 @@ def _trigger_coords_transmission(
     return tra_error
 
 
+def _finalize_target(
+    img_out,
+    img_err,
+    session,
+    target_dir,
+    position=None,
+    img_err_fallback=True,
+    tra_method="txt",
+    tra_kwargs={},
+    tra_err_resume=False,
+    write_txt=True,
+    deadline_missed=False,
+):
+    """Handles the outcome of an image analysis call: falls back to previous
+    coordinates if the analysis failed or missed its deadline, transmits the
+    coordinates to the microscope (with retries) and records them in the txt
+    file if required.
+
+    Parameters
+    ----------
+    img_out : tuple
+        Output of the image analysis function as returned by
+        `_trigger_image_analysis`: `(z_pos, y_pos, x_pos, img_msg, img_cache)`
+    img_err : None or Exception
+        Image analysis error as returned by `_trigger_image_analysis`.
+    session : dict
+        Mutable state of the DySTrack session. Its "coordinates" list and the
+        coordinate history of the given position are extended with the new
+        (or fallback) coordinates, the position's "img_cache" is replaced with
+        the new cache, and the session's "img_success_counter",
+        "tra_success_counter" and "deadline_missed_counter" are incremented
+        as appropriate.
+    target_dir : path-like
+        Directory path that is being monitored by DySTrack.
+    position : string or None, optional, default None
+        Position key of the target file (see `_get_position`). Fallbacks use
+        the previous coordinates of the same position.
+    img_err_fallback, tra_method, tra_kwargs, tra_err_resume, write_txt
+        See doc string of `run_dystrack_manager`.
+    deadline_missed : bool, optional, default False
+        If True, the image analysis has not finished before its deadline (see
+        `_analyze_with_deadline`), so the previous coordinates of the position
+        are transmitted instead, and the position's "img_cache" is kept.
+    """
+
+    z_pos, y_pos, x_pos = img_out[:3]
+    img_msg, img_cache = img_out[3:]
+    position_state = _get_position_state(session, position)
+    if not deadline_missed:
+        position_state["img_cache"] = img_cache
+    coordinates = position_state["coordinates"]
+
+    # Handle missed deadline case (the analysis continues in the background)
+    if deadline_missed:
+        session["deadline_missed_counter"] += 1
+        print(
+            "[!!] Image analysis missed its deadline; reusing previous "
+            + "position!"
+        )
+        z_pos, y_pos, x_pos = coordinates[-1]
+        coordinates.append([z_pos, y_pos, x_pos])
+
+    # Handle success case
+    elif img_err is None:
+        session["img_success_counter"] += 1
+        coordinates.append([z_pos, y_pos, x_pos])
+        print("Image analysis complete.")
+
+    # Handle failure case
+    else:
+
+        # Hard-fail if fallback to previous is disabled
+        if not img_err_fallback:
+            print(
+                "[!!] Image analysis failed and `fallback="
+                + "False`; raising image analysis error."
+            )
+            raise img_err
+
+        # Hard-fail if this was the very first acquisition
+        if not coordinates:
+            print(
+                "[!!] Image analysis failed on first try; "
+                + "raising image analysis error."
+            )
+            raise img_err
+
+        # Fall back to previous position
+        print(
+            "[!!] Image analysis failed; reusing previous "
+            + "position! Skipped error was:"
+        )
+        print("[!!] >>", repr(img_err))
+        z_pos, y_pos, x_pos = coordinates[-1]
+        coordinates.append([z_pos, y_pos, x_pos])
+
+    # Record coordinates for the session as a whole
+    session["coordinates"].append([z_pos, y_pos, x_pos])
+
+    # Transmit coordinates to the microscope (with retries)
+    print("Pushing coords to scope...")
+    retry_attempts = 3
+    attempt = 0
+    while attempt <= retry_attempts:
+        attempt += 1
+        tra_err = _trigger_coords_transmission(
+            tra_method,
+            z_pos,
+            y_pos,
+            x_pos,
+            img_msg,
+            img_cache,
+            img_err,
+            target_dir,
+            tra_kwargs,
+        )
+        if tra_err is None:
+            break
+        elif attempt < retry_attempts:
+            print("[!!] Failed to push coords; retrying...")
+
+    # Handle success case
+    if tra_err is None:
+        session["tra_success_counter"] += 1
+        print("Coords pushed.")
+
+    # Handle failure case
+    else:
+
+        # Hard-fail if resuming is disabled
+        if not tra_err_resume:
+            print(
+                "[!!] Terminally failed to push coords and "
+                + "`tra_err_resume=False`; raising error."
+            )
+            raise tra_err
+
+        # Otherwise resume monitoring
+        else:
+            print(
+                "[!!] Terminally failed to push coords but "
+                + "`tra_err_resume=True`; proceeding. "
+                + "Skipped error was:"
+            )
+            print("[!!] >>", repr(tra_err))
+
+    # Record coordinates in file if necessary
+    if tra_err is None:
+        if write_txt and (tra_method != "txt"):
+            txt_err = _trigger_coords_transmission(
+                "txt",
+                z_pos,
+                y_pos,
+                x_pos,
+                img_msg,
+                target_dir=target_dir,
+            )
+            if txt_err is not None:
+                print(
+                    "[!!] Failed to record coords in txt file;"
+                    + " skipping. This should not affect"
+                    + " anything else. The error was:"
+                )
+                print("[!!] >>", repr(txt_err))
+
+
+def _finalize_job(
+    job, img_out, img_err, session, finalize_kwargs, deadline_missed=False
+):
+    """Finalizes a job (see `_finalize_target`), timing the transmission stage
+    and recording the job's stage timings in `session["stage_timings"]`.
+
+    Jobs are dicts with the keys "seq", "target_path", "position", "prev_seq",
+    "time_detected" (a `perf_counter` value) and "stage_times" (a dict that
+    already holds the timings of all stages up to and including analysis).
+    """
+    time_start = perf_counter()
+    _finalize_target(
+        img_out,
+        img_err,
+        session,
+        position=job["position"],
+        deadline_missed=deadline_missed,
+        **finalize_kwargs,
+    )
+    job["stage_times"]["transmit"] = perf_counter() - time_start
+    job["stage_times"]["total"] = perf_counter() - job["time_detected"]
+    session["stage_timings"].append(job["stage_times"])
+
+
+def _record_late_result(future, job, session, commit_cond, late_result):
+    """Done-callback for analyses that missed their deadline (see
+    `_analyze_with_deadline`): takes the job out of `session["late_jobs"]`,
+    so the next job of its position is analyzed again, then reports the late
+    result, records it in `session["late_results"]` and, if `late_result` is
+    "prior", makes its `img_cache` the cache of the job's position.
+
+    Errors raised outside of the image analysis function itself (e.g. by a
+    broken process pool) are recorded as the error of the late result. Jobs
+    that are no longer in `session["late_jobs"]` (because they have already
+    been handled at the end of the session, see `_end_late_analyses`) are
+    ignored.
+    """
+
+    with commit_cond:
+
+        # Take the job out of the running late analyses (unless it has
+        # already been handled), and skip analyses that have been cancelled
+        if session.setdefault("late_jobs", {}).pop(future, None) is None:
+            return
+        if future.cancelled():
+            return
+
+        # Get the result
+        try:
+            img_out, img_err, analysis_times = future.result()
+        except Exception as e:
+            img_out = (None, None, None, "Image analysis failed!", None)
+            img_err = e
+
+        # Record
+        session.setdefault("late_results", []).append(
+            {
+                "target_path": job["target_path"],
+                "position": job["position"],
+                "coords": list(img_out[:3]),
+                "img_msg": img_out[3],
+                "img_error": img_err,
+                "total": perf_counter() - job["time_detected"],
+            }
+        )
+        if late_result == "prior" and img_err is None:
+            position_state = _get_position_state(session, job["position"])
+            position_state["img_cache"] = img_out[4]
+
+        # Report
+        target_file = os.path.split(job["target_path"])[-1]
+        if img_err is None:
+            print(
+                f"[!!] Late image analysis result for {target_file}: "
+                + f"{img_out[0]}, {img_out[1]}, {img_out[2]} (zyx)"
+            )
+        else:
+            print(f"[!!] Late image analysis of {target_file} failed.")
+            print("[!!] >>", repr(img_err))
+
+
+def _end_late_analyses(session, commit_cond, timeout, late_result="log"):
+    """Handles the analyses that missed their deadline and are still running
+    at the end of the session (see `_analyze_with_deadline`).
+
+    They are given up to `timeout` more seconds to finish, and their results
+    are recorded as usual (see `_record_late_result`). Analyses that are still
+    running after that are cancelled (if possible) and recorded in
+    `session["late_results"]` as dropped, with the message
+    "WARN:LATE-RESULT-DROPPED", so that no late results arrive after the end
+    of the session.
+    """
+
+    # Wait for the running late analyses
+    with commit_cond:
+        futures = list(session.setdefault("late_jobs", {}))
+    futures_wait(futures, timeout=timeout)
+
+    with commit_cond:
+        for future, job in list(session["late_jobs"].items()):
+
+            # Record results that have just arrived
+            if future.done():
+                _record_late_result(
+                    future, job, session, commit_cond, late_result
+                )
+                continue
+
+            # Drop analyses that are still running
+            del session["late_jobs"][future]
+            future.cancel()
+            session.setdefault("late_results", []).append(
+                {
+                    "target_path": job["target_path"],
+                    "position": job["position"],
+                    "coords": [None, None, None],
+                    "img_msg": "WARN:LATE-RESULT-DROPPED",
+                    "img_error": TimeoutError(
+                        "Image analysis was still running at the end of the"
+                        + " session."
+                    ),
+                    "total": perf_counter() - job["time_detected"],
+                }
+            )
+            target_file = os.path.split(job["target_path"])[-1]
+            print(
+                f"[!!] Late image analysis of {target_file} dropped at the"
+                + " end of the session."
+            )
+
+
+def _analyze_with_deadline(
+    job,
+    analysis_args,
+    session,
+    commit_cond,
+    deadline=None,
+    late_result="log",
+    executor=None,
+):
+    """Runs `_timed_image_analysis` for a job, optionally with a deadline.
+
+    Without a deadline, the analysis runs in the calling thread (or in
+    `executor`, if given). With a deadline, it runs in `executor` (which is
+    then required and is shared by all jobs of the session), and if it has
+    not finished within `deadline` seconds of the detection of the target
+    file, the job is returned as having missed its deadline. The analysis
+    then continues in the background and its result is handled by
+    `_record_late_result` once it arrives. The first job of a position is
+    always awaited, since there are no previous coordinates to fall back to.
+
+    While a late analysis of a position is still running (as recorded in
+    `session["late_jobs"]`), further jobs of that position are not
+    analyzed but returned as having missed their deadline right away, so that
+    analyses that cannot keep up do not pile up in the executor.
+
+    Returns
+    -------
+    img_out, img_err, stage_times
+        See `_timed_image_analysis`. If the deadline was missed, `img_out`
+        holds no coordinates and the message "WARN:DEADLINE-MISSED", and
+        `img_err` is a `TimeoutError`.
+    deadline_missed : bool
+        Whether the deadline was missed.
+    """
+
+    # Without deadline, just run the analysis
+    if deadline is None:
+        if executor is None:
+            analysis_out = _timed_image_analysis(*analysis_args)
+        else:
+            analysis_out = executor.submit(
+                _timed_image_analysis, *analysis_args
+            ).result()
+        return analysis_out + (False,)
+    if executor is None:
+        raise ValueError("An `executor` is required to enforce a deadline.")
+
+    # Check if there is something to fall back to, and skip the analysis if
+    # the previous analysis of this position is still running late
+    img_out = (None, None, None, "WARN:DEADLINE-MISSED", analysis_args[3])
+    with commit_cond:
+        position_state = _get_position_state(session, job["position"])
+        can_fall_back = bool(position_state["coordinates"])
+        late_jobs = session.setdefault("late_jobs", {})
+        late_positions = [
+            late_job["position"] for late_job in late_jobs.values()
+        ]
+        if can_fall_back and job["position"] in late_positions:
+            img_err = TimeoutError(
+                "Skipped image analysis, as the previous analysis of this"
+                + " position is still running."
+            )
+            return img_out, img_err, {}, True
+
+    # Start the analysis in the background and wait until the deadline,
+    # unless there is nothing to fall back to
+    future = executor.submit(_timed_image_analysis, *analysis_args)
+    time_left = deadline - (perf_counter() - job["time_detected"])
+    try:
+        timeout = max(time_left, 0.0) if can_fall_back else None
+        return future.result(timeout=timeout) + (False,)
+
+    # Handle the late result once it arrives
+    except FutureTimeoutError:
+        with commit_cond:
+            late_jobs[future] = job
+        future.add_done_callback(
+            lambda done: _record_late_result(
+                done, job, session, commit_cond, late_result
+            )
+        )
+        img_err = TimeoutError(
+            f"Image analysis did not finish within {deadline} s."
+        )
+        return img_out, img_err, {}, True
+
+
+def _analysis_worker(
+    job_queue,
+    done_queue,
+    commit_cond,
+    session,
+    image_analysis_func,
+    img_kwargs,
+    finalize_kwargs,
+    executor=None,
+    deadline=None,
+    late_result="log",
+):
+    """Worker thread target for running image analysis in the background.
+
+    Jobs (see `_finalize_job`) are taken from `job_queue`, where "seq" is the
+    order in which the target files were detected; a `None` job ends the
+    worker. Image analyses of different jobs run concurrently, each starting
+    from the `img_cache` of the most recently finalized job of its position.
+    If "prev_seq" is not None, the analysis only starts once job "prev_seq"
+    (the previous job of the same position) has been finalized, so that its
+    `img_cache` can serve as prior. Results are finalized strictly in order
+    of "seq", so coordinates reach the microscope in the order of detection.
+
+    If `executor` is given (e.g. a `ProcessPoolExecutor`), the image analysis
+    call itself is submitted to it and the worker thread waits for its result.
+    If `deadline` is given, the analysis call is submitted to `executor`
+    (e.g. a `ThreadPoolExecutor` shared by all workers), and the worker stops
+    waiting for the result after that many seconds and falls back to the
+    previous coordinates (see `_analyze_with_deadline`).
+
+    If finalizing raises an error, it is stored in `session["error"]` for the
+    monitoring loop to re-raise, and all remaining jobs are skipped. Paths of
+    finished jobs are put into `done_queue`.
+    """
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        seq, prev_seq = job["seq"], job["prev_seq"]
+
+        # Wait until the previous job of this position has been finalized
+        with commit_cond:
+            if prev_seq is not None:
+                commit_cond.wait_for(lambda: session["next_seq"] > prev_seq)
+            position_state = _get_position_state(session, job["position"])
+            img_cache = position_state["img_cache"]
+
+        # Run image analysis (unless an error has already occurred)
+        # Note: Errors raised outside of the image analysis function itself
+        #       (e.g. by a broken process pool or by arguments that cannot be
+        #       pickled) are handled like image analysis errors, so the job is
+        #       still finalized and later jobs do not wait for it forever
+        if session["error"] is None:
+            target_file = os.path.split(job["target_path"])[-1]
+            print(f"Running image analysis of {target_file}...")
+            job["stage_times"]["queue"] = perf_counter() - job["time_detected"]
+            analysis_args = (
+                job["target_path"],
+                image_analysis_func,
+                img_kwargs,
+                img_cache,
+            )
+            try:
+                img_out, img_err, analysis_times, deadline_missed = (
+                    _analyze_with_deadline(
+                        job,
+                        analysis_args,
+                        session,
+                        commit_cond,
+                        deadline,
+                        late_result,
+                        executor,
+                    )
+                )
+            except Exception as e:
+                img_out = (
+                    None,
+                    None,
+                    None,
+                    "Image analysis failed!",
+                    img_cache,
+                )
+                img_err, analysis_times, deadline_missed = e, {}, False
+            job["stage_times"].update(analysis_times)
+
+        # Wait for the turn of this job, then finalize it
+        with commit_cond:
+            commit_cond.wait_for(lambda: session["next_seq"] == seq)
+            try:
+                if session["error"] is None:
+                    _finalize_job(
+                        job,
+                        img_out,
+                        img_err,
+                        session,
+                        finalize_kwargs,
+                        deadline_missed,
+                    )
+            except Exception as e:
+                session["error"] = e
+            finally:
+                session["next_seq"] += 1
+                commit_cond.notify_all()
+        done_queue.put(job["target_path"])
+
+
 def run_dystrack_manager(
     target_dir,
     image_analysis_func,
@@ -219,6 +799,8 @@ def run_dystrack_manager(
     end_on_esc=True,
     delay=1.0,
     recurse=False,
+    watcher="poll",
+    trigger_on_overwrite=False,
     file_start="",
     file_end="",
     file_regex="",
@@ -229,6 +811,12 @@ def run_dystrack_manager(
     tra_kwargs={},
     tra_err_resume=False,
     write_txt=True,
+    workers=0,
+    worker_type="thread",
+    position_regex="",
+    prefetch=False,
+    deadline=None,
+    late_result="log",
 ):
     """Manages an event loop that monitors a target directory for new files.
     For each new file found that matches user-defined criteria, the speficied
@@ -261,9 +849,21 @@ def run_dystrack_manager(
         If True, hitting the `Esc` key will terminate the loop.
     delay : float, optional, default 1.0
         Time (in seconds) to wait before the next check if no new files have
-        been found in the target directory.
+        been found in the target directory. With `watcher="events"`, this is
+        the maximum wait; new files end the wait as soon as they appear.
     recurse : bool, optional, default False
         If True, subdirectories of `target_dir` are monitored recursively.
+    watcher : str, optional, default "poll"
+        Backend used to detect new files in the target directory. Options:
+
+            * "poll" : List the directory contents on every check
+            * "events" : Use file system notifications from the OS; new files
+              are picked up within milliseconds (requires `watchdog`)
+
+    trigger_on_overwrite : bool, optional, default False
+        If True, files that are overwritten (i.e. whose size or modification
+        time change after they have been detected and processed) will trigger
+        the pipeline again. If False, only new file names trigger it.
     file_start : string, optional, default ""
         Only files that start with this string will trigger the pipeline.
     file_end : string, optional, default ""
@@ -272,7 +872,10 @@ def run_dystrack_manager(
         A regex pattern. Only file names that fully match this pattern will
         trigger the pipeline.
     img_kwargs : dict, optional, default {}
-        Additional parameters passed to the image analysis function.
+        Additional parameters passed to the image analysis function. If they
+        make the pipeline reuse buffers across frames (`reuse_buffers`), the
+        buffers held in the manager's process are dropped at the end of the
+        session (see `clear_buffer_pool`).
     img_cache : dict, optional, default {}
         Additional parameters passed to the image analysis function. This will
         be overwritten by the 4th output of the function (after the coordinate
@@ -304,6 +907,68 @@ def run_dystrack_manager(
         If True, coordinates are recorded in a txt file ("dystrack_coords.txt")
         in `target_dir` *regardless* of the specified `tra_method`. If said
         method is "txt", this has no effect as the file is generated anyway.
+    workers : int, optional, default 0
+        Number of worker threads that run image analysis and coordinate
+        transmission in the background, so that monitoring continues (and new
+        files are detected) while an image is being analyzed. Analyses of
+        files that arrive in quick succession then overlap, but coordinates
+        are still transmitted in the order in which the files were detected.
+        Each analysis uses the `img_cache` of the most recently completed one
+        (of the same position, see `position_regex`). If 0, each file is
+        processed within the monitoring loop itself.
+    worker_type : str, optional, default "thread"
+        Only relevant if `workers` > 0. If "thread", image analysis runs in the
+        worker threads themselves. If "process", the image analysis calls are
+        sent to a pool of `workers` processes, so analyses of different files
+        run truly in parallel on multiple cores. This requires the image
+        analysis function, `img_kwargs` and `img_cache` to be picklable (which
+        is the case for the pipelines included in DySTrack).
+    position_regex : str, optional, default ""
+        A regex pattern used to extract a position key from file names (e.g.
+        `r"pos_(\\d+)"` for files named like "prescan_3_pos_7.czi"). If it
+        contains a group named "pos", that group is the key; otherwise the
+        first group is used. Each position keeps its own `img_cache` and
+        coordinate history (used for fallbacks). With `workers` > 0, files of
+        the same position are analyzed one after another (so each can use the
+        previous `img_cache` as prior), while different positions are analyzed
+        concurrently. If empty, all files share one `img_cache` and history.
+    prefetch : bool, optional, default False
+        If True, each target file starts loading in a background thread as
+        soon as it is detected, so that the image analysis pipeline finds it
+        already in memory. The loader settings (`await_write`, `channel`, etc.)
+        are taken from `img_kwargs`. Only effective for pipelines that load
+        images with `robustly_load_image_after_write`, and cannot be combined
+        with `worker_type="process"` or with tiled analysis (`tile_size` in
+        `img_kwargs`, which memory-maps images instead of loading them in
+        full). Prefetches that the pipeline does not use are discarded once
+        the file has been processed, and the background threads are stopped
+        at the end of the session.
+    deadline : float or None, optional, default None
+        If given, the maximum time (in seconds, counted from the detection of
+        the target file) that the microscope is kept waiting for coordinates.
+        If image analysis has not finished by then, the previous coordinates
+        of the same position are transmitted with the message
+        "WARN:DEADLINE-MISSED", so the acquisition schedule does not slip. As
+        the microscope re-centers on the transmitted coordinates for each new
+        frame, reusing them corresponds to assuming that the sample keeps
+        moving as it did in the previous frame. The analysis continues in the
+        background and its late result is handled according to
+        `late_result`; until it arrives, further target files of the same
+        position are not analyzed, and their previous coordinates are
+        transmitted right away. The first target file of each position is
+        always awaited, as there are no previous coordinates to fall back to.
+        Unless `worker_type` is "process", analyses then run in a pool of
+        `max(workers, 1)` threads that is shared across the session. At the
+        end of the session, analyses that are still running late are given
+        up to another `deadline` seconds to finish; any that are still
+        running then are recorded as dropped.
+    late_result : str, optional, default "log"
+        Only relevant if `deadline` is set. How results of analyses that
+        missed their deadline are handled when they arrive:
+
+            * "log" : Report them and record them in the returned stats
+            * "prior" : As "log", but also use their `img_cache` for the next
+              analysis of the same position (if it has not started yet)
 
     Returns
     -------
@@ -314,10 +979,29 @@ def run_dystrack_manager(
         A dictionary containing the following stats about the run:
 
             * No. of checks made (check_counter)
-            * No. of new files found (found_counter)
+            * No. of new (or overwritten) files found (found_counter)
             * No. of target files found (target_counter)
             * No. of successful image analysis calls (img_success_counter)
             * No. of successful coordiate transmissions (tra_success_counter)
+            * Coordinate histories per position key (position_coordinates)
+            * Seconds spent in each stage of processing each target file, as a
+              list of dicts in order of transmission (stage_timings); stages
+              are "detect" (the directory check), "queue" (from detection to
+              the start of image analysis), "wait_write" and "decode" (waiting
+              for the file to be written and loading it, if recorded by the
+              pipeline's image loader; with `prefetch`, waiting for the
+              prefetched image counts as "decode"), "analysis" (rest of the
+              pipeline), "transmit" (coordinate transmission and recording),
+              and "total" (from detection to the end of transmission)
+            * p50, p95 and max of each stage across all files (stage_summary)
+            * No. of target files for which the deadline was missed or
+              whose analysis was skipped because the previous analysis of
+              the same position was still running (deadline_missed_counter)
+            * Results of analyses that missed their deadline, as a list of
+              dicts with the keys "target_path", "position", "coords",
+              "img_msg", "img_error" and "total" (seconds from detection to
+              the late result); analyses dropped at the end of the session
+              have the "img_msg" "WARN:LATE-RESULT-DROPPED" (late_results)
     """
 
     ### Preparation
@@ -330,6 +1014,24 @@ def run_dystrack_manager(
             + "must not be `None`, or `end_on_esc` must be True."
         )
 
+    # Check that the worker type is valid
+    if worker_type not in ["thread", "process"]:
+        raise ValueError(
+            "Invalid `worker_type`; must be 'thread' or 'process'."
+        )
+    if late_result not in ["log", "prior"]:
+        raise ValueError("Invalid `late_result`; must be 'log' or 'prior'.")
+    if prefetch and workers > 0 and worker_type == "process":
+        raise ValueError(
+            "`prefetch` loads images in this process, so it cannot be used"
+            + " with `worker_type='process'`."
+        )
+    if prefetch and img_kwargs.get("tile_size") is not None:
+        raise ValueError(
+            "`prefetch` loads whole images, so it cannot be used with"
+            + " tiled analysis (`tile_size` in `img_kwargs`)."
+        )
+
     # Generate txt file to record coordinates (if necessary)
     if (tra_method == "txt") or write_txt:
         txt_path = os.path.join(target_dir, "dystrack_coords.txt")
@@ -337,29 +1039,74 @@ def run_dystrack_manager(
             with open(txt_path, "w") as coordsfile:
                 coordsfile.write("Z\tY\tX\tmsg\n")
 
-    # Find existing files in the target dir (and its subdirs)
-    if recurse:
-        paths = [
-            os.path.join(dir_info[0], fname)
-            for dir_info in os.walk(target_dir)
-            for fname in dir_info[2]
-        ]
-    else:
-        paths = [
-            os.path.join(target_dir, fname)
-            for fname in os.listdir(target_dir)
-            if os.path.isfile(os.path.join(target_dir, fname))
-        ]
-
-    # Initialize coordinate list
-    coordinates = []
-
-    # Initialize stats
+    # Start watching the target dir (and its subdirs)
+    # Note: Files that already exist at this point are ignored
+    file_watcher = wtc.get_watcher(watcher, target_dir, recurse)
+    file_watcher.start()
+
+    # Initialize coordinates, image analysis cache and stats
+    session = {
+        "coordinates": [],
+        "img_cache": img_cache,
+        "positions": {},
+        "img_success_counter": 0,
+        "tra_success_counter": 0,
+        "next_seq": 0,
+        "error": None,
+        "stage_timings": [],
+        "late_results": [],
+        "late_jobs": {},
+        "deadline_missed_counter": 0,
+    }
     check_counter = 0
     found_counter = 0
     target_counter = 0
-    img_success_counter = 0
-    tra_success_counter = 0
+
+    # Arguments for finalizing each target after image analysis
+    finalize_kwargs = {
+        "target_dir": target_dir,
+        "img_err_fallback": img_err_fallback,
+        "tra_method": tra_method,
+        "tra_kwargs": tra_kwargs,
+        "tra_err_resume": tra_err_resume,
+        "write_txt": write_txt,
+    }
+
+    # Start background workers (if requested)
+    job_queue, done_queue = queue.Queue(), queue.Queue()
+    commit_cond = threading.Condition()
+    last_seqs = {}  # position -> seq of its most recent job
+    # Note: With a deadline, analyses run in a thread pool of the same size
+    #       (unless they already run in a process pool), so that analyses
+    #       that miss their deadline keep running in a bounded set of threads
+    executor = None
+    if workers > 0 and worker_type == "process":
+        executor = ProcessPoolExecutor(max_workers=workers)
+    elif deadline is not None:
+        executor = ThreadPoolExecutor(
+            max_workers=max(workers, 1), thread_name_prefix="dystrack-analysis"
+        )
+    worker_threads = [
+        threading.Thread(
+            target=_analysis_worker,
+            args=(
+                job_queue,
+                done_queue,
+                commit_cond,
+                session,
+                image_analysis_func,
+                img_kwargs,
+                finalize_kwargs,
+                executor,
+                deadline,
+                late_result,
+            ),
+            daemon=True,
+        )
+        for _ in range(workers)
+    ]
+    for worker_thread in worker_threads:
+        worker_thread.start()
 
     # Report
     print("\n\nDYSTRACK MANAGER SESSION STARTED!")
@@ -373,180 +1120,156 @@ def run_dystrack_manager(
 
     ### Run monitoring loop
 
-    while True:
+    try:
+        while True:
 
-        # Check if counters have reached their limits to exit loop
-        if max_checks is not None:
-            if check_counter == max_checks:
-                break
-        if max_triggers is not None:
-            if target_counter >= max_triggers:
-                break
-
-        # Listen for ESC keypress to exit loop
-        if end_on_esc:
-            esc_pressed = False
-            while kbhit():
-                if ord(getch()) == 27:
-                    esc_pressed = True
+            # Re-raise errors from background workers
+            if session["error"] is not None:
+                raise session["error"]
+
+            # Check if counters have reached their limits to exit loop
+            if max_checks is not None:
+                if check_counter == max_checks:
                     break
-            if esc_pressed:
-                break
-
-        # Find files in the target dir (and its subdirs)
-        if recurse:
-            new_paths = [
-                os.path.join(dir_info[0], fname)
-                for dir_info in os.walk(target_dir)
-                for fname in dir_info[2]
-            ]
-        else:
-            new_paths = [
-                os.path.join(target_dir, fname)
-                for fname in os.listdir(target_dir)
-                if os.path.isfile(os.path.join(target_dir, fname))
-            ]
-        check_counter += 1
-
-        # If something has changed...
-        if new_paths != paths:
-
-            # Get all new paths
-            target_paths = [p for p in new_paths if p not in paths]
+            if max_triggers is not None:
+                if target_counter >= max_triggers:
+                    break
+
+            # Listen for ESC keypress to exit loop
+            if end_on_esc:
+                esc_pressed = False
+                while kbhit():
+                    if ord(getch()) == 27:
+                        esc_pressed = True
+                        break
+                if esc_pressed:
+                    break
+
+            # Writes that were ongoing at detection time of processed files
+            # should not be mistaken for an overwrite
+            while not done_queue.empty():
+                done_path = done_queue.get()
+                file_watcher.refresh(done_path)
+                if prefetch:
+                    ldg.discard_prefetch(done_path)
+
+            # Get new (or overwritten) files in the target dir (and subdirs)
+            time_check = perf_counter()
+            new_paths, changed_paths = file_watcher.check()
+            time_detected = perf_counter()
+            check_counter += 1
+            target_paths = new_paths
+            if trigger_on_overwrite:
+                target_paths = new_paths + changed_paths
+
+            # If nothing has changed, wait for the interval to pass (or for
+            # the watcher to signal a new file), then continue monitoring
+            if not target_paths:
+                file_watcher.wait(delay)
+                continue
+
+            # Count all new paths
             found_counter += len(target_paths)
 
+            # Start loading the target files in the background right away
+            if prefetch:
+                for target_path in target_paths:
+                    if _check_fname(
+                        os.path.split(target_path)[-1],
+                        file_start,
+                        file_end,
+                        file_regex,
+                    ):
+                        ldg.prefetch_image(target_path, **img_kwargs)
+
             # For each new file...
             for target_path in target_paths:
                 target_file = os.path.split(target_path)[-1]
 
                 # Check if the file matches the conditions
-                if _check_fname(target_file, file_start, file_end, file_regex):
-
-                    # Stats & report
-                    target_counter += 1
+                if not _check_fname(
+                    target_file, file_start, file_end, file_regex
+                ):
+                    continue
+
+                # Stats & report
+                target_counter += 1
+                if target_path in changed_paths:
+                    print("\nTarget file overwritten:", target_file)
+                else:
                     print("\nTarget file detected:", target_file)
 
-                    # Run image analysis pipeline
-                    print("Running image analysis...")
-                    img_out, img_err = _trigger_image_analysis(
-                        target_path,
-                        image_analysis_func,
-                        img_kwargs,
-                        img_cache,
+                # Prepare job
+                job = {
+                    "seq": target_counter - 1,
+                    "target_path": target_path,
+                    "position": _get_position(target_file, position_regex),
+                    "prev_seq": None,
+                    "time_detected": time_detected,
+                    "stage_times": {"detect": time_detected - time_check},
+                }
+
+                # Hand over to the background workers...
+                if workers > 0:
+                    if position_regex:
+                        job["prev_seq"] = last_seqs.get(job["position"])
+                        last_seqs[job["position"]] = job["seq"]
+                    job_queue.put(job)
+                    continue
+
+                # ...or run image analysis pipeline and transmit coordinates
+                print(f"Running image analysis of {target_file}...")
+                job["stage_times"]["queue"] = perf_counter() - time_detected
+                position_state = _get_position_state(session, job["position"])
+                analysis_args = (
+                    target_path,
+                    image_analysis_func,
+                    img_kwargs,
+                    position_state["img_cache"],
+                )
+                img_out, img_err, analysis_times, deadline_missed = (
+                    _analyze_with_deadline(
+                        job,
+                        analysis_args,
+                        session,
+                        commit_cond,
+                        deadline,
+                        late_result,
+                        executor,
                     )
-                    z_pos, y_pos, x_pos = img_out[:3]
-                    img_msg, img_cache = img_out[3:]
-
-                    # Handle success case
-                    if img_err is None:
-                        img_success_counter += 1
-                        coordinates.append([z_pos, y_pos, x_pos])
-                        print("Image analysis complete.")
-
-                    # Handle failure case
-                    else:
-
-                        # Hard-fail if fallback to previous is disabled
-                        if not img_err_fallback:
-                            print(
-                                "[!!] Image analysis failed and `fallback="
-                                + "False`; raising image analysis error."
-                            )
-                            raise img_err
-
-                        # Hard-fail if this was the very first acquisition
-                        if not coordinates:
-                            print(
-                                "[!!] Image analysis failed on first try; "
-                                + "raising image analysis error."
-                            )
-                            raise img_err
-
-                        # Fall back to previous position
-                        print(
-                            "[!!] Image analysis failed; reusing previous "
-                            + "position! Skipped error was:"
-                        )
-                        print("[!!] >>", repr(img_err))
-                        z_pos, y_pos, x_pos = coordinates[-1]
-                        coordinates.append([z_pos, y_pos, x_pos])
-
-                    # Transmit coordinates to the microscope (with retries)
-                    print("Pushing coords to scope...")
-                    retry_attempts = 3
-                    attempt = 0
-                    while attempt <= retry_attempts:
-                        attempt += 1
-                        tra_err = _trigger_coords_transmission(
-                            tra_method,
-                            z_pos,
-                            y_pos,
-                            x_pos,
-                            img_msg,
-                            img_cache,
-                            img_err,
-                            target_dir,
-                            tra_kwargs,
-                        )
-                        if tra_err is None:
-                            break
-                        elif attempt < retry_attempts:
-                            print("[!!] Failed to push coords; retrying...")
-
-                    # Handle success case
-                    if tra_err is None:
-                        tra_success_counter += 1
-                        print("Coords pushed.")
-
-                    # Handle failure case
-                    else:
-
-                        # Hard-fail if resuming is disabled
-                        if not tra_err_resume:
-                            print(
-                                "[!!] Terminally failed to push coords and "
-                                + "`tra_err_resume=False`; raising error."
-                            )
-                            raise tra_err
-
-                        # Otherwise resume monitoring
-                        else:
-                            print(
-                                "[!!] Terminally failed to push coords but "
-                                + "`tra_err_resume=True`; proceeding. "
-                                + "Skipped error was:"
-                            )
-                            print("[!!] >>", repr(tra_err))
-
-                    # Record coordinates in file if necessary
-                    if tra_err is None:
-                        if write_txt and (tra_method != "txt"):
-                            txt_err = _trigger_coords_transmission(
-                                "txt",
-                                z_pos,
-                                y_pos,
-                                x_pos,
-                                img_msg,
-                                target_dir=target_dir,
-                            )
-                            if txt_err is not None:
-                                print(
-                                    "[!!] Failed to record coords in txt file;"
-                                    + " skipping. This should not affect"
-                                    + " anything else. The error was:"
-                                )
-                                print("[!!] >>", repr(txt_err))
-
-                    # Continue monitoring
-                    print("Resuming monitoring...")
-
-            # Update the paths list
-            paths = new_paths
-            continue
-
-        # If nothing has changed, wait for the interval to pass,
-        # then continue monitoring
-        sleep(delay)
+                )
+                job["stage_times"].update(analysis_times)
+                _finalize_job(
+                    job,
+                    img_out,
+                    img_err,
+                    session,
+                    finalize_kwargs,
+                    deadline_missed,
+                )
+                done_queue.put(target_path)
+
+                # Continue monitoring
+                print("Resuming monitoring...")
+
+        # Let the background workers finish any remaining jobs
+        for worker_thread in worker_threads:
+            job_queue.put(None)
+        for worker_thread in worker_threads:
+            worker_thread.join()
+        if session["error"] is not None:
+            raise session["error"]
+
+    # Stop watching (also in case of errors)
+    finally:
+        file_watcher.stop()
+        if deadline is not None:
+            _end_late_analyses(session, commit_cond, deadline, late_result)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if prefetch:
+            ldg.stop_prefetching()
+        bfs.clear_buffer_pool()
 
     ### Report and return
 
@@ -556,17 +1279,42 @@ def run_dystrack_manager(
     print("  Total checks made:       ", check_counter)
     print("  Total new files found:   ", found_counter)
     print("  Total target files found:", target_counter)
-    print("    No. successfully analyzed:", img_success_counter)
-    print("    No. coords sent to scope: ", tra_success_counter)
+    print("    No. successfully analyzed:", session["img_success_counter"])
+    print("    No. coords sent to scope: ", session["tra_success_counter"])
+    if deadline is not None:
+        print(
+            "    No. deadlines missed:     ",
+            session["deadline_missed_counter"],
+        )
+
+    # Report stage latencies
+    stage_summary = tmr.summarize_stages(session["stage_timings"])
+    if stage_summary:
+        print("\nStage latencies:")
+        for stage, sts in stage_summary.items():
+            print(
+                f"  {stage + ':':<12}"
+                + f"{sts['p50'] * 1000:9.1f} ms (p50)"
+                + f"{sts['p95'] * 1000:9.1f} ms (p95)"
+                + f"{sts['max'] * 1000:9.1f} ms (max)"
+            )
 
     # Compile information
     stats_dict = {
         "check_counter": check_counter,
         "found_counter": found_counter,
         "target_counter": target_counter,
-        "img_success_counter": img_success_counter,
-        "tra_success_counter": tra_success_counter,
+        "img_success_counter": session["img_success_counter"],
+        "tra_success_counter": session["tra_success_counter"],
+        "position_coordinates": {
+            position: position_state["coordinates"]
+            for position, position_state in session["positions"].items()
+        },
+        "stage_timings": session["stage_timings"],
+        "stage_summary": stage_summary,
+        "late_results": list(session["late_results"]),
+        "deadline_missed_counter": session["deadline_missed_counter"],
     }
 
     # Return
-    return coordinates, stats_dict
+    return session["coordinates"], stats_dict
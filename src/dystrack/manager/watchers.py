@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Backends for watching the target directory for new files. The
+            polling backend scans the directory on every check, whereas the
+            event backend subscribes to file system notifications from the
+            operating system (through the optional `watchdog` package). Both
+            keep a persistent index of (size, mtime) per file path, so each
+            check only costs as much as the files that actually changed.
+"""
+
+import os
+import queue
+import threading
+from time import sleep
+
+
+class FileIndex:
+    """Persistent index of known files, keyed by path, storing the file size
+    and modification time (in ns) of each file as last seen.
+
+    Lookups and updates are O(1) per file, so comparing the current state of
+    a directory with the index is linear in the number of files (rather than
+    quadratic, as with comparing two lists of paths).
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def update(self, path, stat_result):
+        """Record the stats of `path` and report how it compares to before.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file.
+        stat_result : os.stat_result
+            Stats of the file, e.g. from `os.stat` or `os.DirEntry.stat`.
+
+        Returns
+        -------
+        status : str or None
+            "new" if the path was not in the index, "changed" if its size or
+            mtime differ from the indexed values, None otherwise.
+        """
+        key = (stat_result.st_size, stat_result.st_mtime_ns)
+        old_key = self.entries.get(path)
+        self.entries[path] = key
+        if old_key is None:
+            return "new"
+        elif old_key != key:
+            return "changed"
+        return None
+
+    def refresh(self, path):
+        """Re-record the current stats of `path` without reporting them, e.g.
+        after a file has been processed, so that writes that were still going
+        on at detection time are not later reported as an overwrite."""
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            self.entries.pop(path, None)
+        else:
+            self.entries[path] = (stat_result.st_size, stat_result.st_mtime_ns)
+
+    def remove(self, path):
+        """Drop `path` from the index (if present)."""
+        self.entries.pop(path, None)
+
+
+class _IndexedWatcher:
+    """Shared base of the watcher backends; maintains a `FileIndex` and can
+    (re)scan the target directory into it with `os.scandir`.
+
+    When monitoring recursively, subdirectories whose own mtime has not changed
+    since the last scan are not relisted, as no files can have been added to
+    or removed from them. Their own subdirectories are still visited.
+    """
+
+    def __init__(self, target_dir, recurse=False):
+        self.target_dir = target_dir
+        self.recurse = recurse
+        self.index = FileIndex()
+        self._dirs = {}  # dir path -> (dir mtime, file paths, subdir paths)
+
+    def _scan_dir(self, dir_path, is_top, new_paths, changed_paths):
+        """Scan a single directory, updating the index and collecting new and
+        changed file paths, then recurse into subdirectories if required."""
+
+        # Skip listing unchanged subdirectories (but still visit their subdirs)
+        dir_mtime = os.stat(dir_path).st_mtime_ns
+        known = self._dirs.get(dir_path)
+        if (not is_top) and (known is not None) and (known[0] == dir_mtime):
+            subdirs = known[2]
+
+        # Otherwise, list the directory and compare against the index
+        else:
+            file_paths, subdirs = [], []
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        file_paths.append(entry.path)
+                        status = self.index.update(entry.path, entry.stat())
+                        if status == "new":
+                            new_paths.append(entry.path)
+                        elif status == "changed":
+                            changed_paths.append(entry.path)
+                    elif self.recurse and entry.is_dir():
+                        subdirs.append(entry.path)
+
+            # Drop files that have disappeared since the last scan
+            if known is not None:
+                for path in set(known[1]).difference(file_paths):
+                    self.index.remove(path)
+
+            self._dirs[dir_path] = (dir_mtime, file_paths, subdirs)
+
+        # Recurse
+        for subdir in subdirs:
+            try:
+                self._scan_dir(subdir, False, new_paths, changed_paths)
+            except FileNotFoundError:
+                self._dirs.pop(subdir, None)
+
+    def start(self):
+        """Index the files already present, which will not be reported."""
+        self._scan_dir(self.target_dir, True, [], [])
+
+    def refresh(self, path):
+        """See `FileIndex.refresh`."""
+        self.index.refresh(path)
+
+
+class PollingWatcher(_IndexedWatcher):
+    """Watch a target directory for new and overwritten files by scanning its
+    contents on each check and comparing them to a persistent `FileIndex`.
+
+    Directories are scanned with `os.scandir`, which (on Windows) provides
+    file sizes and mtimes without an extra system call per file. When
+    monitoring recursively, unchanged subdirectories are skipped (see
+    `_IndexedWatcher`).
+
+    Note that modifying a file in place does not change the mtime of its
+    directory, so in-place overwrites of files in unchanged subdirectories
+    are only reported once their directory changes. Overwrites by replacing
+    the file (the usual behavior of microscope software) are always caught.
+
+    Parameters
+    ----------
+    target_dir : path-like
+        Path to the directory that is to be monitored.
+    recurse : bool, optional, default False
+        If True, subdirectories of `target_dir` are monitored recursively.
+    """
+
+    def check(self):
+        """Scan for files that were added or changed since the last check.
+
+        Returns
+        -------
+        new_paths : list of str
+            Paths of files that appeared since the last check, in the order in
+            which they are listed by the file system.
+        changed_paths : list of str
+            Paths of already known files whose size or mtime have changed.
+        """
+        new_paths, changed_paths = [], []
+        self._scan_dir(self.target_dir, True, new_paths, changed_paths)
+        return new_paths, changed_paths
+
+    def wait(self, timeout):
+        """Wait for `timeout` seconds before the next check."""
+        sleep(timeout)
+
+    def stop(self):
+        """Nothing to clean up for polling."""
+        pass
+
+
+class EventWatcher(_IndexedWatcher):
+    """Watch a target directory for new and overwritten files using
+    notifications from the operating system (ReadDirectoryChangesW on Windows,
+    inotify on Linux), provided through the `watchdog` package.
+
+    File creation, modification, move/rename and (where supported) closing
+    events are collected in a thread-safe queue by the observer thread. On
+    each check, only the paths named in these events are stat'ed and compared
+    against a persistent `FileIndex`, so each path is reported as new exactly
+    once no matter how many events it produced.
+
+    Parameters
+    ----------
+    target_dir : path-like
+        Path to the directory that is to be monitored.
+    recurse : bool, optional, default False
+        If True, subdirectories of `target_dir` are monitored recursively.
+    """
+
+    def __init__(self, target_dir, recurse=False):
+
+        # The event backend is optional, so only import it when requested
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError as err:
+            raise ImportError(
+                "The 'events' watcher requires the `watchdog` package; "
+                + "install it with `pip install dystrack[watch]` or use the "
+                + "default 'poll' watcher instead."
+            ) from err
+
+        _IndexedWatcher.__init__(self, target_dir, recurse)
+        self._queue = queue.Queue()
+        self._new_event = threading.Event()
+
+        # Forward relevant file events to the queue
+        watcher = self
+
+        class _Handler(FileSystemEventHandler):
+
+            def on_created(self, event):
+                if not event.is_directory:
+                    watcher._put(event.src_path)
+
+            def on_modified(self, event):
+                if not event.is_directory:
+                    watcher._put(event.src_path)
+
+            def on_moved(self, event):
+                if not event.is_directory:
+                    watcher._put(event.dest_path)
+
+            def on_closed(self, event):
+                if not event.is_directory:
+                    watcher._put(event.src_path)
+
+        self._observer = Observer()
+        self._observer.daemon = True
+        self._observer.schedule(_Handler(), target_dir, recursive=recurse)
+
+    def _put(self, path):
+        """Called from the observer thread for each relevant event."""
+        self._queue.put(os.fsdecode(path))
+        self._new_event.set()
+
+    def start(self):
+        """Index the files already present (which will not be reported as new)
+        and start the observer thread."""
+        _IndexedWatcher.start(self)
+        self._observer.start()
+
+    def check(self):
+        """Check the files named in events received since the last check.
+
+        Returns
+        -------
+        new_paths : list of str
+            Paths of files that appeared since the last check, in the order in
+            which their first events arrived.
+        changed_paths : list of str
+            Paths of already known files whose size or mtime have changed.
+        """
+        self._new_event.clear()
+
+        # Collect unique paths (in order of arrival)
+        event_paths = {}
+        while True:
+            try:
+                event_paths[self._queue.get_nowait()] = None
+            except queue.Empty:
+                break
+
+        # Compare against the index
+        new_paths, changed_paths = [], []
+        for path in event_paths:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                self.index.remove(path)
+                continue
+            status = self.index.update(path, stat_result)
+            if status == "new":
+                new_paths.append(path)
+            elif status == "changed":
+                changed_paths.append(path)
+
+        return new_paths, changed_paths
+
+    def wait(self, timeout):
+        """Wait until a new event arrives, or for at most `timeout` seconds."""
+        self._new_event.wait(timeout)
+
+    def stop(self):
+        """Stop and join the observer thread."""
+        self._observer.stop()
+        self._observer.join()
+
+
+def get_watcher(watcher, target_dir, recurse=False):
+    """Construct the requested watcher backend for `target_dir`.
+
+    Parameters
+    ----------
+    watcher : str
+        Name of the watcher backend; either "poll" or "events".
+    target_dir : path-like
+        Path to the directory that is to be monitored.
+    recurse : bool, optional, default False
+        If True, subdirectories of `target_dir` are monitored recursively.
+
+    Returns
+    -------
+    watcher : PollingWatcher or EventWatcher
+        The (not yet started) watcher object.
+    """
+    if watcher == "poll":
+        return PollingWatcher(target_dir, recurse)
+    elif watcher == "events":
+        return EventWatcher(target_dir, recurse)
+    else:
+        raise ValueError("Invalid `watcher`; must be 'poll' or 'events'.")
@@ -9,19 +9,51 @@ Created on Sun Jan 15 00:34:07 2017
             either intensity values directly or simple masking.
 """
 
-from warnings import simplefilter, warn
+from warnings import simplefilter
 
 simplefilter("always", UserWarning)
 
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy.ndimage as ndi
 from skimage.filters import threshold_otsu
 
+from dystrack.pipelines.utilities.batching import (
+    batch_centroids,
+    batch_largest_centroids,
+    batch_otsu_thresholds,
+)
+from dystrack.pipelines.utilities.binning import (
+    bin_image,
+    get_bin_factors,
+    refine_centroid,
+    unbin_coords,
+)
+from dystrack.pipelines.utilities.buffers import BufferLease, get_buffer_pool
+from dystrack.pipelines.utilities.components import (
+    component_stats,
+    largest_component,
+)
 from dystrack.pipelines.utilities.constraints import constrain_z_movement
 from dystrack.pipelines.utilities.loading import (
     robustly_load_image_after_write,
 )
+from dystrack.pipelines.utilities.marginals import Marginals
+from dystrack.pipelines.utilities.preprocessing import (
+    convert_image,
+    gaussian_smooth,
+    min_max,
+)
+from dystrack.pipelines.utilities.projection import (
+    column_z_position,
+    project_stack,
+)
+from dystrack.pipelines.utilities.roi import (
+    crop_to_roi,
+    next_roi,
+    touches_roi_border,
+)
+from dystrack.pipelines.utilities.thresholding import objct_threshold
+from dystrack.pipelines.utilities.tiling import tiled_center_of_mass
 
 
 def analyze_image(
@@ -30,10 +62,26 @@ def analyze_image(
     method="intensity",
     gauss_sigma=3.0,
     count_reduction=0.5,
+    objct_engine="tree",
+    objct_window=20,
+    objct_coarse_step=None,
+    objct_workers=1,
+    gauss_workers=1,
     await_write=2,
+    memmap=False,
+    tile_size=None,
+    downsample=1,
+    downsample_refine=False,
+    projection=None,
+    column_radius=10,
+    roi_margin=None,
     warn_8bit=True,
+    keep_16bit=False,
+    reuse_buffers=False,
     show=False,
     verbose=False,
+    objct_prior=None,
+    roi_prior=None,
 ):
     """Compute new coordinates for the scope to track/stabilize tissues based
     on the center of mass of either intensity values directly or masks derived
@@ -55,7 +103,8 @@ def analyze_image(
         Path to the image file that is to be analyzed.
     channel : int, optional, default None
         Index of channel to use for masking in case of multi-channel images.
-        If not specified, a single-channel image is assumed.
+        If not specified, a single-channel image is assumed. Only the given
+        channel is read from disk.
     method : str, optional, default "intensity"
         Masking method. One of "intensity", "otsu", or "objct". See doc string
         header for details.
@@ -65,13 +114,102 @@ def analyze_image(
         Factor by which object count has to be reduced below its initial peak
         for a threshold value to be accepted. Only relevant if `method` is set
         to "objct".
+    objct_engine : str, optional, default "tree"
+        Engine used to count objects across thresholds; either "tree" or
+        "label" (see `object_counts`). Only relevant if `method` is "objct".
+    objct_window : int or None, optional, default 20
+        If a threshold from a previous call is available (`objct_prior`),
+        thresholds more than this distance above it are only evaluated if the
+        selection could depend on them, which gives the same threshold as the
+        full series with fewer `ndi.label` calls (see `objct_threshold`). Only
+        effective with the "label" engine; the default "tree" engine evaluates
+        all thresholds in a single pass and ignores it. If None, the full
+        series is always evaluated. Only relevant if `method` is "objct".
+    objct_coarse_step : int or None, optional, default None
+        If given, the threshold series is first evaluated at every
+        `objct_coarse_step`-th threshold and then refined where the object
+        count changes, which saves most `ndi.label` calls at the cost of
+        occasionally missing very narrow features of the count curve (see
+        `objct_threshold`). Only effective with the "label" engine; a warning
+        is issued otherwise. Only relevant if `method` is "objct".
+    objct_workers : int, optional, default 1
+        Number of threads over which the `ndi.label` calls of the "label"
+        engine are spread. If 1, they run sequentially. Only relevant if
+        `method` is "objct".
+    gauss_workers : int, optional, default 1
+        Number of threads used for Gaussian smoothing (see `gaussian_smooth`).
+        Like `objct_workers`, this should only be raised if the manager does
+        not already run several image analyses in parallel (see its `workers`
+        argument), as that would oversubscribe the CPUs.
     await_write : int, optional, default 2
-        Seconds to wait between each check of the target file size to determine
-        if the file is still being written to. Reducing this will shave off
-        latency but increases the risk of race conditions.
+        Seconds for which the target file size must be stable before loading
+        if the file cannot be confirmed to be complete based on its structure
+        (see `robustly_load_image_after_write`). Reducing this will shave off
+        latency for such files but increases the risk of race conditions.
+    memmap : bool, optional, default False
+        If True, uncompressed TIFF and ND2 files are memory-mapped rather than
+        decoded into memory, which speeds up loading of large images (see
+        `robustly_load_image_after_write`).
+    tile_size : int or None, optional, default None
+        If given, the image is converted, smoothed and masked in tiles of this
+        size in y and x (with overlap), which are reduced to histograms and
+        per-object statistics that are merged across tiles (see
+        `tiled_center_of_mass`). This gives the same result as the full-image
+        analysis while only about one tile is held in memory at a time, which
+        allows tracking of large tile-scan prescans on machines with limited
+        memory. Uncompressed TIFF and ND2 files are memory-mapped (see
+        `memmap`) so they are also read tile by tile; other formats are loaded
+        in full. Only available for the "intensity" and "otsu" methods; with
+        "objct", a ValueError is raised before the image is loaded. The
+        `show` option only shows the input image in this mode. Note that the
+        other pipelines (`lateral_line`, `chick_node`) have no tiled mode.
+    downsample : int or tuple of int, optional, default 1
+        If >1, the image is binned by this factor in y and x (z is not binned)
+        after conversion, and smoothing, masking and centroid detection are
+        done on the binned image; `gauss_sigma` is scaled down accordingly. A
+        tuple gives the factor for each axis (e.g. (2, 4, 4) for zyx). The
+        resulting coordinates are mapped back to full-resolution pixel units.
+        Ignored in tiled mode (see `tile_size`).
+    downsample_refine : bool, optional, default False
+        If True and the image is binned (see `downsample`), the centroid of
+        the mask is refined by masking a full-resolution crop around the mask
+        from the binned image with the same threshold (see `refine_centroid`).
+        Only relevant if `method` is "otsu" or "objct".
+    projection : str or None, optional, default None
+        If "max" or "mean", 3D images are analyzed projection-first: the image
+        is projected along z, y and x are found by analyzing the projection as
+        a 2D image, and z is then found as the intensity-weighted centroid of
+        the z profile of a narrow column of voxels around that yx position
+        (see `column_z_position`). Mean projections usually give results
+        closer to those of the full volume, as max projections accumulate
+        background noise. This avoids masking and labeling the full
+        volume, which saves most of the work for deep stacks. Ignored for 2D
+        images and in tiled mode (see `tile_size`).
+    column_radius : int, optional, default 10
+        Half-width in y and x of the column used to find z in projection-first
+        mode (see `projection`), in pixels of the (binned) image.
+    roi_margin : float or None, optional, default None
+        If given, the bounding box of the object is stored in `img_cache`,
+        shifted by the movement of the field of view and expanded by this
+        fraction of the image size on each side, and the next frame is first
+        analyzed only within this region of interest (ROI) in y and x. If the
+        object is not found within the ROI or touches its border (other than
+        the border of the image), the full frame is analyzed instead. Only
+        relevant if `method` is "otsu" or "objct"; ignored in tiled mode.
     warn_8bit : bool, optional, default True
         Whether to emit a warning when a non-8bit image was found and was down-
         converted to 8bit using min-max rescaling.
+    keep_16bit : bool, optional, default False
+        If True, 16bit images are analyzed at their native bit depth rather
+        than being down-converted to 8bit. Only applies to the "otsu" method;
+        "objct" thresholding works on 8bit images, and the "intensity" method
+        relies on the conversion subtracting the background (the minimum).
+    reuse_buffers : bool, optional, default False
+        If True, the large intermediate arrays (the converted and smoothed
+        images, masks and labeled images) are taken from a process-wide pool
+        of buffers and given back at the end of the analysis (see
+        `BufferPool`), so that consecutive frames of the same shape reuse the
+        same memory rather than allocating new arrays.
     show : bool, optional, default False
         Whether to show the threshold plot and the mask. Default is False.
         Note that figures will be shown without blocking execution, so if many
@@ -79,6 +217,12 @@ def analyze_image(
         all figures will be closed when the python process exits.
     verbose : bool, optional, default False
         If True, more information is printed.
+    objct_prior : dict or None, optional, default None
+        Threshold and object counts from the previous call, usually passed in
+        through `img_cache` rather than set by the user.
+    roi_prior : dict or None, optional, default None
+        ROI around the expected position of the object (see `roi_margin`),
+        usually passed in through `img_cache` rather than set by the user.
 
     Returns
     -------
@@ -87,15 +231,34 @@ def analyze_image(
     img_msg : "_"
         A string output message; required by DySTrack but here unused and just
         set to "_".
-    img_cache : {}
+    img_cache : dict
         A dictionary to be passed as keyword arguments to future calls to the
-        pipeline; required by DySTrack but here unused and just set to {}.
+        pipeline; if `method` is "objct" with the "label" engine and an
+        `objct_window`, holds the detected threshold and object counts as
+        `objct_prior` to warm-start thresholding on the next call, and if
+        `roi_margin` is given, the ROI for the next frame as `roi_prior`;
+        otherwise empty.
     """
 
+    # Check that the method supports tiled mode
+    if tile_size is not None and method not in ("intensity", "otsu"):
+        raise ValueError(
+            "Invalid `method` for tiled mode (`tile_size`); must be"
+            + " 'intensity' or 'otsu'."
+        )
+
     ### Load data
 
+    # Get the large intermediate arrays from the buffer pool (if requested)
+    buffers = BufferLease(get_buffer_pool() if reuse_buffers else None)
+
     # Wait for image to be written and then load it
-    raw = robustly_load_image_after_write(target_path, await_write=await_write)
+    raw = robustly_load_image_after_write(
+        target_path,
+        await_write=await_write,
+        memmap=memmap or tile_size is not None,
+        channel=channel,
+    )
 
     # Report
     if verbose:
@@ -106,23 +269,147 @@ def analyze_image(
         raise IOError("Image dimensionality >4; this cannot be right!")
     elif raw.ndim < 2:
         raise IOError("Image dimensionality <2; this cannot be right!")
-    elif raw.ndim < 3 and channel is not None:
-        raise IOError("CHANNEL given but image dimensionality is <3!")
-    elif raw.shape[0] > 5 and channel is not None:
-        warn(f"CHANNEL given but image dim 0 is of size {raw.shape[0]}!")
 
-    # If there are multiple channels, select the one to use
-    if channel is not None:
-        raw = raw[channel, ...]
+    ### ROI-restricted analysis
+
+    # If the object's expected position is known from the previous frame,
+    # first analyze only an ROI around it, falling back to the full frame if
+    # the object is not found within the ROI or touches its border
+    # Note: Both attempts share the loaded image, and the ROI is converted
+    #       with the value range of the full frame, so its 8bit values are the
+    #       same as in the full-frame analysis!
+    frame_args = dict(
+        method=method,
+        gauss_sigma=gauss_sigma,
+        count_reduction=count_reduction,
+        objct_engine=objct_engine,
+        objct_window=objct_window,
+        objct_coarse_step=objct_coarse_step,
+        objct_workers=objct_workers,
+        gauss_workers=gauss_workers,
+        tile_size=tile_size,
+        downsample=downsample,
+        downsample_refine=downsample_refine,
+        projection=projection,
+        column_radius=column_radius,
+        roi_margin=roi_margin,
+        keep_16bit=keep_16bit,
+        show=show,
+        verbose=verbose,
+        objct_prior=objct_prior,
+    )
+    value_range = None
+    use_roi = tile_size is None and method != "intensity"
+
+    # Give the buffers of both attempts back to the pool at the end, also if
+    # the analysis fails
+    try:
+        if roi_prior is not None and use_roi:
+            if raw.dtype != np.uint8:
+                value_range = min_max(raw)
+            try:
+                return _analyze_frame(
+                    raw,
+                    buffers,
+                    roi=roi_prior["roi"],
+                    value_range=value_range,
+                    warn_8bit=warn_8bit,
+                    **frame_args,
+                )
+            except Exception as err:
+                if verbose:
+                    print("      ROI analysis failed, using full frame:", err)
+                warn_8bit = False  # Already warned by the ROI analysis
+
+        return _analyze_frame(
+            raw,
+            buffers,
+            roi=None,
+            value_range=value_range,
+            warn_8bit=warn_8bit,
+            **frame_args,
+        )
+    finally:
+        buffers.release()
+
+
+def _analyze_frame(
+    raw,
+    buffers,
+    roi,
+    value_range,
+    method,
+    gauss_sigma,
+    count_reduction,
+    objct_engine,
+    objct_window,
+    objct_coarse_step,
+    objct_workers,
+    gauss_workers,
+    tile_size,
+    downsample,
+    downsample_refine,
+    projection,
+    column_radius,
+    roi_margin,
+    warn_8bit,
+    keep_16bit,
+    show,
+    verbose,
+    objct_prior,
+):
+    """Analyze a loaded image, optionally restricted to an ROI, as described
+    in `analyze_image`.
+
+    Parameters
+    ----------
+    raw : numpy array
+        Loaded image of the full frame (not yet converted).
+    buffers : BufferLease
+        Lease from which the large intermediate arrays are taken.
+    roi : tuple or None
+        ROI to which the analysis is restricted, as `((y0, y1), (x0, x1))`.
+        The analysis fails if the object touches an inner border of the ROI.
+    value_range : tuple of scalars or None
+        Minimum and maximum of the full frame, used to convert the ROI to
+        8bit in the same way as the full frame (see `convert_image`). If None,
+        they are taken from the image that is converted.
+
+    All other parameters and the return values are as in `analyze_image`.
+    """
 
-    # If the image is not 8bit, convert it
+    # Crop to the ROI
+    frame_shape = raw.shape
+    use_roi = tile_size is None and method != "intensity"
+    if roi is not None:
+        raw = crop_to_roi(raw, roi)
+        if verbose:
+            print("      Cropped image to ROI:", roi)
+
+    # If the image is not 8bit, convert it (unless 16bit is kept for Otsu
+    # thresholding, which does not depend on the value range)
     # NOTE: This conversion scales min to 0 and max to 255!
-    if raw.dtype != np.uint8:
-        if warn_8bit:
-            warn("Image converted down to 8bit using min-max scaling!")
-        raw = (
-            (raw.astype(float) - raw.min()) / (raw.max() - raw.min()) * 255
-        ).astype(np.uint8)
+    # Note: In tiled mode, conversion and smoothing are done tile by tile!
+    if tile_size is None:
+        raw = convert_image(
+            raw,
+            warn_8bit=warn_8bit,
+            keep_16bit=keep_16bit and method == "otsu",
+            value_range=value_range,
+            out=buffers.take(raw.shape, np.uint8),
+        )
+
+    # Bin the image for multi-resolution analysis
+    # Note: This is done after conversion, so thresholds found on the binned
+    #       image can be applied at full resolution during refinement!
+    full_shape = raw.shape
+    factors = get_bin_factors(downsample, raw.ndim)
+    binned = tile_size is None and any(f > 1 for f in factors)
+    if binned:
+        raw_full = raw
+        raw = bin_image(raw, factors)
+        if verbose:
+            print("      Binned image to shape:", raw.shape)
 
     # Show loaded image
     if show:
@@ -136,14 +423,53 @@ def analyze_image(
         plt.show(block=False)
         plt.pause(0.001)
 
+    # Projection-first mode: find y and x on a projection along z
+    projected = projection is not None and raw.ndim == 3 and tile_size is None
+    yx_factors = factors[1:] if projected else factors
+    if projected:
+        stack = raw
+        raw = project_stack(stack, projection)
+
     # Preprocessing: Gaussian smoothing
-    raw = ndi.gaussian_filter(raw, sigma=gauss_sigma)
+    if binned:
+        raw = gaussian_smooth(
+            raw,
+            [gauss_sigma / f for f in yx_factors],
+            workers=gauss_workers,
+            out=buffers.take(raw.shape, raw.dtype),
+        )
+    elif tile_size is None:
+        raw = gaussian_smooth(
+            raw,
+            gauss_sigma,
+            workers=gauss_workers,
+            out=buffers.take(raw.shape, raw.dtype),
+        )
+
+    # Nothing to cache unless the "objct" method is used
+    img_cache = {}
+
+    ### Tiled mode: process the image tile by tile with bounded memory
+
+    if tile_size is not None:
+
+        # Convert, smooth and mask tiles, then merge per-tile reductions into
+        # the centroid
+        cen = tiled_center_of_mass(
+            raw,
+            method=method,
+            gauss_sigma=gauss_sigma,
+            tile_size=tile_size,
+            warn_8bit=warn_8bit,
+            keep_16bit=keep_16bit and method == "otsu",
+            verbose=verbose,
+        )
 
     ### Method "intensity": do not mask
 
-    if method == "intensity":
+    elif method == "intensity":
 
-        mask = raw
+        cen = Marginals(raw, ("sum",)).centroid()
 
     ### Method "otsu": use Otsu's method for masking
 
@@ -153,7 +479,9 @@ def analyze_image(
         threshold = threshold_otsu(raw)
         if verbose:
             print("      Detected treshold:", threshold)
-        mask = raw >= threshold
+        mask = np.greater_equal(
+            raw, threshold, out=buffers.take(raw.shape, bool)
+        )
 
         # Plot resulting mask
         if show:
@@ -172,26 +500,26 @@ def analyze_image(
             plt.show(block=False)
             plt.pause(0.001)
 
-        # Clean-up: retain only largest object
-        img_bin_labeled = ndi.label(mask)[0]
-        obj_nums, obj_sizes = np.unique(img_bin_labeled, return_counts=True)
-        largest_obj = np.argmax(obj_sizes[1:]) + 1
-        mask[img_bin_labeled != largest_obj] = 0
+        # Clean-up: measure all objects and retain only the largest one
+        stats, labels = component_stats(
+            mask, labels=buffers.take(mask.shape, np.int32)
+        )
+        largest_obj = largest_component(stats)
+        cen = stats["centroid"][largest_obj]
+        bbox = stats["bbox"][largest_obj]
 
         # Show resulting mask
         if show:
+            mask = labels == largest_obj + 1
             if mask.ndim == 3:
+                mask_max = Marginals(mask, ("max",))
                 plt.figure()
-                plt.imshow(
-                    np.max(mask, axis=0), interpolation="none", cmap="gray"
-                )
+                plt.imshow(mask_max.max(0), interpolation="none", cmap="gray")
                 plt.title("Mask after clean-up (z-max)")
                 plt.show(block=False)
                 plt.pause(0.001)
                 plt.figure()
-                plt.imshow(
-                    np.max(mask, axis=1), interpolation="none", cmap="gray"
-                )
+                plt.imshow(mask_max.max(1), interpolation="none", cmap="gray")
                 plt.title("Mask after clean-up (y-max)")
                 plt.show(block=False)
                 plt.pause(0.001)
@@ -209,60 +537,27 @@ def analyze_image(
 
     elif method == "objct":
 
-        # Preparations
-        thresholds = np.arange(0, 256, 1)
-        counts = np.zeros_like(thresholds)
-
-        # Run threshold series
-        for index, threshold in enumerate(thresholds):
-
-            # Apply current threshold and count objects
-            counts[index] = ndi.label(raw >= threshold)[1]
-
-        # Smoothen the thresholds a bit
-        counts_smooth = ndi.gaussian_filter1d(counts, 3)
-
-        # Get the target threshold
-        for threshold in thresholds[1:255]:
-
-            # Criterion 1: Is there a previous threshold with more objects?
-            if np.max(counts_smooth[:threshold]) > counts_smooth[threshold]:
-
-                # Criterion 2a: Has the number of objects sufficiently reduced?
-                # Note: Although it works empirically, this criterion may not
-                #       be as robust as we would ideally like it to be!
-                if counts_smooth[threshold] <= (
-                    np.max(counts_smooth[:threshold]) * count_reduction
-                ):
-                    break
-
-                # Criterion 2b: Alternatively, it the current number of objects
-                # is a local minimum (i.e. followed by an increase afterwards)
-                # Note: An "early dip" despite smoothing could trigger this
-                #       early!
-                elif counts_smooth[threshold + 1] > counts_smooth[threshold]:
-                    break
-
-        # Fallback: If the detected threshold has zero objects, take highest
-        # previous threshold that did. Important to avoid smoothing issues
-        # Note: Although it works empirically, this approach may not be as
-        #       robust as we would ideally like it to be!
-        if counts[threshold] == 0:
-            for backstep in range(1, threshold):
-                if counts[threshold - backstep] > 0:
-                    threshold = threshold - backstep
-                    break
-
-        # Terminal fallback: If the final result is still nonesense, give up
-        if threshold >= 250 or threshold == 0 or counts[threshold] == 0:
-            raise Exception(
-                "THRESHOLD DETECTION FAILED! Image analysis run aborted..."
-            )
+        # Run threshold series (count objects at each threshold) and pick the
+        # threshold, starting from the previous threshold if available
+        threshold, counts, counts_smooth, objct_prior = objct_threshold(
+            raw,
+            count_reduction=count_reduction,
+            engine=objct_engine,
+            prior=objct_prior,
+            window=objct_window,
+            coarse_step=objct_coarse_step,
+            workers=objct_workers,
+            buffers=buffers.pool,
+        )
+        if objct_prior is not None:
+            img_cache["objct_prior"] = objct_prior
 
         # Binarize with the target threshold
         if verbose:
             print("      Detected treshold:", threshold)
-        mask = raw >= threshold
+        mask = np.greater_equal(
+            raw, threshold, out=buffers.take(raw.shape, bool)
+        )
 
         # Plot threshold series and resulting mask
         if show:
@@ -289,26 +584,26 @@ def analyze_image(
             plt.show(block=False)
             plt.pause(0.001)
 
-        # Clean-up: retain only largest object
-        img_bin_labeled = ndi.label(mask)[0]
-        obj_nums, obj_sizes = np.unique(img_bin_labeled, return_counts=True)
-        largest_obj = np.argmax(obj_sizes[1:]) + 1
-        mask[img_bin_labeled != largest_obj] = 0
+        # Clean-up: measure all objects and retain only the largest one
+        stats, labels = component_stats(
+            mask, labels=buffers.take(mask.shape, np.int32)
+        )
+        largest_obj = largest_component(stats)
+        cen = stats["centroid"][largest_obj]
+        bbox = stats["bbox"][largest_obj]
 
         # Show resulting mask
         if show:
+            mask = labels == largest_obj + 1
             if mask.ndim == 3:
+                mask_max = Marginals(mask, ("max",))
                 plt.figure()
-                plt.imshow(
-                    np.max(mask, axis=0), interpolation="none", cmap="gray"
-                )
+                plt.imshow(mask_max.max(0), interpolation="none", cmap="gray")
                 plt.title("Mask after clean-up (z-max)")
                 plt.show(block=False)
                 plt.pause(0.001)
                 plt.figure()
-                plt.imshow(
-                    np.max(mask, axis=1), interpolation="none", cmap="gray"
-                )
+                plt.imshow(mask_max.max(1), interpolation="none", cmap="gray")
                 plt.title("Mask after clean-up (y-max)")
                 plt.show(block=False)
                 plt.pause(0.001)
@@ -328,11 +623,36 @@ def analyze_image(
 
     ### Find new z and y positions
 
-    # Get centroid
-    cen = ndi.center_of_mass(mask)
+    # In projection-first mode, get z from a column of the stack around the
+    # centroid in y and x
+    if projected:
+        z_cen = column_z_position(stack, cen, column_radius)
+
+    # Check that the object is within the ROI
+    if roi is not None and touches_roi_border(
+        bbox[-2:], labels.shape, roi, frame_shape
+    ):
+        raise Exception("Object touches the border of the ROI!")
+
+    # Map centroid from the binned image back to full resolution (optionally
+    # refining it on a full-resolution crop around the object)
+    if binned and downsample_refine and method != "intensity":
+        if projected:
+            raw_full = project_stack(raw_full, projection)
+        cen = refine_centroid(
+            raw_full, bbox, yx_factors, threshold, gauss_sigma
+        )
+    elif binned:
+        cen = unbin_coords(cen, yx_factors)
+    if projected:
+        cen = unbin_coords([z_cen], factors[:1]) + tuple(cen)
+
+    # Map centroid from the ROI to the full frame
+    if roi is not None:
+        cen = tuple(cen[:-2]) + (cen[-2] + roi[0][0], cen[-1] + roi[1][0])
 
     # Get positions for 3D
-    if raw.ndim == 3:
+    if len(full_shape) == 3:
 
         # Use centroid positions as focusing targets
         z_pos = cen[0]
@@ -341,7 +661,7 @@ def analyze_image(
 
         # Limit how much DySTrack may move in z
         z_limit = 0.1  # Fraction of image size
-        z_pos = constrain_z_movement(z_pos, raw.shape[0], z_limit)
+        z_pos = constrain_z_movement(z_pos, full_shape[0], z_limit)
 
     # Get positions for 2D
     else:
@@ -349,6 +669,19 @@ def analyze_image(
         y_pos = cen[0]
         x_pos = cen[1]
 
+    # Get the ROI in which to look for the object in the next frame
+    if roi_margin is not None and use_roi:
+        roi_next = next_roi(
+            bbox[-2:],
+            yx_factors[-2:],
+            roi,
+            (y_pos, x_pos),
+            frame_shape,
+            roi_margin,
+        )
+        if roi_next is not None:
+            img_cache["roi_prior"] = {"roi": roi_next}
+
     ### Return results
 
     if verbose:
@@ -357,4 +690,140 @@ def analyze_image(
             + f"{z_pos:.4f}, {y_pos:.4f}, {x_pos:.4f}"
         )
 
-    return z_pos, y_pos, x_pos, "OK", {}
+    return z_pos, y_pos, x_pos, "OK", img_cache
+
+
+def analyze_batch(
+    target_paths,
+    channel=None,
+    method="intensity",
+    gauss_sigma=3.0,
+    await_write=2,
+    memmap=False,
+    warn_8bit=True,
+    verbose=False,
+):
+    """Compute new coordinates for a batch of same-shape images (e.g. the
+    prescans of several positions that arrived in quick succession) with the
+    same result as calling `analyze_image` on each of them.
+
+    The images are loaded and converted to 8bit one by one into a single
+    stack, and the smoothing, thresholding, labeling and centroid detection
+    then each run once over the whole stack (see `batching.py`), which saves
+    the per-image overhead of separate pipeline calls. Only the "intensity"
+    and "otsu" methods are supported.
+
+    Note that this is a library function for custom scripts and pipelines;
+    the DySTrack manager does not batch target files and always calls
+    `analyze_image` once per file.
+
+    Parameters
+    ----------
+    target_paths : list of path-like
+        Paths to the image files that are to be analyzed; all images must
+        have the same shape.
+    channel : int, optional, default None
+        Index of channel to use in case of multi-channel images (see
+        `analyze_image`).
+    method : str, optional, default "intensity"
+        Masking method; either "intensity" or "otsu" (see `analyze_image`).
+    gauss_sigma : float, optional, default 3.0
+        Sigma for Gaussian filter prior to masking.
+    await_write : int, optional, default 2
+        Seconds for which the file sizes must be stable before loading (see
+        `analyze_image`).
+    memmap : bool, optional, default False
+        If True, uncompressed TIFF and ND2 files are memory-mapped (see
+        `analyze_image`).
+    warn_8bit : bool, optional, default True
+        Whether to emit a warning when a non-8bit image was found and was down-
+        converted to 8bit using min-max rescaling.
+    verbose : bool, optional, default False
+        If True, more information is printed.
+
+    Returns
+    -------
+    results : list of tuples
+        For each image, `(z_pos, y_pos, x_pos, img_msg, img_cache)` as
+        returned by `analyze_image`.
+    """
+
+    # Check the method
+    if method not in ("intensity", "otsu"):
+        raise ValueError(
+            "Invalid `method` for batched analysis; must be 'intensity' or"
+            + " 'otsu'."
+        )
+
+    ### Load data
+
+    # Load each image and convert it into the stack
+    # NOTE: This conversion scales min to 0 and max to 255 for each image!
+    stack = None
+    for index, target_path in enumerate(target_paths):
+        raw = robustly_load_image_after_write(
+            target_path,
+            await_write=await_write,
+            memmap=memmap,
+            channel=channel,
+        )
+        if raw.ndim not in (2, 3):
+            raise IOError("Batched analysis requires 2D or 3D images!")
+        if stack is None:
+            stack = np.empty((len(target_paths),) + raw.shape, dtype=np.uint8)
+        elif raw.shape != stack.shape[1:]:
+            raise ValueError(
+                "All images of a batch must have the same shape; got "
+                + f"{raw.shape} for {target_path}, expected {stack.shape[1:]}."
+            )
+        out = stack[index]
+        converted = convert_image(raw, warn_8bit=warn_8bit, out=out)
+        if converted is not out:
+            out[...] = converted
+
+    # Report
+    if verbose:
+        print("      Loaded image batch of shape:", stack.shape)
+
+    # Preprocessing: Gaussian smoothing (not across the batch axis)
+    stack = gaussian_smooth(stack, [0.0] + [gauss_sigma] * (stack.ndim - 1))
+
+    ### Get centroids
+
+    # Method "intensity": do not mask
+    if method == "intensity":
+        centroids = batch_centroids(stack)
+
+    # Method "otsu": use Otsu's method for masking, then retain only the
+    # largest object of each image
+    else:
+        thresholds = batch_otsu_thresholds(stack)
+        if verbose:
+            print("      Detected tresholds:", thresholds)
+        mask = stack >= thresholds.reshape((-1,) + (1,) * (stack.ndim - 1))
+        centroids = batch_largest_centroids(mask)
+
+    ### Find new positions
+
+    results = []
+    for cen in centroids:
+
+        # Get positions for 3D, limiting how much DySTrack may move in z
+        if stack.ndim == 4:
+            z_pos, y_pos, x_pos = cen
+            z_limit = 0.1  # Fraction of image size
+            z_pos = constrain_z_movement(z_pos, stack.shape[1], z_limit)
+
+        # Get positions for 2D
+        else:
+            z_pos = 0.0
+            y_pos, x_pos = cen
+
+        if verbose:
+            print(
+                f"      Resulting coords (zyx): "
+                + f"{z_pos:.4f}, {y_pos:.4f}, {x_pos:.4f}"
+            )
+        results.append((z_pos, y_pos, x_pos, "OK", {}))
+
+    return results
@@ -7,7 +7,7 @@ Created on Sun Oct 27 22:38:59 2024
 @descript:  DySTrack image analysis pipeline for tracking of the chick node.
 """
 
-from warnings import simplefilter, warn
+from warnings import simplefilter
 
 simplefilter("always", UserWarning)
 
@@ -15,21 +15,44 @@ import os
 
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import curve_fit
 
+from dystrack.pipelines.utilities.binning import (
+    bin_image,
+    get_bin_factors,
+    unbin_coords,
+)
+from dystrack.pipelines.utilities.buffers import BufferLease, get_buffer_pool
 from dystrack.pipelines.utilities.constraints import constrain_z_movement
+from dystrack.pipelines.utilities.fitting import (
+    estimate_gaussian,
+    estimate_sigmoid,
+    f_gaussian,
+    f_sigmoid,
+    fit_profile,
+    image_profiles,
+    x_profile,
+)
 from dystrack.pipelines.utilities.loading import (
     robustly_load_image_after_write,
 )
+from dystrack.pipelines.utilities.marginals import Marginals
+from dystrack.pipelines.utilities.preprocessing import convert_image
 
 
 def analyze_image(
     target_path,
     channel=None,
     await_write=2,
+    memmap=False,
+    downsample=1,
+    fit_mode="refine",
+    fit_maxfev=None,
     warn_8bit=True,
+    keep_16bit=False,
+    reuse_buffers=False,
     show=False,
     verbose=False,
+    fit_prior=None,
 ):
     """Compute new coordinates for the scope to track the developing chick node
     during regression based on a 2D or 3D image. Stable node coordinates are
@@ -42,14 +65,50 @@ def analyze_image(
         Path to the image file that is to be analyzed.
     channel : int, optional, default None
         Index of channel to use for masking in case of multi-channel images.
-        If not specified, a single-channel image is assumed.
+        If not specified, a single-channel image is assumed. Only the given
+        channel is read from disk.
     await_write : int, optional, default 2
-        Seconds to wait between each check of the target file size to determine
-        if the file is still being written to. Reducing this will shave off
-        latency but increases the risk of race conditions.
+        Seconds for which the target file size must be stable before loading
+        if the file cannot be confirmed to be complete based on its structure
+        (see `robustly_load_image_after_write`). Reducing this will shave off
+        latency for such files but increases the risk of race conditions.
+    memmap : bool, optional, default False
+        If True, uncompressed TIFF and ND2 files are memory-mapped rather than
+        decoded into memory, which speeds up loading of large images (see
+        `robustly_load_image_after_write`).
+    downsample : int or tuple of int, optional, default 1
+        If >1, the image is binned by this factor in y and x (z is not binned)
+        after conversion, and the intensity profiles are fitted on the binned
+        image. A tuple gives the factor for each axis (e.g. (2, 4, 4) for
+        zyx). The resulting coordinates are mapped back to full-resolution
+        pixel units.
+    fit_mode : str, optional, default "refine"
+        How the models are fitted to the profiles (see `fit_profile`):
+            - "refine": least-squares fit starting from the parameters fitted
+              on the previous frame (`fit_prior`) if available, or otherwise
+              from closed-form estimates (see `estimate_gaussian` and
+              `estimate_sigmoid`). If a fit from the previous parameters does
+              not converge, it is retried from the closed-form estimate; if
+              that does not converge either, the analysis fails.
+            - "closed": use the closed-form estimates directly, without any
+              least-squares fitting; fastest and cannot fail to converge, but
+              less accurate for noisy or asymmetric profiles.
+    fit_maxfev : int or None, optional, default None
+        Maximum number of function evaluations of each least-squares fit. If
+        None, the default of `curve_fit` is used. Only relevant if `fit_mode`
+        is "refine".
     warn_8bit : bool, optional, default True
         Whether to emit a warning when a non-8bit image was found and was down-
         converted to 8bit using min-max rescaling.
+    keep_16bit : bool, optional, default False
+        If True, 16bit images are analyzed at their native bit depth rather
+        than being down-converted to 8bit.
+    reuse_buffers : bool, optional, default False
+        If True, the large intermediate arrays (the converted and smoothed
+        images, masks and labeled images) are taken from a process-wide pool
+        of buffers and given back at the end of the analysis (see
+        `BufferPool`), so that consecutive frames of the same shape reuse the
+        same memory rather than allocating new arrays.
     show : bool, optional, default False
         Whether to show various intermediate results. Default is False.
         Note that figures will be shown without blocking execution, so if many
@@ -57,6 +116,9 @@ def analyze_image(
         all figures will be closed when the python process exits.
     verbose : bool, optional, default False
         If True, more information is printed.
+    fit_prior : dict or None, optional, default None
+        Parameters fitted on the previous frame, usually passed in through
+        `img_cache` rather than set by the user.
 
     Returns
     -------
@@ -65,15 +127,21 @@ def analyze_image(
     img_msg : "_"
         A string output message; required by DySTrack but here unused and just
         set to "_".
-    img_cache : {}
+    img_cache : dict
         A dictionary to be passed as keyword arguments to future calls to the
-        pipeline; required by DySTrack but here unused and just set to {}.
+        pipeline; holds the fitted parameters as `fit_prior` to warm-start the
+        fits on the next call.
     """
 
     ### Load data
 
+    # Get the large intermediate arrays from the buffer pool (if requested)
+    buffers = BufferLease(get_buffer_pool() if reuse_buffers else None)
+
     # Wait for image to be written and then load it
-    raw = robustly_load_image_after_write(target_path, await_write=await_write)
+    raw = robustly_load_image_after_write(
+        target_path, await_write=await_write, memmap=memmap, channel=channel
+    )
 
     # Report
     if verbose:
@@ -84,29 +152,75 @@ def analyze_image(
         raise IOError("Image dimensionality >4; this cannot be right!")
     elif raw.ndim < 2:
         raise IOError("Image dimensionality <2; this cannot be right!")
-    elif raw.ndim < 3 and channel is not None:
-        raise IOError("CHANNEL given but image dimensionality is <3!")
-    elif raw.shape[0] > 5 and channel is not None:
-        warn(f"CHANNEL given but image dim 0 is of size {raw.shape[0]}!")
 
-    # If there are multiple channels, select the one to use
-    if channel is not None:
-        raw = raw[channel, ...]
+    # Analyze the image, giving the buffers back to the pool at the end (also
+    # if the analysis fails)
+    try:
+        return _analyze_frame(
+            raw,
+            buffers,
+            downsample=downsample,
+            fit_mode=fit_mode,
+            fit_maxfev=fit_maxfev,
+            warn_8bit=warn_8bit,
+            keep_16bit=keep_16bit,
+            show=show,
+            verbose=verbose,
+            fit_prior=fit_prior,
+        )
+    finally:
+        buffers.release()
+
+
+def _analyze_frame(
+    raw,
+    buffers,
+    downsample,
+    fit_mode,
+    fit_maxfev,
+    warn_8bit,
+    keep_16bit,
+    show,
+    verbose,
+    fit_prior,
+):
+    """Analyze a loaded image as described in `analyze_image`.
+
+    Parameters
+    ----------
+    raw : numpy array
+        Loaded image (not yet converted).
+    buffers : BufferLease
+        Lease from which the large intermediate arrays are taken.
+
+    All other parameters and the return values are as in `analyze_image`.
+    """
 
-    # If the image is not 8bit, convert it
+    # If the image is not 8bit, convert it (unless 16bit is kept)
     # NOTE: This conversion scales min to 0 and max to 255!
-    if raw.dtype != np.uint8:
-        if warn_8bit:
-            warn("Image converted down to 8bit using min-max scaling!")
-        raw = (
-            (raw.astype(float) - raw.min()) / (raw.max() - raw.min()) * 255
-        ).astype(np.uint8)
+    raw = convert_image(
+        raw,
+        warn_8bit=warn_8bit,
+        keep_16bit=keep_16bit,
+        out=buffers.take(raw.shape, np.uint8),
+    )
+
+    # Bin the image for multi-resolution analysis
+    full_shape = raw.shape
+    factors = get_bin_factors(downsample, raw.ndim)
+    raw = bin_image(raw, factors)
+    if verbose and raw.shape != full_shape:
+        print("      Binned image to shape:", raw.shape)
+
+    # Get the marginals of the image (sums for the profiles, maxima for the
+    # plots) in a single pass
+    marginals = Marginals(raw, ("sum", "max") if show else ("sum",))
 
     # Show loaded image
     if show:
         plt.figure()
         if raw.ndim == 3:
-            plt.imshow(np.max(raw, axis=0), interpolation="none", cmap="gray")
+            plt.imshow(marginals.max(0), interpolation="none", cmap="gray")
             plt.title("Raw input image (z-max)")
         else:
             plt.imshow(raw, interpolation="none", cmap="gray")
@@ -116,21 +230,16 @@ def analyze_image(
 
     ### Approach 6: Fit simple models to intensity profiles in each dimension
 
-    # Define Gaussian model
-    def f_gaussian(x, *p):
-        A, mu, sg = p
-        return (
-            A
-            / (sg * np.sqrt(2.0 * np.pi))
-            * np.exp(-1 / 2 * ((x - mu) / sg) ** 2.0)
-        )
+    # Get the profiles along all axes from the marginals
+    z_prof, y_prof, yx_sum = image_profiles(marginals)
 
-    # Define sigmoid model
-    # Note: (x0 - x) means it starts high and then decreases, so this assumes
-    #       that anterior is on the left; (x - x0) would be the opposite.
-    def f_sigmoid(x, *p):
-        L, k, x0 = p
-        return L / (1.0 + np.exp(-k * (x0 - x)))
+    # Start fits from the previous frame's parameters if available, otherwise
+    # from closed-form estimates
+    if fit_mode not in ("refine", "closed"):
+        raise ValueError("Invalid `fit_mode`; must be 'refine' or 'closed'.")
+    refine = fit_mode == "refine"
+    prior = fit_prior if fit_prior is not None and refine else {}
+    fit_out = {}
 
     ## Fit Z-axis profile with Gaussian model
 
@@ -142,14 +251,15 @@ def analyze_image(
             fig, ax = plt.subplots(1, 3, figsize=(10, 2.5))
             axi = 0
 
-        # Get normalized z-axis mean profile
-        z_prof = np.mean(raw, axis=(1, 2))
-        z_prof = (z_prof - z_prof.min()) / (z_prof.max() - z_prof.min())
-
-        # Fit Gaussian function to intensity profile
+        # Fit Gaussian function to normalized z-axis mean profile
         z_locs = np.arange(z_prof.size)
-        p0 = [z_prof.sum(), z_locs[-1] / 2, z_locs[-1] / 8]  # Initial guess
-        p_fit = curve_fit(f_gaussian, z_locs, z_prof, p0=p0)[0]
+        p_est = estimate_gaussian(z_prof)
+        p0 = prior.get("z", p_est)
+        p_retry = p_est if "z" in prior else None
+        p_fit = fit_profile(
+            "gaussian", z_prof, p0, None, refine, fit_maxfev, p_retry
+        )
+        fit_out["z"] = p_fit
 
         # Get z_pos as mu of Gaussian
         z_pos = p_fit[1]
@@ -187,17 +297,15 @@ def analyze_image(
 
     ## Fit Y-axis profile with Gaussian model
 
-    # Get normalized y-axis mean profile
-    if raw.ndim == 2:
-        y_prof = np.mean(raw, axis=1)
-    else:
-        y_prof = np.mean(raw, axis=(0, 2))
-    y_prof = (y_prof - y_prof.min()) / (y_prof.max() - y_prof.min())
-
-    # Fit function to profile
+    # Fit function to normalized y-axis mean profile
     y_locs = np.arange(y_prof.size)
-    p0 = [y_prof.sum(), y_locs[-1] / 2, y_locs[-1] / 6]  # Initial guess
-    p_fit = curve_fit(f_gaussian, y_locs, y_prof, p0=p0)[0]
+    p_est = estimate_gaussian(y_prof)
+    p0 = prior.get("y", p_est)
+    p_retry = p_est if "y" in prior else None
+    p_fit = fit_profile(
+        "gaussian", y_prof, p0, None, refine, fit_maxfev, p_retry
+    )
+    fit_out["y"] = p_fit
 
     # Get y_pos as mu of Gaussian
     y_pos = p_fit[1]
@@ -224,25 +332,21 @@ def analyze_image(
     ## Fit X-axis profile with sigmoid model (kind of an edge tracker really)
 
     # Get normalized x-axis profile around y position
-    if raw.ndim == 2:
-        x_prof = np.mean(
-            raw[int(y_pos - p_fit[2]) : int(y_pos + p_fit[2]), :], axis=0
-        )
-    else:
-        x_prof = np.mean(
-            raw[:, int(y_pos - p_fit[2]) : int(y_pos + p_fit[2]), :],
-            axis=(0, 1),
-        )
-    x_prof = (x_prof - x_prof.min()) / (x_prof.max() - x_prof.min())
+    x_prof = x_profile(yx_sum, int(y_pos - p_fit[2]), int(y_pos + p_fit[2]))
 
     # Fit function to profile
     x_locs = np.arange(x_prof.size)
-    p0 = [x_prof.mean(), 10.0 / x_locs[-1], x_locs[-1] / 3 * 2]  # Init. guess
+    p_est = estimate_sigmoid(x_prof)
+    p0 = prior.get("x", p_est)
+    p_retry = p_est if "x" in prior else None
     bounds = (
         [x_prof.min(), 1 / x_locs[-1], x_locs[-1] / 6.0],
         [1.2 * x_prof.max(), 100 / x_locs[-1], x_locs[-1] / 1.2],
     )
-    p_fit = curve_fit(f_sigmoid, x_locs, x_prof, p0=p0, bounds=bounds)[0]
+    p_fit = fit_profile(
+        "sigmoid", x_prof, p0, bounds, refine, fit_maxfev, p_retry
+    )
+    fit_out["x"] = p_fit
 
     # Get x_pos as x0 of sigmoid function
     x_pos = p_fit[2]
@@ -274,12 +378,12 @@ def analyze_image(
     # Show resulting positions in images / maximum projections
     if (raw.ndim == 3) and show:  # 3D
         plt.figure()
-        plt.imshow(np.max(raw, axis=0), interpolation="none", cmap="gray")
+        plt.imshow(marginals.max(0), interpolation="none", cmap="gray")
         plt.scatter(x_pos, y_pos, c="r", s=5, alpha=1.0)
         plt.show(block=False)
         plt.pause(0.001)
         plt.figure()
-        plt.imshow(np.max(raw, axis=1), interpolation="none", cmap="gray")
+        plt.imshow(marginals.max(1), interpolation="none", cmap="gray")
         plt.scatter(x_pos, z_pos, c="r", s=5, alpha=1.0)
         plt.show(block=False)
         plt.pause(0.001)
@@ -292,12 +396,18 @@ def analyze_image(
 
     ### Postprocessing
 
+    # Map positions from the binned image back to full resolution
+    if raw.ndim == 3:
+        z_pos, y_pos, x_pos = unbin_coords((z_pos, y_pos, x_pos), factors)
+    else:
+        y_pos, x_pos = unbin_coords((y_pos, x_pos), factors)
+
     # Z limit: An absolute limitation on how much it can move!
     if raw.ndim == 3:
 
         # Limit how much DySTrack may move in z
         z_limit = 0.2  # Fraction of image size
-        z_pos = constrain_z_movement(z_pos, raw.shape[0], z_limit)
+        z_pos = constrain_z_movement(z_pos, full_shape[0], z_limit)
 
     ### Return results
 
@@ -307,4 +417,4 @@ def analyze_image(
             + f"{z_pos:.4f}, {y_pos:.4f}, {x_pos:.4f}"
         )
 
-    return z_pos, y_pos, x_pos, "OK", {}
+    return z_pos, y_pos, x_pos, "OK", {"fit_prior": fit_out}
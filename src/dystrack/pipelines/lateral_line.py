@@ -16,12 +16,37 @@ simplefilter("always", UserWarning)
 
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy.ndimage as ndi
 
+from dystrack.pipelines.utilities.binning import (
+    bin_image,
+    get_bin_factors,
+    unbin_coords,
+)
+from dystrack.pipelines.utilities.buffers import BufferLease, get_buffer_pool
+from dystrack.pipelines.utilities.components import (
+    component_stats,
+    largest_component,
+)
 from dystrack.pipelines.utilities.constraints import constrain_z_movement
 from dystrack.pipelines.utilities.loading import (
     robustly_load_image_after_write,
 )
+from dystrack.pipelines.utilities.marginals import Marginals
+from dystrack.pipelines.utilities.preprocessing import (
+    convert_image,
+    gaussian_smooth,
+    min_max,
+)
+from dystrack.pipelines.utilities.projection import (
+    column_z_position,
+    project_stack,
+)
+from dystrack.pipelines.utilities.roi import (
+    crop_to_roi,
+    next_roi,
+    touches_roi_border,
+)
+from dystrack.pipelines.utilities.thresholding import objct_threshold
 
 
 def analyze_image(
@@ -29,13 +54,26 @@ def analyze_image(
     channel=None,
     gauss_sigma=3.0,
     count_reduction=0.5,
+    objct_engine="tree",
+    objct_window=20,
+    objct_coarse_step=None,
+    objct_workers=1,
+    gauss_workers=1,
     blank_fract=1.0 / 5.0,
     default_catchup_fract=1.0 / 5.0,
     default_step_fract=1.0 / 8.0,
     await_write=2,
+    memmap=False,
+    downsample=1,
+    projection=None,
+    column_radius=10,
+    roi_margin=None,
     warn_8bit=True,
+    reuse_buffers=False,
     show=False,
     verbose=False,
+    objct_prior=None,
+    roi_prior=None,
 ):
     """Compute new coordinates for the scope to track the zebrafish lateral
     line primordium's movement based on a 2D or 3D image. The primordium is
@@ -53,12 +91,39 @@ def analyze_image(
         Path to the image file that is to be analyzed.
     channel : int, optional, default None
         Index of channel to use for masking in case of multi-channel images.
-        If not specified, a single-channel image is assumed.
+        If not specified, a single-channel image is assumed. Only the given
+        channel is read from disk.
     gauss_sigma : float, optional, default 3.0
         Sigma for Gaussian filter prior to masking.
     count_reduction : float, optional, default 0.5
         Factor by which object count has to be reduced below its initial peak
         for a threshold value to be accepted.
+    objct_engine : str, optional, default "tree"
+        Engine used to count objects across thresholds; either "tree" or
+        "label" (see `object_counts`).
+    objct_window : int or None, optional, default 20
+        If a threshold from a previous call is available (`objct_prior`),
+        thresholds more than this distance above it are only evaluated if the
+        selection could depend on them, which gives the same threshold as the
+        full series with fewer `ndi.label` calls (see `objct_threshold`). Only
+        effective with the "label" engine; the default "tree" engine evaluates
+        all thresholds in a single pass and ignores it. If None, the full
+        series is always evaluated.
+    objct_coarse_step : int or None, optional, default None
+        If given, the threshold series is first evaluated at every
+        `objct_coarse_step`-th threshold and then refined where the object
+        count changes, which saves most `ndi.label` calls at the cost of
+        occasionally missing very narrow features of the count curve (see
+        `objct_threshold`). Only effective with the "label" engine; a warning
+        is issued otherwise.
+    objct_workers : int, optional, default 1
+        Number of threads over which the `ndi.label` calls of the "label"
+        engine are spread. If 1, they run sequentially.
+    gauss_workers : int, optional, default 1
+        Number of threads used for Gaussian smoothing (see `gaussian_smooth`).
+        Like `objct_workers`, this should only be raised if the manager does
+        not already run several image analyses in parallel (see its `workers`
+        argument), as that would oversubscribe the CPUs.
     blank_fract : float, optional, default 1.0/5.0
         Distance of the leading edge from the right-hand border of the image
         after the correction, expressed as a fraction of the image size in x.
@@ -71,12 +136,51 @@ def analyze_image(
         appears to have failed (leading edge in rear half of image), expressed
         as a fraction of the image size in x.
     await_write : int, optional, default 2
-        Seconds to wait between each check of the target file size to determine
-        if the file is still being written to. Reducing this will shave off
-        latency but increases the risk of race conditions.
+        Seconds for which the target file size must be stable before loading
+        if the file cannot be confirmed to be complete based on its structure
+        (see `robustly_load_image_after_write`). Reducing this will shave off
+        latency for such files but increases the risk of race conditions.
+    memmap : bool, optional, default False
+        If True, uncompressed TIFF and ND2 files are memory-mapped rather than
+        decoded into memory, which speeds up loading of large images (see
+        `robustly_load_image_after_write`).
+    downsample : int or tuple of int, optional, default 1
+        If >1, the image is binned by this factor in y and x (z is not binned)
+        after conversion, and smoothing, masking and leading edge detection
+        are done on the binned image; `gauss_sigma` is scaled down accordingly.
+        A tuple gives the factor for each axis (e.g. (2, 4, 4) for zyx). The
+        resulting coordinates are mapped back to full-resolution pixel units,
+        with the leading edge resolved to the nearest bin.
+    projection : str or None, optional, default None
+        If "max" or "mean", 3D images are analyzed projection-first: the image
+        is projected along z, y and the leading edge are found by analyzing
+        the projection as a 2D image, and z is then found as the intensity-
+        weighted centroid of the z profile of a narrow column of voxels around
+        the centroid of the mask (see `column_z_position`). Mean projections
+        usually give results closer to those of the full volume, as max
+        projections accumulate background noise. This avoids
+        masking and labeling the full volume, which saves most of the work for
+        deep stacks. Ignored for 2D images.
+    column_radius : int, optional, default 10
+        Half-width in y and x of the column used to find z in projection-first
+        mode (see `projection`), in pixels of the (binned) image.
+    roi_margin : float or None, optional, default None
+        If given, the bounding box of the mask is stored in `img_cache`,
+        shifted by the movement of the field of view and expanded by this
+        fraction of the image size on each side, and the next frame is first
+        analyzed only within this region of interest (ROI) in y and x. If the
+        primordium is not found within the ROI or touches its border (other
+        than the border of the image), the full frame is analyzed instead. No
+        ROI is stored after a default or catch-up step.
     warn_8bit : bool, optional, default True
         Whether to emit a warning when a non-8bit image was found and was down-
         converted to 8bit using min-max rescaling.
+    reuse_buffers : bool, optional, default False
+        If True, the large intermediate arrays (the converted and smoothed
+        images, masks and labeled images) are taken from a process-wide pool
+        of buffers and given back at the end of the analysis (see
+        `BufferPool`), so that consecutive frames of the same shape reuse the
+        same memory rather than allocating new arrays.
     show : bool, optional, default False
         Whether to show the threshold plot and the mask. Default is False.
         Note that figures will be shown without blocking execution, so if many
@@ -84,6 +188,13 @@ def analyze_image(
         all figures will be closed when the python process exits.
     verbose : bool, optional, default False
         If True, more information is printed.
+    objct_prior : dict or None, optional, default None
+        Threshold and object counts from the previous call, usually passed in
+        through `img_cache` rather than set by the user.
+    roi_prior : dict or None, optional, default None
+        ROI around the expected position of the primordium (see
+        `roi_margin`), usually passed in through `img_cache` rather than set
+        by the user.
 
     Returns
     -------
@@ -92,15 +203,23 @@ def analyze_image(
     img_msg : "_"
         A string output message; required by DySTrack but here unused and just
         set to "_".
-    img_cache : {}
+    img_cache : dict
         A dictionary to be passed as keyword arguments to future calls to the
-        pipeline; required by DySTrack but here unused and just set to {}.
+        pipeline; with the "label" engine and an `objct_window`, holds the
+        detected threshold and object counts as `objct_prior` to warm-start
+        thresholding on the next call, and if `roi_margin` is given, the ROI
+        for the next frame as `roi_prior`.
     """
 
     ### Load data
 
+    # Get the large intermediate arrays from the buffer pool (if requested)
+    buffers = BufferLease(get_buffer_pool() if reuse_buffers else None)
+
     # Wait for image to be written and then load it
-    raw = robustly_load_image_after_write(target_path, await_write=await_write)
+    raw = robustly_load_image_after_write(
+        target_path, await_write=await_write, memmap=memmap, channel=channel
+    )
 
     # Report
     if verbose:
@@ -111,23 +230,134 @@ def analyze_image(
         raise IOError("Image dimensionality >4; this cannot be right!")
     elif raw.ndim < 2:
         raise IOError("Image dimensionality <2; this cannot be right!")
-    elif raw.ndim < 3 and channel is not None:
-        raise IOError("CHANNEL given but image dimensionality is <3!")
-    elif raw.shape[0] > 5 and channel is not None:
-        warn(f"CHANNEL given but image dim 0 is of size {raw.shape[0]}!")
 
-    # If there are multiple channels, select the one to use
-    if channel is not None:
-        raw = raw[channel, ...]
+    ### ROI-restricted analysis
+
+    # If the primordium's expected position is known from the previous frame,
+    # first analyze only an ROI around it, falling back to the full frame if
+    # it is not found within the ROI or touches its border
+    # Note: Both attempts share the loaded image, and the ROI is converted
+    #       with the value range of the full frame, so its 8bit values are the
+    #       same as in the full-frame analysis!
+    frame_args = dict(
+        gauss_sigma=gauss_sigma,
+        count_reduction=count_reduction,
+        objct_engine=objct_engine,
+        objct_window=objct_window,
+        objct_coarse_step=objct_coarse_step,
+        objct_workers=objct_workers,
+        gauss_workers=gauss_workers,
+        blank_fract=blank_fract,
+        default_catchup_fract=default_catchup_fract,
+        default_step_fract=default_step_fract,
+        downsample=downsample,
+        projection=projection,
+        column_radius=column_radius,
+        roi_margin=roi_margin,
+        show=show,
+        verbose=verbose,
+        objct_prior=objct_prior,
+    )
+    value_range = None
+
+    # Give the buffers of both attempts back to the pool at the end, also if
+    # the analysis fails
+    try:
+        if roi_prior is not None:
+            if raw.dtype != np.uint8:
+                value_range = min_max(raw)
+            try:
+                return _analyze_frame(
+                    raw,
+                    buffers,
+                    roi=roi_prior["roi"],
+                    value_range=value_range,
+                    warn_8bit=warn_8bit,
+                    **frame_args,
+                )
+            except Exception as err:
+                if verbose:
+                    print("      ROI analysis failed, using full frame:", err)
+                warn_8bit = False  # Already warned by the ROI analysis
+
+        return _analyze_frame(
+            raw,
+            buffers,
+            roi=None,
+            value_range=value_range,
+            warn_8bit=warn_8bit,
+            **frame_args,
+        )
+    finally:
+        buffers.release()
+
+
+def _analyze_frame(
+    raw,
+    buffers,
+    roi,
+    value_range,
+    gauss_sigma,
+    count_reduction,
+    objct_engine,
+    objct_window,
+    objct_coarse_step,
+    objct_workers,
+    gauss_workers,
+    blank_fract,
+    default_catchup_fract,
+    default_step_fract,
+    downsample,
+    projection,
+    column_radius,
+    roi_margin,
+    warn_8bit,
+    show,
+    verbose,
+    objct_prior,
+):
+    """Analyze a loaded image, optionally restricted to an ROI, as described
+    in `analyze_image`.
+
+    Parameters
+    ----------
+    raw : numpy array
+        Loaded image of the full frame (not yet converted).
+    buffers : BufferLease
+        Lease from which the large intermediate arrays are taken.
+    roi : tuple or None
+        ROI to which the analysis is restricted, as `((y0, y1), (x0, x1))`.
+        The analysis fails if the mask touches an inner border of the ROI.
+    value_range : tuple of scalars or None
+        Minimum and maximum of the full frame, used to convert the ROI to
+        8bit in the same way as the full frame (see `convert_image`). If None,
+        they are taken from the image that is converted.
+
+    All other parameters and the return values are as in `analyze_image`.
+    """
+
+    # Crop to the ROI
+    frame_shape = raw.shape
+    if roi is not None:
+        raw = crop_to_roi(raw, roi)
+        if verbose:
+            print("      Cropped image to ROI:", roi)
 
     # If the image is not 8bit, convert it
     # NOTE: This conversion scales min to 0 and max to 255!
-    if raw.dtype != np.uint8:
-        if warn_8bit:
-            warn("Image converted down to 8bit using min-max scaling!")
-        raw = (
-            (raw.astype(float) - raw.min()) / (raw.max() - raw.min()) * 255
-        ).astype(np.uint8)
+    raw = convert_image(
+        raw,
+        warn_8bit=warn_8bit,
+        value_range=value_range,
+        out=buffers.take(raw.shape, np.uint8),
+    )
+
+    # Bin the image for multi-resolution analysis
+    full_shape = raw.shape
+    factors = get_bin_factors(downsample, raw.ndim)
+    raw = bin_image(raw, factors)
+    if verbose and raw.shape != full_shape:
+        print("      Binned image to shape:", raw.shape)
 
     # Show loaded image
     if show:
@@ -147,62 +377,41 @@ def analyze_image(
     # well for cldnb:lyn-EGFP and for some other (uniform) labels. However,
     # there may be room for improvement or for an altogether new approach!
 
+    # Projection-first mode: mask a projection along z
+    projected = projection is not None and raw.ndim == 3
+    if projected:
+        stack = raw
+        raw = project_stack(stack, projection)
+
     # Preprocessing: Gaussian smoothing
-    raw = ndi.gaussian_filter(raw, sigma=gauss_sigma)
-
-    # Preparations
-    thresholds = np.arange(0, 256, 1)
-    counts = np.zeros_like(thresholds)
-
-    # Run threshold series
-    for index, threshold in enumerate(thresholds):
-
-        # Apply current threshold and count objects
-        counts[index] = ndi.label(raw >= threshold)[1]
-
-    # Smoothen the thresholds a bit
-    counts_smooth = ndi.gaussian_filter1d(counts, 3)
-
-    # Get the target threshold
-    for threshold in thresholds[1:255]:
-
-        # Criterion 1: Is there a previous threshold with more objects?
-        if np.max(counts_smooth[:threshold]) > counts_smooth[threshold]:
-
-            # Criterion 2a: Has the number of objects sufficiently reduced?
-            # Note: Although it works empirically, this criterion may not be as
-            #       robust as we would ideally like it to be!
-            if counts_smooth[threshold] <= (
-                np.max(counts_smooth[:threshold]) * count_reduction
-            ):
-                break
-
-            # Criterion 2b: Alternatively, it the current number of objects is
-            # a local minimum (i.e. followed by an increase afterwards)
-            # Note: An "early dip" despite smoothing could trigger this early!
-            elif counts_smooth[threshold + 1] > counts_smooth[threshold]:
-                break
-
-    # Fallback: If the detected threshold has zero objects, take the highest
-    # previous threshold that did. Important to avoid smoothing issues
-    # Note: Although it works empirically, this approach may not be as robust
-    #       as we would ideally like it to be!
-    if counts[threshold] == 0:
-        for backstep in range(1, threshold):
-            if counts[threshold - backstep] > 0:
-                threshold = threshold - backstep
-                break
-
-    # Terminal fallback: If the final result is still nonesense, give up
-    if threshold >= 250 or threshold == 0 or counts[threshold] == 0:
-        raise Exception(
-            "THRESHOLD DETECTION FAILED! Image analysis run aborted..."
-        )
+    yx_factors = factors[-raw.ndim :]
+    raw = gaussian_smooth(
+        raw,
+        [gauss_sigma / f for f in yx_factors],
+        workers=gauss_workers,
+        out=buffers.take(raw.shape, raw.dtype),
+    )
+
+    # Run threshold series (count objects at each threshold) and pick the
+    # threshold, starting from the previous threshold if available
+    threshold, counts, counts_smooth, objct_prior = objct_threshold(
+        raw,
+        count_reduction=count_reduction,
+        engine=objct_engine,
+        prior=objct_prior,
+        window=objct_window,
+        coarse_step=objct_coarse_step,
+        workers=objct_workers,
+        buffers=buffers.pool,
+    )
+    img_cache = {}
+    if objct_prior is not None:
+        img_cache["objct_prior"] = objct_prior
 
     # Binarize with the target threshold
     if verbose:
         print("      Detected treshold:", threshold)
-    mask = raw >= threshold
+    mask = np.greater_equal(raw, threshold, out=buffers.take(raw.shape, bool))
 
     # Plot threshold series and resulting mask
     if show:
@@ -227,22 +436,26 @@ def analyze_image(
         plt.show(block=False)
         plt.pause(0.001)
 
-    # Clean-up: retain only largest object
-    img_bin_labeled = ndi.label(mask)[0]
-    obj_nums, obj_sizes = np.unique(img_bin_labeled, return_counts=True)
-    largest_obj = np.argmax(obj_sizes[1:]) + 1
-    mask[img_bin_labeled != largest_obj] = 0
+    # Clean-up: measure all objects and retain only the largest one
+    stats, labels = component_stats(
+        mask, labels=buffers.take(mask.shape, np.int32)
+    )
+    largest_obj = largest_component(stats)
+    cen = stats["centroid"][largest_obj]
+    bbox = stats["bbox"][largest_obj]
 
     # Show resulting mask
     if show:
+        mask = labels == largest_obj + 1
         if mask.ndim == 3:
+            mask_max = Marginals(mask, ("max",))
             plt.figure()
-            plt.imshow(np.max(mask, axis=0), interpolation="none", cmap="gray")
+            plt.imshow(mask_max.max(0), interpolation="none", cmap="gray")
             plt.title("Mask after clean-up (z-max)")
             plt.show(block=False)
             plt.pause(0.001)
             plt.figure()
-            plt.imshow(np.max(mask, axis=1), interpolation="none", cmap="gray")
+            plt.imshow(mask_max.max(1), interpolation="none", cmap="gray")
             plt.title("Mask after clean-up (y-max)")
             plt.show(block=False)
             plt.pause(0.001)
@@ -255,11 +468,24 @@ def analyze_image(
 
     ### Find new z and y positions
 
-    # Get centroid
-    cen = ndi.center_of_mass(mask)
+    # Check that the mask is within the ROI
+    if roi is not None and touches_roi_border(
+        bbox[-2:], labels.shape, roi, frame_shape
+    ):
+        raise Exception("Mask touches the border of the ROI!")
+
+    # In projection-first mode, get z from a column of the stack around the
+    # centroid in y and x
+    if projected:
+        cen = (column_z_position(stack, cen, column_radius),) + tuple(cen)
+
+    # Convert to full-resolution pixels of the full frame
+    cen = unbin_coords(cen, factors)
+    if roi is not None:
+        cen = tuple(cen[:-2]) + (cen[-2] + roi[0][0], cen[-1] + roi[1][0])
 
     # Get z and y positions for 3D
-    if raw.ndim == 3:
+    if len(full_shape) == 3:
 
         # Use centroid of mask
         z_pos = cen[0]
@@ -267,7 +493,7 @@ def analyze_image(
 
         # Limit how much DySTrack may move in z
         z_limit = 0.1  # Fraction of image size
-        z_pos = constrain_z_movement(z_pos, raw.shape[0], z_limit)
+        z_pos = constrain_z_movement(z_pos, full_shape[0], z_limit)
 
     # Get "z" and y positions for 2D
     else:
@@ -276,14 +502,16 @@ def analyze_image(
 
     ### Find new x (leading edge) position
 
-    # Collapse to x axis
-    if raw.ndim == 3:
-        collapsed = np.max(np.max(mask, axis=0), axis=0)
-    else:
-        collapsed = np.max(mask, axis=0)
+    # Find frontal-most non-zero pixel (end of the object's bounding box)
+    front_pos = bbox[-1].stop - 1
+    touches_front = front_pos == labels.shape[-1] - 1
 
-    # Find frontal-most non-zero pixel
-    front_pos = np.max(np.nonzero(collapsed)[0])
+    # Convert to full-resolution pixels of the full frame (last pixel covered
+    # by the bin)
+    size_x = frame_shape[-1]
+    front_pos = (front_pos + 1) * factors[-1] - 1
+    if roi is not None:
+        front_pos += roi[1][0]
 
     ### Check if leading edge position is sensible
 
@@ -293,7 +521,7 @@ def analyze_image(
     #   large default movement (1/5th of the image)
 
     # If the tip of the mask is behind the center of the image...
-    if front_pos < collapsed.shape[0] / 2.0:
+    if front_pos < size_x / 2.0:
 
         # In this case, the mask is probably missing a lot at the tip
         warn(
@@ -303,19 +531,17 @@ def analyze_image(
 
         # Handle it...
         # default_step_fract = 1.0 / 8.0
-        x_pos = (
-            0.5 * collapsed.shape[0] + default_step_fract * collapsed.shape[0]
-        )
+        x_pos = 0.5 * size_x + default_step_fract * size_x
         if verbose:
             print(
                 f"      Resulting coords (zyx): "
                 + f"{z_pos:.4f}, {y_pos:.4f}, {x_pos:.4f}"
             )
 
-        return z_pos, y_pos, x_pos, "WARN:MASK-FAIL-DEFAULT-STEP", {}
+        return z_pos, y_pos, x_pos, "WARN:MASK-FAIL-DEFAULT-STEP", img_cache
 
     # If the tip of the mask touches the front end of the image
-    elif front_pos == collapsed.shape[0] - 1:
+    elif touches_front:
 
         # In this case, the prim has probably moved out of the frame
         warn(
@@ -325,17 +551,14 @@ def analyze_image(
 
         # Handle it...
         # default_catchup_fract = 1.0 / 5.0
-        x_pos = (
-            0.5 * collapsed.shape[0]
-            + default_catchup_fract * collapsed.shape[0]
-        )
+        x_pos = 0.5 * size_x + default_catchup_fract * size_x
         if verbose:
             print(
                 f"      Resulting coords (zyx): "
                 + f"{z_pos:.4f}, {y_pos:.4f}, {x_pos:.4f}"
             )
 
-        return z_pos, y_pos, x_pos, "WARN:CATCH-UP-STEP", {}
+        return z_pos, y_pos, x_pos, "WARN:CATCH-UP-STEP", img_cache
 
     ### If the above issues did not trigger, compute new x-position for scope
 
@@ -346,9 +569,20 @@ def analyze_image(
     #   based on previous coordinates stored in img_cache.
 
     # blank_fract = 1.0 / 5.0
-    x_pos = (
-        front_pos + blank_fract * collapsed.shape[0] - 0.5 * collapsed.shape[0]
-    )
+    x_pos = front_pos + blank_fract * size_x - 0.5 * size_x
+
+    # Get the ROI in which to look for the primordium in the next frame
+    if roi_margin is not None:
+        roi_next = next_roi(
+            bbox[-2:],
+            factors[-2:],
+            roi,
+            (y_pos, x_pos),
+            frame_shape,
+            roi_margin,
+        )
+        if roi_next is not None:
+            img_cache["roi_prior"] = {"roi": roi_next}
 
     ### Return results
 
@@ -358,4 +592,4 @@ def analyze_image(
             + f"{z_pos:.4f}, {y_pos:.4f}, {x_pos:.4f}"
         )
 
-    return z_pos, y_pos, x_pos, "OK", {}
+    return z_pos, y_pos, x_pos, "OK", img_cache
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for analyzing a batch of same-shape images (e.g. the
+            prescans of several positions) stacked along a leading batch axis,
+            such that each step runs once over the whole batch rather than
+            once per image.
+"""
+
+import numpy as np
+import scipy.ndimage as ndi
+from skimage.filters import threshold_otsu
+
+from dystrack.pipelines.utilities.components import object_moments
+
+
+def batch_centroids(stack):
+    """Intensity-weighted centroid of each image in a batch, as
+    `ndi.center_of_mass` of each image, computed from the sum profiles
+    along each axis.
+
+    Parameters
+    ----------
+    stack : numpy array
+        Batch of images (2D or 3D) stacked along the first axis.
+
+    Returns
+    -------
+    centroids : numpy array of float
+        Centroid of each image, with shape `(n_images, stack.ndim - 1)`.
+    """
+
+    # Sum over x, then derive the other profiles from that
+    ndim = stack.ndim - 1
+    sum_x = np.sum(stack, axis=-1, dtype=np.float64)
+    profiles = [
+        np.sum(sum_x, axis=tuple(a for a in range(1, ndim) if a != axis))
+        for axis in range(1, ndim)
+    ]
+    profiles.append(
+        np.sum(stack, axis=tuple(range(1, ndim)), dtype=np.float64)
+    )
+
+    # Get centroids
+    total = profiles[-1].sum(axis=1)
+    return np.stack(
+        [prof @ np.arange(prof.shape[1]) / total for prof in profiles], axis=1
+    )
+
+
+def batch_otsu_thresholds(stack):
+    """Otsu threshold of each image in a batch of integer images, as
+    `threshold_otsu` of each image.
+
+    Parameters
+    ----------
+    stack : numpy array of non-negative integers
+        Batch of images stacked along the first axis, usually 8bit.
+
+    Returns
+    -------
+    thresholds : numpy array of int
+        Threshold of each image.
+    """
+    n_bins = int(stack.max()) + 1
+    thresholds = np.zeros(stack.shape[0], dtype=np.int64)
+    for index, img in enumerate(stack):
+        hist = np.bincount(img.ravel(), minlength=n_bins)
+        values = np.flatnonzero(hist)
+        if values.size == 1:
+            thresholds[index] = values[0]
+        else:
+            thresholds[index] = threshold_otsu(hist=(hist, np.arange(n_bins)))
+    return thresholds
+
+
+def batch_label(mask):
+    """Label a batch of masks in one call, connecting voxels within each mask
+    (as with `ndi.label`) but not across the batch axis.
+
+    Parameters
+    ----------
+    mask : numpy array of bool
+        Batch of masks (2D or 3D) stacked along the first axis.
+
+    Returns
+    -------
+    labels : numpy array of int
+        Labeled masks; labels are unique across the whole batch.
+    n_objects : int
+        Number of objects in the batch.
+    """
+    structure = np.zeros((3,) * mask.ndim, dtype=bool)
+    structure[1] = ndi.generate_binary_structure(mask.ndim - 1, 1)
+    return ndi.label(mask, structure=structure)
+
+
+def batch_largest_centroids(mask):
+    """Centroid of the largest object (face-connected component) of each mask
+    in a batch.
+
+    Parameters
+    ----------
+    mask : numpy array of bool
+        Batch of masks (2D or 3D) stacked along the first axis.
+
+    Returns
+    -------
+    centroids : numpy array of float
+        Centroid of the largest object of each mask, with shape
+        `(n_images, mask.ndim - 1)`.
+
+    Raises
+    ------
+    Exception
+        If any of the masks has no objects.
+    """
+
+    # Label and measure all objects of the batch at once
+    # Note: For 3D masks, the batch is measured as one 3D image of stacked
+    #       z-planes, with the z coordinates restarting for each image
+    labels, n_objects = batch_label(mask)
+    n_images, ndim = mask.shape[0], mask.ndim - 1
+    if ndim == 3:
+        coords = [np.tile(np.arange(mask.shape[1], dtype=float), n_images)]
+        planes = labels.reshape((-1,) + mask.shape[2:])
+    else:
+        coords = [np.zeros(n_images)]
+        planes = labels
+    coords += [np.arange(size, dtype=float) for size in mask.shape[-2:]]
+    sizes, moments = object_moments(planes, n_objects, coords)
+    moments = moments[:, -ndim:]
+
+    # Get the image each object belongs to
+    # Note: Labels are assigned in raster order, so the objects of each image
+    #       have consecutive labels, up to the highest label in that image
+    last_labels = np.max(labels.reshape(n_images, -1), axis=1)
+    last_labels = np.maximum.accumulate(last_labels)
+    owners = np.searchsorted(last_labels, np.arange(1, n_objects + 1))
+
+    # Get the centroid of the largest object of each image
+    centroids = np.zeros((n_images, ndim))
+    for index in range(n_images):
+        objects = np.flatnonzero(owners == index)
+        if objects.size == 0:
+            raise Exception(
+                f"No object found in mask of batch image {index}! Image "
+                + "analysis run aborted."
+            )
+        largest_obj = objects[np.argmax(sizes[objects])]
+        centroids[index] = moments[largest_obj] / sizes[largest_obj]
+    return centroids
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for multi-resolution analysis, where images are binned
+            for masking and the results are mapped back to (and optionally
+            refined at) full resolution.
+"""
+
+import numpy as np
+
+from dystrack.pipelines.utilities.components import (
+    component_stats,
+    largest_component,
+)
+from dystrack.pipelines.utilities.preprocessing import (
+    CHUNK_SIZE,
+    gaussian_smooth,
+)
+
+
+def get_bin_factors(downsample, ndim):
+    """Get per-axis binning factors from a pipeline's `downsample` argument.
+
+    Parameters
+    ----------
+    downsample : int or tuple of int
+        Binning factor for y and x (z is not binned), or a factor per axis.
+    ndim : int
+        Dimensionality of the image (2 or 3).
+
+    Returns
+    -------
+    factors : tuple of int
+        Binning factor for each axis.
+    """
+    if np.ndim(downsample) == 0:
+        factors = (1,) * (ndim - 2) + (int(downsample),) * 2
+    else:
+        factors = tuple(int(f) for f in downsample)
+    if len(factors) != ndim or min(factors) < 1:
+        raise ValueError(
+            f"Invalid `downsample` {downsample} for image with {ndim} dims!"
+        )
+    return factors
+
+
+def bin_image(img, factors):
+    """Downsample an image by averaging blocks of voxels (binning).
+
+    Trailing voxels that do not fill a complete block are dropped. Binning is
+    done chunk by chunk, so no full-size temporaries are created.
+
+    Parameters
+    ----------
+    img : numpy array
+        Input image; may be a (read-only) memory-mapped array.
+    factors : tuple of int
+        Binning factor for each axis (see `get_bin_factors`).
+
+    Returns
+    -------
+    img_binned : numpy array
+        Binned image of the same dtype as `img`; block means are rounded for
+        integer images.
+    """
+
+    # Prep
+    if all(f == 1 for f in factors):
+        return img
+    shape = tuple(s // f for s, f in zip(img.shape, factors))
+    img_binned = np.empty(shape, dtype=img.dtype)
+    if img_binned.size == 0:
+        return img_binned
+    block_shape = [n for s, f in zip(shape[1:], factors[1:]) for n in (s, f)]
+    crop = tuple(slice(0, s * f) for s, f in zip(shape[1:], factors[1:]))
+
+    # Bin along the first axis in chunks of whole blocks
+    step = max(1, CHUNK_SIZE // (img.size // img.shape[0] * factors[0]))
+    for start in range(0, shape[0], step):
+        stop = min(start + step, shape[0])
+        chunk = img[(slice(start * factors[0], stop * factors[0]),) + crop]
+        chunk = chunk.reshape([stop - start, factors[0]] + block_shape)
+        chunk = chunk.mean(axis=tuple(range(1, chunk.ndim, 2)))
+        if np.issubdtype(img.dtype, np.integer):
+            chunk = np.rint(chunk)
+        img_binned[start:stop] = chunk
+
+    return img_binned
+
+
+def unbin_coords(coords, factors):
+    """Convert coordinates in a binned image (see `bin_image`) to coordinates
+    in the original image, where each bin is centered on the voxels it covers.
+
+    Parameters
+    ----------
+    coords : sequence of floats
+        Coordinates in the binned image, one per axis.
+    factors : tuple of int
+        Binning factor for each axis.
+
+    Returns
+    -------
+    coords : tuple of floats
+        Coordinates in the original image.
+    """
+    return tuple(c * f + (f - 1) / 2.0 for c, f in zip(coords, factors))
+
+
+def refine_centroid(raw, bbox, factors, threshold, gauss_sigma):
+    """Refine the centroid of an object masked in a binned image by masking a
+    full-resolution crop around it.
+
+    The crop covers the bounding box of the binned object, extended by one bin
+    on each side. It is smoothed (with an extra margin of the filter radius,
+    so the crop's borders do not affect the result), masked with the same
+    threshold as the binned image, and the centroid of the largest object in
+    the crop is returned.
+
+    Parameters
+    ----------
+    raw : numpy array
+        Full-resolution image (before smoothing), with the same intensity
+        scale as the binned image the object was masked in.
+    bbox : tuple of slices
+        Bounding box of the object in the binned image (see
+        `component_stats`).
+    factors : tuple of int
+        Binning factor for each axis (see `get_bin_factors`).
+    threshold : scalar
+        Threshold used to derive the mask from the smoothed binned image.
+    gauss_sigma : float
+        Sigma for Gaussian filter at full resolution.
+
+    Returns
+    -------
+    cen : tuple of floats
+        Centroid of the refined mask in full-resolution coordinates.
+    """
+
+    # Get the crop (with and without filter margin) around the binned object
+    halo = int(4.0 * gauss_sigma + 0.5)
+    inner, outer = [], []
+    for index, f, size in zip(bbox, factors, raw.shape):
+        start = max((index.start - 1) * f, 0)
+        stop = min((index.stop + 1) * f, size)
+        inner.append(slice(start, stop))
+        outer.append(slice(max(start - halo, 0), min(stop + halo, size)))
+    local = tuple(
+        slice(i.start - o.start, i.stop - o.start)
+        for i, o in zip(inner, outer)
+    )
+
+    # Smooth and mask the crop
+    crop = gaussian_smooth(np.asarray(raw[tuple(outer)]), gauss_sigma)
+    mask_crop = crop[local] >= threshold
+
+    # Get the centroid of the largest object in full-resolution coordinates
+    stats = component_stats(mask_crop)[0]
+    if stats["size"].size == 0:
+        raise Exception("Refinement at full resolution found no object!")
+    cen = stats["centroid"][largest_component(stats)]
+    return tuple(c + i.start for c, i in zip(cen, inner))
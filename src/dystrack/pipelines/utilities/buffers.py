@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for reusing the large intermediate arrays of the image
+            analysis pipelines across frames, since all prescans of a session
+            usually have the same shape and dtype.
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+# Default limit on the memory held by free buffers in a pool
+MAX_POOL_BYTES = 2**31
+
+# Process-wide pool (see `get_buffer_pool`)
+_buffer_pool = None
+_buffer_pool_lock = threading.Lock()
+
+
+class BufferPool:
+    """Pool of preallocated arrays, keyed by shape and dtype.
+
+    Arrays are taken from the pool for the duration of an analysis and given
+    back afterwards, so that the next frame of the same shape reuses them
+    rather than allocating new ones. The pool only holds free buffers; taken
+    buffers that are never given back are simply garbage-collected. Since a
+    buffer is only ever handed out once until it is given back, concurrent
+    analyses (e.g. in worker threads) never share a buffer.
+
+    The pool is thread-safe. If the free buffers exceed `max_bytes` (e.g.
+    because the shapes change from frame to frame, as with ROIs), those of
+    the least recently used shapes are dropped.
+
+    Parameters
+    ----------
+    max_bytes : int, optional, default MAX_POOL_BYTES
+        Maximum number of bytes held by free buffers.
+    """
+
+    def __init__(self, max_bytes=MAX_POOL_BYTES):
+        self.max_bytes = max_bytes
+        self._free = OrderedDict()  # (shape, dtype) -> list of arrays
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """Number of bytes held by free buffers."""
+        return self._nbytes
+
+    def take(self, shape, dtype):
+        """Take a buffer of the given shape and dtype from the pool, or
+        allocate a new one if there is none. Its content is undefined."""
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                buf = free.pop()
+                self._nbytes -= buf.nbytes
+                if not free:
+                    del self._free[key]
+                return buf
+        return np.empty(*key)
+
+    def give(self, *bufs):
+        """Give buffers (back) to the pool."""
+        with self._lock:
+            for buf in bufs:
+                key = (buf.shape, buf.dtype)
+                self._free.setdefault(key, []).append(buf)
+                self._free.move_to_end(key)
+                self._nbytes += buf.nbytes
+
+            # Drop the least recently used buffers beyond the limit
+            while self._nbytes > self.max_bytes:
+                key = next(iter(self._free))
+                for buf in self._free.pop(key):
+                    self._nbytes -= buf.nbytes
+
+    @contextmanager
+    def borrow(self, *specs):
+        """Context manager that takes a buffer for each `(shape, dtype)` spec
+        and gives them back on exit."""
+        bufs = [self.take(shape, dtype) for shape, dtype in specs]
+        try:
+            yield bufs
+        finally:
+            self.give(*bufs)
+
+    def clear(self):
+        """Drop all free buffers."""
+        with self._lock:
+            self._free.clear()
+            self._nbytes = 0
+
+
+class BufferLease:
+    """Buffers taken from a pool for the analysis of one frame, to be given
+    back together at the end of it (see `BufferPool`), usually in a `finally`
+    clause so that they are also given back if the analysis fails.
+
+    Parameters
+    ----------
+    pool : BufferPool or None
+        Pool to take buffers from. If None, `take` returns None, so that the
+        functions receiving the buffer as `out` allocate their own output.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._taken = []
+
+    def take(self, shape, dtype):
+        """Take a buffer from the pool (see `BufferPool.take`), or return None
+        if there is no pool."""
+        if self.pool is None:
+            return None
+        buf = self.pool.take(shape, dtype)
+        self._taken.append(buf)
+        return buf
+
+    def release(self):
+        """Give all taken buffers back to the pool. They must no longer be
+        used afterwards."""
+        if self.pool is not None:
+            self.pool.give(*self._taken)
+        self._taken = []
+
+
+def get_buffer_pool():
+    """Get the process-wide buffer pool used by the pipelines, creating it
+    on first use.
+
+    The pool lives in the process that runs the image analysis, so it
+    persists across frames both when analyses run in the manager's process
+    and in a pool of worker processes (where `img_cache` is pickled for every
+    call and could not carry the buffers without copying them).
+    """
+    global _buffer_pool
+    with _buffer_pool_lock:
+        if _buffer_pool is None:
+            _buffer_pool = BufferPool()
+        return _buffer_pool
+
+
+def clear_buffer_pool():
+    """Drop all free buffers of the process-wide buffer pool (if it has been
+    created), e.g. at the end of a DySTrack session, so that the process no
+    longer holds on to their memory."""
+    with _buffer_pool_lock:
+        if _buffer_pool is not None:
+            _buffer_pool.clear()
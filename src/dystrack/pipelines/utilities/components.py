@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for measuring the connected components (objects) of a
+            mask with `bincount`-style reductions over a single labeling.
+"""
+
+import numpy as np
+import scipy.ndimage as ndi
+
+
+def object_moments(labels, n_objects, coords=None):
+    """Get the sizes and coordinate sums of the objects in a labeled image,
+    going plane by plane to avoid full-size temporaries.
+
+    Parameters
+    ----------
+    labels : numpy array of int
+        Labeled image (2D or 3D), as returned by `ndi.label`.
+    n_objects : int
+        Number of objects in `labels`.
+    coords : list of numpy arrays or None, optional, default None
+        Coordinates of the voxels along each axis (e.g. the global coordinates
+        of a tile). If None, voxel indices are used.
+
+    Returns
+    -------
+    sizes : numpy array of float
+        Number of voxels of each object (excluding the background).
+    moments : numpy array of float
+        Sum of the voxel coordinates of each object along each axis, with
+        shape `(n_objects, labels.ndim)`.
+    """
+
+    # Prep
+    if coords is None:
+        coords = [np.arange(size, dtype=float) for size in labels.shape]
+    sizes = np.zeros(n_objects + 1)
+    moments = np.zeros((n_objects + 1, labels.ndim))
+    y_weights = np.repeat(coords[-2], labels.shape[-1])
+    x_weights = np.tile(coords[-1], labels.shape[-2])
+
+    # Accumulate over planes
+    planes = labels.reshape((-1,) + labels.shape[-2:])
+    z_coords = coords[0] if labels.ndim == 3 else [0.0]
+    for plane, z in zip(planes, z_coords):
+        flat = plane.ravel()
+        plane_sizes = np.bincount(flat, minlength=n_objects + 1)
+        sizes += plane_sizes
+        if labels.ndim == 3:
+            moments[:, 0] += plane_sizes * z
+        moments[:, -2] += np.bincount(
+            flat, weights=y_weights, minlength=n_objects + 1
+        )
+        moments[:, -1] += np.bincount(
+            flat, weights=x_weights, minlength=n_objects + 1
+        )
+
+    # Drop the background
+    return sizes[1:], moments[1:]
+
+
+def component_stats(mask, labels=None):
+    """Label a mask and measure all of its objects (face-connected components,
+    as with `ndi.label`).
+
+    The labeled image is reduced to per-object statistics with `bincount`
+    (see `object_moments`) and `ndi.find_objects`, so there is no need to
+    sort the labeled image (as with `np.unique`), to rewrite the mask to
+    retain only one object, or to compute its centroid in another full pass.
+
+    Parameters
+    ----------
+    mask : numpy array of bool
+        Mask (2D or 3D).
+    labels : numpy array of int32 or None, optional, default None
+        Preallocated output for the labeled image (e.g. from a `BufferPool`).
+        If None, a new array is allocated.
+
+    Returns
+    -------
+    stats : dict
+        Statistics of the objects, ordered by label, with the keys:
+            - "size": number of voxels of each object, shape (n_objects,)
+            - "centroid": centroid of each object, shape (n_objects, ndim)
+            - "bbox": bounding box of each object, as a list of tuples of
+              slices (as returned by `ndi.find_objects`)
+            - "extent": size of the bounding box of each object along each
+              axis, shape (n_objects, ndim)
+    labels : numpy array of int
+        Labeled image (label i+1 is object i); `labels` if given.
+    """
+    if labels is None:
+        labels, n_objects = ndi.label(mask)
+    else:
+        n_objects = ndi.label(mask, output=labels)
+    sizes, moments = object_moments(labels, n_objects)
+    bboxes = ndi.find_objects(labels)
+    stats = {
+        "size": sizes.astype(np.int64),
+        "centroid": moments / np.maximum(sizes, 1)[:, None],
+        "bbox": bboxes,
+        "extent": np.array(
+            [[index.stop - index.start for index in bbox] for bbox in bboxes],
+            dtype=np.int64,
+        ).reshape(n_objects, mask.ndim),
+    }
+    return stats, labels
+
+
+def largest_component(stats):
+    """Get the index of the largest object (see `component_stats`).
+
+    Parameters
+    ----------
+    stats : dict
+        Object statistics as returned by `component_stats`.
+
+    Returns
+    -------
+    index : int
+        Index of the largest object in `stats` (its label is `index + 1`).
+
+    Raises
+    ------
+    Exception
+        If there are no objects.
+    """
+    if stats["size"].size == 0:
+        raise Exception("No object found in mask! Image analysis run aborted.")
+    return int(np.argmax(stats["size"]))
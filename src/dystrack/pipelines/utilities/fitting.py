@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for fitting simple models (Gaussian, sigmoid) to the
+            intensity profiles of an image, with closed-form estimates that
+            can be used directly or as the starting point of a short
+            least-squares refinement.
+"""
+
+from warnings import simplefilter, warn
+
+simplefilter("always", UserWarning)
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from dystrack.pipelines.utilities.marginals import Marginals
+
+
+def f_gaussian(x, *p):
+    """Gaussian model with area `A`, mean `mu` and standard deviation `sg`."""
+    A, mu, sg = p
+    return (
+        A
+        / (sg * np.sqrt(2.0 * np.pi))
+        * np.exp(-1 / 2 * ((x - mu) / sg) ** 2.0)
+    )
+
+
+def f_sigmoid(x, *p):
+    """Sigmoid model with height `L`, steepness `k` and midpoint `x0`.
+
+    Note: (x0 - x) means it starts high and then decreases, so this assumes
+    that anterior is on the left; (x - x0) would be the opposite.
+    """
+    L, k, x0 = p
+    return L / (1.0 + np.exp(-k * (x0 - x)))
+
+
+def normalize_profile(prof):
+    """Min-max normalize a profile to the range from 0 to 1."""
+    return (prof - prof.min()) / (prof.max() - prof.min())
+
+
+def image_profiles(img):
+    """Get the normalized mean intensity profiles of an image along z (if 3D)
+    and y, and the projection along z used for the profile along x, from its
+    marginals (see `Marginals`).
+
+    Parameters
+    ----------
+    img : numpy array or Marginals
+        Input image (2D or 3D), or its marginals (e.g. to share them with
+        diagnostic plots).
+
+    Returns
+    -------
+    z_prof : numpy array or None
+        Normalized mean profile along z, or None for 2D images.
+    y_prof : numpy array
+        Normalized mean profile along y.
+    yx_sum : numpy array
+        Sum of the image along z (the image itself for 2D images), from which
+        the profile along x is taken (see `x_profile`).
+    """
+    if not isinstance(img, Marginals):
+        img = Marginals(img, reductions=("sum",))
+    y_prof = normalize_profile(img.profile(-2, "mean"))
+    if img.ndim == 3:
+        z_prof = normalize_profile(img.profile(0, "mean"))
+        yx_sum = img.sum(0)
+    else:
+        z_prof, yx_sum = None, img.img
+    return z_prof, y_prof, yx_sum
+
+
+def x_profile(yx_sum, y0, y1):
+    """Get the normalized mean intensity profile along x within rows `y0` to
+    `y1` (see `image_profiles`)."""
+    return normalize_profile(np.sum(yx_sum[y0:y1], axis=0, dtype=np.float64))
+
+
+def estimate_gaussian(prof):
+    """Closed-form estimate of the Gaussian model parameters of a profile,
+    based on its moments: `A` is its sum, `mu` its mean and `sg` its standard
+    deviation (treating the profile as a distribution over positions).
+
+    Parameters
+    ----------
+    prof : numpy array
+        Normalized profile (see `image_profiles`).
+
+    Returns
+    -------
+    p : list of floats
+        Estimated parameters `[A, mu, sg]` (see `f_gaussian`).
+    """
+    locs = np.arange(prof.size, dtype=np.float64)
+    A = prof.sum()
+    mu = prof @ locs / A
+    sg = np.sqrt(prof @ (locs - mu) ** 2 / A)
+    return [A, mu, sg]
+
+
+def estimate_sigmoid(prof):
+    """Closed-form estimate of the sigmoid model parameters of a profile.
+
+    The profile is split into a high (left) and a low (right) part at the
+    position that minimizes the squared error of a step function, which is
+    found for all positions at once from cumulative sums. `x0` is the split
+    position and `L` the mean of the high part. The steepness `k` cannot be
+    estimated robustly from noisy profiles and is set to a generic value of
+    10 over the length of the profile.
+
+    Parameters
+    ----------
+    prof : numpy array
+        Normalized profile (see `x_profile`).
+
+    Returns
+    -------
+    p : list of floats
+        Estimated parameters `[L, k, x0]` (see `f_sigmoid`).
+    """
+
+    # Squared error of a step for each split position (right after `split`)
+    n = prof.size
+    split = np.arange(1, n)
+    csum, csum2 = np.cumsum(prof), np.cumsum(prof**2)
+    mean_high = csum[:-1] / split
+    mean_low = (csum[-1] - csum[:-1]) / (n - split)
+    sse = csum2[:-1] - split * mean_high**2
+    sse += csum2[-1] - csum2[:-1] - (n - split) * mean_low**2
+
+    # Best split
+    best = np.argmin(sse)
+    return [mean_high[best], 10.0 / (n - 1), float(split[best])]
+
+
+def fit_profile(
+    model, prof, p0, bounds=None, refine=True, maxfev=None, fallback_p0=None
+):
+    """Fit a model to a profile, starting from given parameters.
+
+    Parameters
+    ----------
+    model : str
+        Either "gaussian" or "sigmoid" (see `f_gaussian` and `f_sigmoid`).
+    prof : numpy array
+        Normalized profile.
+    p0 : sequence of floats
+        Starting parameters, e.g. a closed-form estimate (see
+        `estimate_gaussian` and `estimate_sigmoid`) or the parameters fitted
+        on the previous frame. They are clipped to `bounds` if given.
+    bounds : tuple of sequences or None, optional, default None
+        Lower and upper bounds of the parameters, as for `curve_fit`.
+    refine : bool, optional, default True
+        If False, `p0` is returned without a least-squares refinement.
+    maxfev : int or None, optional, default None
+        Maximum number of function evaluations of the refinement; if None,
+        the default of `curve_fit` is used.
+    fallback_p0 : sequence of floats or None, optional, default None
+        If given and the refinement from `p0` (e.g. the parameters of the
+        previous frame) does not converge, the fit is retried once from these
+        parameters (e.g. a closed-form estimate), with a warning.
+
+    Returns
+    -------
+    p_fit : numpy array
+        Fitted parameters.
+
+    Raises
+    ------
+    RuntimeError
+        If the refinement does not converge (from `fallback_p0`, if given).
+    """
+    p0 = np.asarray(p0, dtype=np.float64)
+    if bounds is not None:
+        lower, upper = np.asarray(bounds[0]), np.asarray(bounds[1])
+        p0 = np.clip(p0, lower, np.nextafter(upper, lower))
+    if not refine:
+        return p0
+    f_model = {"gaussian": f_gaussian, "sigmoid": f_sigmoid}[model]
+    kwargs = {} if bounds is None else {"bounds": bounds}
+    if maxfev is not None:
+        kwargs["max_nfev" if bounds is not None else "maxfev"] = maxfev
+    locs = np.arange(prof.size)
+    try:
+        return curve_fit(f_model, locs, prof, p0=p0, **kwargs)[0]
+    except RuntimeError:
+        if fallback_p0 is None:
+            raise
+        warn("Profile fit did not converge; retrying from fallback_p0!")
+    return fit_profile(model, prof, fallback_p0, bounds, refine, maxfev)
@@ -8,8 +8,14 @@ Created on Thu Aug 15 00:13:31 2025
 @descript:  Utilities for image loading in image analysis pipelines.
 """
 
+import inspect
+import mmap
 import os
-from time import sleep
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter, sleep
 from warnings import simplefilter, warn
 
 simplefilter("always", UserWarning)
@@ -17,15 +23,708 @@ simplefilter("always", UserWarning)
 import numpy as np
 from bioio import BioImage
 
+from dystrack.pipelines.utilities.timers import stage_timer
 
-def robustly_load_image_after_write(target_path, await_write=2):
+# bioio reader classes resolved per file suffix (see `open_bioimage`)
+_reader_cache = {}
+
+# Images being loaded in the background (see `prefetch_image`)
+MAX_PREFETCHED = 8
+_prefetched = {}
+_prefetch_lock = threading.Lock()
+_prefetch_executor = None
+
+# Sizes (in bytes) of TIFF field types
+_TIFF_TYPE_SIZES = dict(
+    zip(
+        [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 16, 17, 18],
+        [1, 1, 2, 4, 8, 1, 1, 2, 4, 8, 4, 8, 4, 8, 8, 8],
+    )
+)
+
+
+def _tiff_is_complete(f, file_size):
+    """Check if the IFD chain of a TIFF (or BigTIFF) file is terminated within
+    the file and all tag values and strips/tiles referenced by its IFDs lie
+    within the file. Returns None if the file is not recognized as a TIFF."""
+
+    # Header
+    header = f.read(16)
+    if len(header) < 8:
+        return False
+    if header[:2] == b"II":
+        bo = "<"
+    elif header[:2] == b"MM":
+        bo = ">"
+    else:
+        return None
+    version = struct.unpack(bo + "H", header[2:4])[0]
+    if version == 42:
+        ifd_offset = struct.unpack(bo + "I", header[4:8])[0]
+        cnt_fmt, cnt_size, tag_size, off_fmt, off_size = "H", 2, 12, "I", 4
+    elif version == 43:
+        ifd_offset = struct.unpack(bo + "Q", header[8:16])[0]
+        cnt_fmt, cnt_size, tag_size, off_fmt, off_size = "Q", 8, 20, "Q", 8
+    else:
+        return None
+    types = {3: "H", 4: "I", 16: "Q"}  # SHORT, LONG, LONG8
+
+    # Walk the IFD chain
+    visited = set()
+    while ifd_offset != 0:
+        if ifd_offset in visited or ifd_offset + cnt_size > file_size:
+            return False
+        visited.add(ifd_offset)
+        f.seek(ifd_offset)
+        n_tags = struct.unpack(bo + cnt_fmt, f.read(cnt_size))[0]
+        ifd_end = ifd_offset + cnt_size + n_tags * tag_size + off_size
+        if ifd_end > file_size:
+            return False
+        ifd = f.read(n_tags * tag_size + off_size)
+
+        # Check that out-of-line tag values lie within the file and get data
+        # offsets and byte counts (strips or tiles)
+        data = {}
+        for i in range(n_tags):
+            entry = ifd[i * tag_size : (i + 1) * tag_size]
+            tag, dtype = struct.unpack(bo + "HH", entry[:4])
+            count = struct.unpack(bo + off_fmt, entry[4 : 4 + off_size])[0]
+            n_bytes = count * _TIFF_TYPE_SIZES.get(dtype, 1)
+            ptr = None
+            if n_bytes > off_size:
+                ptr = struct.unpack(bo + off_fmt, entry[4 + off_size :])[0]
+                if ptr + n_bytes > file_size:
+                    return False
+            if tag not in (273, 279, 324, 325) or dtype not in types:
+                continue
+            fmt = bo + str(count) + types[dtype]
+            if ptr is None:
+                values = struct.unpack(fmt, entry[4 + off_size :][:n_bytes])
+            else:
+                f.seek(ptr)
+                values = struct.unpack(fmt, f.read(n_bytes))
+            data[tag] = values
+        offsets = data.get(273, data.get(324, ()))
+        counts = data.get(279, data.get(325, ()))
+        if offsets and counts:
+            if max(o + c for o, c in zip(offsets, counts)) > file_size:
+                return False
+
+        ifd_offset = struct.unpack(bo + off_fmt, ifd[-off_size:])[0]
+
+    return True
+
+
+def _czi_is_complete(f, file_size):
+    """Check if the header of a CZI file points to a subblock directory and a
+    metadata segment and that all subblocks and attachments listed in their
+    directories lie within the file. Returns None if the file is not
+    recognized as a CZI."""
+
+    # File header segment
+    header = f.read(112)
+    if len(header) < 112:
+        return False
+    if not header.startswith(b"ZISRAWFILE"):
+        return None
+    dir_pos, meta_pos, update_pending = struct.unpack("<qqi", header[84:104])
+    att_pos = struct.unpack("<q", header[104:112])[0]
+    if dir_pos <= 0 or meta_pos <= 0 or update_pending:
+        return False
+
+    # Check that a segment with the expected ID lies within the file
+    def read_segment(pos, seg_id):
+        if pos + 32 > file_size:
+            return None
+        f.seek(pos)
+        seg_header = f.read(32)
+        allocated = struct.unpack("<q", seg_header[16:24])[0]
+        if (not seg_header.startswith(seg_id)) or (
+            pos + 32 + allocated > file_size
+        ):
+            return None
+        return allocated
+
+    if read_segment(meta_pos, b"ZISRAWMETADATA") is None:
+        return False
+    if read_segment(dir_pos, b"ZISRAWDIRECTORY") is None:
+        return False
+
+    # Check that all subblocks listed in the directory are present
+    f.seek(dir_pos + 32)
+    n_entries = struct.unpack("<i", f.read(128)[:4])[0]
+    last_pos = 0
+    for _ in range(n_entries):
+        entry = f.read(32)
+        if len(entry) < 32:
+            return False
+        last_pos = max(last_pos, struct.unpack("<q", entry[6:14])[0])
+        f.seek(struct.unpack("<i", entry[28:32])[0] * 20, os.SEEK_CUR)
+    if n_entries and read_segment(last_pos, b"ZISRAWSUBBLOCK") is None:
+        return False
+
+    # Check that all attachments (if any) are present
+    if att_pos > 0:
+        if read_segment(att_pos, b"ZISRAWATTDIR") is None:
+            return False
+        f.seek(att_pos + 32)
+        n_entries = struct.unpack("<i", f.read(256)[:4])[0]
+        last_pos = 0
+        for _ in range(n_entries):
+            entry = f.read(128)
+            if len(entry) < 128:
+                return False
+            last_pos = max(last_pos, struct.unpack("<q", entry[12:20])[0])
+        if n_entries and read_segment(last_pos, b"ZISRAWATTACH") is None:
+            return False
+
+    return True
+
+
+def _nd2_is_complete(f, file_size):
+    """Check if an ND2 file ends in the chunk map signature and points to a
+    valid chunk map (which is written last). Returns None if the file is not
+    recognized as a modern (non-JPEG2000) ND2 file."""
+    magic = f.read(4)
+    if len(magic) < 4:
+        return False
+    if magic != b"\xda\xce\xbe\x0a":
+        return None
+    if file_size < 40:
+        return False
+    f.seek(file_size - 40)
+    trailer = f.read(40)
+    if trailer[:32] != b"ND2 CHUNK MAP SIGNATURE 0000001!":
+        return False
+    map_pos = struct.unpack("<Q", trailer[32:])[0]
+    if map_pos + 4 > file_size:
+        return False
+    f.seek(map_pos)
+    return f.read(4) == b"\xda\xce\xbe\x0a"
+
+
+def check_structural_completeness(target_path, file_size=None):
+    """Check if an image file is structurally complete, i.e. if the parts of
+    the file that are written last by the microscope software are present
+    and consistent (the terminated IFD chain and all referenced image data
+    for TIFF, the directory, metadata and all subblocks for CZI, and the
+    chunk map trailer for ND2).
+
+    Parameters
+    ----------
+    target_path : path-like
+        Path to the image file.
+    file_size : int, optional, default None
+        Size of the file in bytes, if already known. Otherwise, the file is
+        stat'ed to get its size.
+
+    Returns
+    -------
+    complete : bool or None
+        True if the file is structurally complete, False if it is not (yet),
+        and None if completeness cannot be determined for this file type.
+    """
+    checks = {
+        "tif": _tiff_is_complete,
+        "tiff": _tiff_is_complete,
+        "czi": _czi_is_complete,
+        "nd2": _nd2_is_complete,
+    }
+    check = checks.get(str(target_path).split(".")[-1].lower())
+    if check is None:
+        return None
+    try:
+        if file_size is None:
+            file_size = os.stat(target_path).st_size
+        with open(target_path, "rb") as f:
+            return check(f, file_size)
+    except (OSError, struct.error):
+        return False
+
+
+def probe_exclusive_access(target_path):
+    """Check if the file can be opened for writing, which fails on Windows as
+    long as the microscope software still holds it open for writing without
+    sharing write access. Always True on other operating systems, where file
+    access is not locked. The file is not modified.
+
+    Parameters
+    ----------
+    target_path : path-like
+        Path to the image file.
+
+    Returns
+    -------
+    accessible : bool
+        False if the file is (probably) still held open by another process.
+    """
+    if os.name != "nt":
+        return True
+    try:
+        with open(target_path, "r+b"):
+            pass
+    except OSError:
+        return False
+    return True
+
+
+def wait_for_write_completion(target_path, await_write=2, poll_min=0.01):
+    """Wait until an image file has been completely written.
+
+    The file is polled with an adaptive interval, starting at `poll_min` and
+    doubling (up to `await_write`) while its size is unchanged. The wait ends
+    as soon as the file size is unchanged since the previous poll, the file
+    is structurally complete (see `check_structural_completeness`) and it is
+    no longer held open by another process (see `probe_exclusive_access`).
+    If completeness cannot be determined from the file's structure, or if the
+    file still appears incomplete, the wait ends once the size has been stable
+    for at least `await_write` seconds.
+
+    Parameters
+    ----------
+    target_path : path-like
+        Path to the image file.
+    await_write : float, optional, default 2
+        Seconds for which the file size must be stable if the file cannot be
+        confirmed to be complete by other means; also the maximum interval
+        between polls.
+    poll_min : float, optional, default 0.01
+        Initial interval between polls in seconds.
+    """
+    file_size = os.stat(target_path).st_size
+    stable_since = perf_counter()
+    interval = poll_min
+    while True:
+        sleep(min(interval, await_write))
+        new_file_size = os.stat(target_path).st_size
+
+        # Restart with short intervals if the file is still growing
+        if new_file_size != file_size:
+            file_size = new_file_size
+            stable_since = perf_counter()
+            interval = poll_min
+            continue
+
+        # Return as soon as the file is confirmed to be complete...
+        if check_structural_completeness(target_path, file_size) and (
+            probe_exclusive_access(target_path)
+        ):
+            return
+
+        # ...or once its size has been stable for long enough
+        if perf_counter() - stable_since >= await_write:
+            return
+        interval *= 2
+
+
+def _reorder_to_tczyx(raw, axes):
+    """Transpose `raw` with dimensions `axes` into bioio's TCZYX order (adding
+    missing dimensions with size 1), as a view. A single unknown axis is
+    treated as Z. Returns None if the axes cannot be mapped unambiguously."""
+    axes = list(axes)
+    unknown = [ax for ax in axes if ax not in "TCZYX"]
+    if len(unknown) > 1 or len(set(axes)) != len(axes):
+        return None
+    if unknown:
+        if "Z" in axes:
+            return None
+        axes[axes.index(unknown[0])] = "Z"
+    sizes = dict(zip(axes, raw.shape))
+    order = sorted(range(len(axes)), key=lambda i: "TCZYX".index(axes[i]))
+    raw = raw.transpose(order)
+    return raw.reshape([sizes.get(ax, 1) for ax in "TCZYX"])
+
+
+def _memmap_tiff(target_path):
+    """Memory-map the first series of an uncompressed TIFF file as a strided
+    read-only view, if its pages are stored at regular intervals."""
+    import tifffile
+
+    with tifffile.TiffFile(target_path) as tif:
+        series = tif.series[0]
+        dtype = series.dtype.newbyteorder(tif.byteorder)
+        if not dtype.isnative:
+            return None
+
+        # Contiguous series (e.g. ImageJ hyperstacks)
+        if series.dataoffset is not None:
+            raw = np.memmap(
+                target_path,
+                dtype=dtype,
+                mode="r",
+                offset=series.dataoffset,
+                shape=series.shape,
+            )
+            return _reorder_to_tczyx(raw, series.axes)
+
+        # Pages with uncompressed, contiguous strips at regular intervals
+        keyframe = series.keyframe
+        if (
+            keyframe.compression != 1
+            or keyframe.samplesperpixel != 1
+            or keyframe.bitspersample != dtype.itemsize * 8
+            or len(keyframe.shape) != 2
+        ):
+            return None
+        page_offsets = []
+        for page in series.pages:
+            if page is None:
+                return None
+            offsets, counts = page.dataoffsets, page.databytecounts
+            if sum(counts) != keyframe.size * dtype.itemsize or any(
+                offsets[i] + counts[i] != offsets[i + 1]
+                for i in range(len(offsets) - 1)
+            ):
+                return None
+            page_offsets.append(offsets[0])
+        step = (
+            page_offsets[1] - page_offsets[0] if len(page_offsets) > 1 else 0
+        )
+        if any(
+            offset != page_offsets[0] + i * step
+            for i, offset in enumerate(page_offsets)
+        ):
+            return None
+        n_rows, n_cols = keyframe.shape
+        shape, axes = series.shape, series.axes
+
+    # Strided view onto the page data
+    mm = np.memmap(target_path, dtype=np.uint8, mode="r")
+    raw = np.ndarray(
+        shape=(len(page_offsets), n_rows, n_cols),
+        dtype=dtype,
+        buffer=mm,
+        offset=page_offsets[0],
+        strides=(step, n_cols * dtype.itemsize, dtype.itemsize),
+    )
+    return _reorder_to_tczyx(raw.reshape(shape), axes)
+
+
+def _memmap_nd2(target_path):
+    """Memory-map an uncompressed (modern) ND2 file as a strided read-only
+    view, if its frames are stored at regular intervals."""
+    import nd2
+
+    # Get image layout
+    with nd2.ND2File(target_path) as f:
+        if f.is_legacy or f.attributes.compressionType is not None:
+            return None
+        attrs = f.attributes
+        sizes = dict(f.sizes)
+        dtype = np.dtype(f.dtype)
+    loop_axes = [ax for ax in sizes if ax not in "CYX"]
+    n_comps = sizes.get("C", 1)
+    if (
+        any(ax not in "TZ" for ax in loop_axes)
+        or n_comps != attrs.componentCount
+        or attrs.bitsPerComponentInMemory != dtype.itemsize * 8
+    ):
+        return None
+
+    # Get frame positions from the chunk map
+    # Note: Each frame chunk consists of a 16-byte header, the chunk name
+    #       (padded to the length given in the header) and an 8-byte time
+    #       stamp, followed by the pixel data.
+    n_frames = int(np.prod([sizes[ax] for ax in loop_axes]))
+    frame_offsets = [None] * n_frames
+    with open(target_path, "rb") as f:
+        f.seek(-8, os.SEEK_END)
+        f.seek(struct.unpack("<Q", f.read(8))[0])
+        _, name_len, map_len = struct.unpack("<IIQ", f.read(16))
+        f.seek(name_len, os.SEEK_CUR)
+        chunk_map = f.read(map_len)
+        i = 0
+        while True:
+            j = chunk_map.find(b"!", i)
+            if j < 0 or j + 17 > len(chunk_map):
+                break
+            name = chunk_map[i : j + 1]
+            if name.startswith(b"ImageDataSeq|"):
+                index = int(name[13:-1])
+                if index < n_frames:
+                    chunk_pos = struct.unpack("<Q", chunk_map[j + 1 : j + 9])
+                    frame_offsets[index] = chunk_pos[0]
+            i = j + 17
+        if None in frame_offsets:
+            return None
+        for index, chunk_pos in enumerate(frame_offsets):
+            f.seek(chunk_pos + 4)
+            name_len = struct.unpack("<I", f.read(4))[0]
+            frame_offsets[index] = chunk_pos + 16 + name_len + 8
+    step = frame_offsets[1] - frame_offsets[0] if n_frames > 1 else 0
+    if any(
+        offset != frame_offsets[0] + i * step
+        for i, offset in enumerate(frame_offsets)
+    ):
+        return None
+
+    # Strided view onto the frame data
+    mm = np.memmap(target_path, dtype=np.uint8, mode="r")
+    raw = np.ndarray(
+        shape=(n_frames, attrs.heightPx, attrs.widthPx, n_comps),
+        dtype=dtype,
+        buffer=mm,
+        offset=frame_offsets[0],
+        strides=(
+            step,
+            attrs.widthBytes,
+            n_comps * dtype.itemsize,
+            dtype.itemsize,
+        ),
+    )
+    shape = [sizes[ax] for ax in loop_axes]
+    shape += [attrs.heightPx, attrs.widthPx, n_comps]
+    return _reorder_to_tczyx(raw.reshape(shape), loop_axes + ["Y", "X", "C"])
+
+
+def memmap_image(target_path):
+    """Memory-map the pixel data of an uncompressed TIFF or ND2 file, without
+    decoding it into memory.
+
+    The returned array is a read-only view onto the file, with the dimensions
+    T, C, Z, Y, X (as with bioio). Pixel data are only read from disk when
+    accessed. Note that (on Windows) the file cannot be
+    deleted or replaced as long as the array (or a view of it) exists.
+
+    Parameters
+    ----------
+    target_path : path-like
+        Path to the image file.
+
+    Returns
+    -------
+    raw : numpy array or None
+        Read-only 5D view of the image data, or None if the file cannot be
+        memory-mapped (unsupported file type, compressed or irregularly laid
+        out pixel data, non-native byte order, or unsupported dimensions).
+    """
+    loaders = {"tif": _memmap_tiff, "tiff": _memmap_tiff, "nd2": _memmap_nd2}
+    loader = loaders.get(str(target_path).split(".")[-1].lower())
+    if loader is None:
+        return None
+    try:
+        return loader(target_path)
+    except Exception:
+        return None
+
+
+def open_bioimage(target_path):
+    """Open an image with bioio, reusing the reader class that bioio resolved
+    for previous files with the same suffix (e.g. ".czi" or ".ome.tiff").
+
+    Resolving the reader requires bioio to check all installed plugins, which
+    takes tens of milliseconds per file. As all images of a DySTrack session
+    usually have the same format, the reader class resolved for the first
+    image is cached and passed directly to `BioImage` for subsequent images.
+
+    Parameters
+    ----------
+    target_path : path-like
+        Path to the image file.
+
+    Returns
+    -------
+    img : BioImage
+        The (lazily loaded) image.
+    """
+    suffix = "".join(Path(target_path).suffixes[-2:]).lower()
+    reader = _reader_cache.get(suffix)
+    if reader is not None:
+        return BioImage(target_path, reader=reader)
+    img = BioImage(target_path)
+    _reader_cache[suffix] = type(img.reader)
+    return img
+
+
+def clear_reader_cache():
+    """Forget the reader classes cached by `open_bioimage`."""
+    _reader_cache.clear()
+
+
+class InvalidSelectionError(IOError):
+    """Raised if the requested channel or z-planes are not in the image. Such
+    errors are raised right away, as retrying to load the image would not
+    resolve them."""
+
+
+def _get_plane_selection(dims, shape, channel=None, z_range=None, z_stride=1):
+    """Translate channel and z-plane selectors into slices per dimension.
+
+    Parameters
+    ----------
+    dims : str
+        Dimension order of the image, e.g. "TCZYX".
+    shape : tuple of int
+        Shape of the image.
+    channel, z_range, z_stride
+        See `robustly_load_image_after_write`.
+
+    Returns
+    -------
+    selection : dict
+        Slice (with explicit start and stop) for each selected dimension.
+
+    Raises
+    ------
+    InvalidSelectionError
+        If the channel or the start of the z-range is not in the image.
+    """
+    sizes = dict(zip(dims, shape))
+    selection = {}
+    if channel is not None:
+        if channel >= sizes.get("C", 1):
+            errmsg = (
+                f"CHANNEL {channel} given but image has only"
+                + f" {sizes.get('C', 1)} channel(s)!"
+            )
+            raise InvalidSelectionError(errmsg)
+        elif sizes["C"] > 5:
+            warn(f"CHANNEL given but image dim C is of size {sizes['C']}!")
+        selection["C"] = slice(channel, channel + 1)
+    if (z_range is not None) or (z_stride != 1):
+        n_z = sizes.get("Z", 1)
+        z_start, z_stop = (0, n_z) if z_range is None else z_range
+        if z_start >= n_z:
+            errmsg = (
+                f"Z_RANGE starting at {z_start} given but image has only"
+                + f" {n_z} z-plane(s)!"
+            )
+            raise InvalidSelectionError(errmsg)
+        selection["Z"] = slice(z_start, min(z_stop, n_z), z_stride)
+    return selection
+
+
+def _drop_singleton_dims(raw, dims):
+    """Drop all dimensions of size 1 except Y and X (unlike `np.squeeze`).
+
+    Returns
+    -------
+    raw : numpy array
+        View of the image data without singleton dimensions.
+    dims : str
+        Dimension order of the returned array.
+    """
+    keep = [i for i, d in enumerate(dims) if d in "YX" or raw.shape[i] > 1]
+    raw = raw.reshape([raw.shape[i] for i in keep])
+    return raw, "".join(dims[i] for i in keep)
+
+
+def _prefetch_key(target_path, load_kwargs):
+    """Key of a prefetch, matching calls with the same path and settings."""
+    return (os.path.abspath(target_path), repr(sorted(load_kwargs.items())))
+
+
+def _pop_prefetch(target_path, load_kwargs):
+    """Remove and return the prefetch future for a call, if there is one."""
+    with _prefetch_lock:
+        return _prefetched.pop(_prefetch_key(target_path, load_kwargs), None)
+
+
+def _prefetch_load(target_path, **load_kwargs):
+    """Load an image for `prefetch_image`. Memory-mapped images are read
+    once (one value per memory page), so that their pixel data are already
+    in the OS's page cache when the pipeline accesses them."""
+    raw = _load_image_after_write(target_path, **load_kwargs)
+    if load_kwargs["memmap"]:
+        np.max(raw[..., :: max(1, mmap.PAGESIZE // raw.itemsize)])
+    return raw
+
+
+def prefetch_image(target_path, **load_kwargs):
+    """Start loading an image in a background thread, so that it is already in
+    memory when `robustly_load_image_after_write` is called for it.
+
+    The prefetch waits for the file to be completely written, just like the
+    regular loader, and its result is handed to the first subsequent call of
+    `robustly_load_image_after_write` with the same `target_path` and the same
+    loader arguments (calls with different arguments load the image as usual).
+    If the prefetch fails, that call loads the image itself. With `memmap`,
+    the pixel data are read into the OS's page cache in the background.
+
+    Only the `MAX_PREFETCHED` most recent prefetches are kept; older ones that
+    were never used are discarded. Prefetching a path again (e.g. after it was
+    overwritten) replaces the previous prefetch. Prefetches that are not used
+    can be discarded with `discard_prefetch`; `stop_prefetching` discards all
+    of them and stops the background threads (e.g. at the end of a session).
+
+    Parameters
+    ----------
+    target_path : path-like
+        Path to the image file that is to be loaded.
+    **load_kwargs
+        Arguments for `robustly_load_image_after_write`. Unknown arguments are
+        ignored, so all image analysis kwargs can be passed.
+    """
+    global _prefetch_executor
+
+    # Use the loader's defaults to match calls that rely on them
+    load_kwargs = {
+        name: load_kwargs.get(name, param.default)
+        for name, param in inspect.signature(
+            _load_image_after_write
+        ).parameters.items()
+        if name != "target_path"
+    }
+
+    with _prefetch_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="dystrack_prefetch"
+            )
+        key = _prefetch_key(target_path, load_kwargs)
+        _prefetched.pop(key, None)
+        _prefetched[key] = _prefetch_executor.submit(
+            _prefetch_load, target_path, **load_kwargs
+        )
+        while len(_prefetched) > MAX_PREFETCHED:
+            _prefetched.pop(next(iter(_prefetched))).cancel()
+
+
+def discard_prefetch(target_path):
+    """Discard all prefetches of an image that have not been used (yet).
+
+    Parameters
+    ----------
+    target_path : path-like
+        Path to the image file.
+    """
+    path = os.path.abspath(target_path)
+    with _prefetch_lock:
+        for key in [key for key in _prefetched if key[0] == path]:
+            _prefetched.pop(key).cancel()
+
+
+def stop_prefetching():
+    """Discard all unused prefetches and shut down the background threads
+    that load them. A later call of `prefetch_image` starts new threads."""
+    global _prefetch_executor
+    with _prefetch_lock:
+        for future in _prefetched.values():
+            future.cancel()
+        _prefetched.clear()
+        if _prefetch_executor is not None:
+            _prefetch_executor.shutdown(wait=False, cancel_futures=True)
+            _prefetch_executor = None
+
+
+def robustly_load_image_after_write(
+    target_path,
+    await_write=2,
+    memmap=False,
+    channel=None,
+    z_range=None,
+    z_stride=1,
+):
     """Load an image from a specified target path using bioio, ensuring (as)
     (best as possible using simple means) that the image is no longer being
     actively written out by the microscope.
 
-    Works by repeatedly checking the target file size and initiating the load
-    only if the size has not increased for at least 2 seconds. Loading itself
-    is attempted multiple times in case it fails for some reason.
+    Works by polling the target file until it is complete; for supported file
+    types, the loader returns as soon as the file's structure shows that it
+    has been fully written (see `wait_for_write_completion`), otherwise only
+    after its size has not changed for `await_write` seconds. Loading itself
+    is attempted multiple times (with increasing delays) in case it fails for
+    some reason.
 
     Currently supported file types:
         - `["tif", "tiff", "czi", "nd2"]`
@@ -35,40 +734,110 @@ def robustly_load_image_after_write(target_path, await_write=2):
     target_path : path-like
         Path to the image file that is to be analyzed.
     await_write : int, optional, default 2
-        Seconds to wait between each check of the target file size to determine
-        if the file is still being written to. Reducing this will shave off
-        latency but increases the risk of race conditions.
+        Seconds for which the target file size must be stable before loading
+        if the file cannot be confirmed to be complete based on its structure;
+        also the maximum delay between loading attempts. Reducing this will
+        shave off latency for such files but increases the risk of race
+        conditions.
+    memmap : bool, optional, default False
+        If True, uncompressed TIFF and ND2 files are memory-mapped instead of
+        being decoded into memory (see `memmap_image`), which reduces loading
+        time and memory use for large images. The returned array is then a
+        read-only view onto the file. Other files are loaded as usual.
+    channel : int, optional, default None
+        Index of the channel to load. If None, all channels are loaded.
+    z_range : tuple of int, optional, default None
+        Start (inclusive) and stop (exclusive) index of the z-planes to load.
+        If None, all z-planes are loaded.
+    z_stride : int, optional, default 1
+        Step between loaded z-planes, e.g. 2 to load every second plane.
+
+    Only the selected channel and planes are read from disk (through bioio's
+    lazy reader, or by indexing into the memory map). If they are not in the
+    image, an `InvalidSelectionError` is raised without further attempts.
 
     Returns
     -------
     raw : numpy array
-        Loaded image data.
+        Loaded image data. Dimensions are in bioio's order (T, C, Z, Y, X),
+        except that T, C and Z are dropped where they are of size 1 (e.g. C if
+        a channel was selected); Y and X are always retained.
     """
 
+    # Use the result of a background prefetch, if one has been started
+    load_kwargs = {
+        "await_write": await_write,
+        "memmap": memmap,
+        "channel": channel,
+        "z_range": z_range,
+        "z_stride": z_stride,
+    }
+    future = _pop_prefetch(target_path, load_kwargs)
+    if future is not None:
+        with stage_timer("decode"):
+            try:
+                return future.result()
+            except InvalidSelectionError:
+                raise
+            except Exception:
+                pass  # Retry without prefetching below
+
+    return _load_image_after_write(target_path, **load_kwargs)
+
+
+def _load_image_after_write(
+    target_path,
+    await_write=2,
+    memmap=False,
+    channel=None,
+    z_range=None,
+    z_stride=1,
+):
+    """See `robustly_load_image_after_write` (which additionally checks for
+    prefetched images)."""
+
     # Make multiple attempts in case loading fails
     attempts_left = 5
-    file_size = os.stat(target_path).st_size
+    retry_delay = 0.1
     while True:
 
         # Wait until the file is no longer being written to
         # Note: Some microscope software may intermittently stop writing, so
         #       this is not a perfect check for whether the file is complete;
         #       hence the multiple loading attempts...
-        while True:
-            sleep(await_write)
-            new_file_size = os.stat(target_path).st_size
-            if new_file_size > file_size:
-                file_size = new_file_size
-                attempts_left = 5
-            else:
-                break
+        with stage_timer("wait_write"):
+            wait_for_write_completion(target_path, await_write)
 
         # If the file writing looks done, make a loading attempt
         try:
             if target_path.split(".")[-1] in ["tif", "tiff", "czi", "nd2"]:
-                raw = BioImage(target_path)
-                raw = raw.data
-                raw = np.squeeze(raw)
+                with stage_timer("decode"):
+
+                    # Index into the memory map...
+                    raw = memmap_image(target_path) if memmap else None
+                    if raw is not None:
+                        dims = "TCZYX"
+                        selection = _get_plane_selection(
+                            dims, raw.shape, channel, z_range, z_stride
+                        )
+                        raw = raw[
+                            tuple(selection.get(d, slice(None)) for d in dims)
+                        ]
+
+                    # ...or read only the selected planes with bioio
+                    else:
+                        img = open_bioimage(target_path)
+                        dims = img.dims.order
+                        selection = _get_plane_selection(
+                            dims, img.shape, channel, z_range, z_stride
+                        )
+                        if selection:
+                            raw = img.get_image_dask_data(dims, **selection)
+                            raw = np.asarray(raw.compute())
+                        else:
+                            raw = img.data
+
+                    raw, dims = _drop_singleton_dims(raw, dims)
 
             # Handle unknown file endings
             else:
@@ -95,6 +864,10 @@ def robustly_load_image_after_write(target_path, await_write=2):
             # Exit the loop of loading attempts if loading was successful
             break
 
+        # Raise invalid selections right away; retrying would not help
+        except InvalidSelectionError:
+            raise
+
         # In case of failure, retry if there are still attempts left, otherwise
         # raise the Exception
         except Exception as err:
@@ -108,7 +881,9 @@ def robustly_load_image_after_write(target_path, await_write=2):
                 )
                 raise
             else:
-                sleep(2)
+                with stage_timer("wait_write"):
+                    sleep(min(retry_delay, await_write))
+                retry_delay *= 2
 
     # In case of success, return the loaded image
     return raw
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for computing the marginals (sums, means and maxima
+            along one or more axes) of an image in a single pass, such that
+            the projections, profiles and centroids needed by a pipeline and
+            its diagnostic plots share the same reductions.
+"""
+
+import numpy as np
+
+# Reductions that can be computed in the single pass
+REDUCTIONS = ("sum", "max")
+
+
+class Marginals:
+    """Memoized marginals of a 2D or 3D image.
+
+    On first use, the image is reduced along each of its axes (for 3D images
+    plane by plane, so each z-plane is read once and stays in cache while
+    it is reduced along y and x). Reductions along several axes (e.g. the
+    profiles along a single axis) and centroids are then derived from these
+    projections, which are small compared to the image. All results are
+    memoized, so an object created once per frame can be shared by the
+    analysis and any diagnostic plots.
+
+    Sums are computed in float64. Maxima keep the dtype of the image.
+
+    Parameters
+    ----------
+    img : numpy array
+        Input image (2D or 3D); may be a (read-only) memory-mapped array.
+    reductions : sequence of str, optional, default ("sum", "max")
+        Reductions computed in the first pass over the image. Others are
+        computed in an additional pass when first requested.
+    """
+
+    def __init__(self, img, reductions=REDUCTIONS):
+        if img.ndim not in (2, 3):
+            raise ValueError("Marginals require a 2D or 3D image.")
+        if any(r not in REDUCTIONS for r in reductions):
+            raise ValueError("Invalid reduction; must be 'sum' or 'max'.")
+        self.img = img
+        self.ndim = img.ndim
+        self.shape = img.shape
+        self._reductions = tuple(reductions)
+        self._projections = {}
+        self._memo = {}
+
+    def _project(self, reductions):
+        """Reduce the image along each single axis in one pass."""
+
+        # Prep
+        img = self.img
+        do_sum, do_max = "sum" in reductions, "max" in reductions
+
+        # 2D: reduce directly
+        if self.ndim == 2:
+            if do_sum:
+                self._projections["sum"] = [
+                    np.sum(img, axis=axis, dtype=np.float64) for axis in (0, 1)
+                ]
+            if do_max:
+                self._projections["max"] = [
+                    np.max(img, axis=a) for a in (0, 1)
+                ]
+            return
+
+        # 3D: reduce plane by plane
+        size_z, size_y, size_x = self.shape
+        if do_sum:
+            sums = [
+                np.zeros((size_y, size_x)),
+                np.zeros((size_z, size_x)),
+                np.zeros((size_z, size_y)),
+            ]
+        if do_max:
+            maxs = [
+                np.array(img[0]),
+                np.empty((size_z, size_x), dtype=img.dtype),
+                np.empty((size_z, size_y), dtype=img.dtype),
+            ]
+        for z, plane in enumerate(img):
+            if do_sum:
+                np.add(sums[0], plane, out=sums[0])
+                np.sum(plane, axis=0, dtype=np.float64, out=sums[1][z])
+                np.sum(plane, axis=1, dtype=np.float64, out=sums[2][z])
+            if do_max:
+                np.maximum(maxs[0], plane, out=maxs[0])
+                np.max(plane, axis=0, out=maxs[1][z])
+                np.max(plane, axis=1, out=maxs[2][z])
+        if do_sum:
+            self._projections["sum"] = sums
+        if do_max:
+            self._projections["max"] = maxs
+
+    def _reduce(self, reduction, axis):
+        """Get the reduction of the image along the given axes (memoized)."""
+
+        # Normalize the axes
+        axes = np.atleast_1d(axis).tolist()
+        axes = tuple(sorted({a % self.ndim for a in axes}))
+        key = (reduction, axes)
+        if key in self._memo:
+            return self._memo[key]
+
+        # Run the pass over the image if needed
+        if reduction not in self._projections:
+            pending = [
+                r for r in self._reductions if r not in self._projections
+            ]
+            self._project(pending if reduction in pending else [reduction])
+
+        # Reduce the projection along the first axis further as needed
+        result = self._projections[reduction][axes[0]]
+        if len(axes) > 1:
+            rest = tuple(a - 1 for a in axes[1:])
+            func = np.sum if reduction == "sum" else np.max
+            result = func(result, axis=rest)
+
+        self._memo[key] = result
+        return result
+
+    def sum(self, axis):
+        """Sum of the image along one or more axes (float64)."""
+        return self._reduce("sum", axis)
+
+    def max(self, axis):
+        """Maximum of the image along one or more axes."""
+        return self._reduce("max", axis)
+
+    def mean(self, axis):
+        """Mean of the image along one or more axes (float64)."""
+        axes = np.atleast_1d(axis).tolist()
+        size = np.prod([self.shape[a] for a in {a % self.ndim for a in axes}])
+        return self.sum(axis) / size
+
+    def profile(self, axis, reduction="sum"):
+        """Profile along a single axis, i.e. the reduction along all others.
+
+        Parameters
+        ----------
+        axis : int
+            Axis along which the profile is taken.
+        reduction : str, optional, default "sum"
+            One of "sum", "mean" or "max".
+
+        Returns
+        -------
+        profile : numpy array
+            Profile of length `shape[axis]`.
+        """
+        others = tuple(a for a in range(self.ndim) if a != axis % self.ndim)
+        if reduction == "mean":
+            return self.mean(others)
+        return self._reduce(reduction, others)
+
+    def centroid(self):
+        """Intensity-weighted centroid of the image, as `ndi.center_of_mass`,
+        computed from the sum profiles along each axis.
+
+        Returns
+        -------
+        cen : tuple of floats
+            Centroid along each axis.
+        """
+        if "centroid" not in self._memo:
+            profiles = [self.profile(axis) for axis in range(self.ndim)]
+            total = profiles[0].sum()
+            self._memo["centroid"] = tuple(
+                float(prof @ np.arange(prof.size) / total) for prof in profiles
+            )
+        return self._memo["centroid"]
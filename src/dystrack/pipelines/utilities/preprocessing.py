@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for preprocessing images prior to image analysis, such as
+            the conversion to 8bit and Gaussian smoothing.
+"""
+
+from warnings import simplefilter, warn
+
+simplefilter("always", UserWarning)
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.ndimage as ndi
+
+# Number of elements processed at once; small enough for the chunk and its
+# float64 temporaries to stay in cache, large enough to keep python overhead
+# negligible
+CHUNK_SIZE = 2**18
+
+
+def _iter_chunks(img):
+    """Yield index tuples that split `img` into blocks along its first axis
+    with about `CHUNK_SIZE` elements each."""
+    if img.ndim == 0 or img.size == 0:
+        return
+    step = max(1, CHUNK_SIZE // max(1, img.size // img.shape[0]))
+    for start in range(0, img.shape[0], step):
+        yield (slice(start, start + step),)
+
+
+def min_max(img):
+    """Get the minimum and maximum of an image in a single (chunked) pass over
+    memory, rather than the two full passes of `img.min()` and `img.max()`.
+
+    Parameters
+    ----------
+    img : numpy array
+        Input image; may be a (read-only) memory-mapped array.
+
+    Returns
+    -------
+    img_min, img_max : scalars
+        Minimum and maximum value of the image.
+    """
+    img_min, img_max = None, None
+    for chunk in _iter_chunks(img):
+        chunk_min, chunk_max = img[chunk].min(), img[chunk].max()
+        if img_min is None or chunk_min < img_min:
+            img_min = chunk_min
+        if img_max is None or chunk_max > img_max:
+            img_max = chunk_max
+    return img_min, img_max
+
+
+def rescale_to_8bit(img, value_range=None, out=None):
+    """Convert an image to 8bit by min-max scaling, such that the minimum is
+    mapped to 0 and the maximum to 255 (values in between are truncated).
+
+    The conversion is done chunk by chunk into a preallocated output, so only
+    the output itself (rather than full-size float64 copies of the image) is
+    added to peak memory. The result is identical to::
+
+        ((img.astype(float) - img.min()) / (img.max() - img.min()) * 255
+        ).astype(np.uint8)
+
+    except for constant images, which are mapped to 0 rather than failing.
+
+    Parameters
+    ----------
+    img : numpy array
+        Input image of any real dtype; may be a (read-only) memory-mapped
+        array.
+    value_range : tuple of scalars or None, optional, default None
+        Minimum and maximum to use for the scaling, e.g. those of the full
+        image when converting a part of it. If None, they are taken from `img`
+        (see `min_max`).
+    out : numpy array of uint8 or None, optional, default None
+        Preallocated output of the same shape as `img` (e.g. from a
+        `BufferPool`). If None, a new array is allocated.
+
+    Returns
+    -------
+    img_8bit : numpy array of uint8
+        Rescaled image of the same shape as `img`; `out` if given.
+    """
+
+    # Prep
+    if value_range is None:
+        value_range = min_max(img)
+    img_min, img_max = value_range
+    if out is None:
+        img_8bit = np.zeros(img.shape, dtype=np.uint8)
+    else:
+        img_8bit = out
+    if img.size == 0 or img_max == img_min:
+        img_8bit[...] = 0
+        return img_8bit
+    img_min, img_range = float(img_min), float(img_max - img_min)
+
+    # Rescale chunk-wise, reusing the float64 temporary for all steps
+    for chunk in _iter_chunks(img):
+        tmp = img[chunk].astype(np.float64)
+        tmp -= img_min
+        tmp /= img_range
+        tmp *= 255
+        img_8bit[chunk] = tmp
+
+    return img_8bit
+
+
+def convert_image(
+    raw, warn_8bit=True, keep_16bit=False, value_range=None, out=None
+):
+    """Convert an image to the bit depth used by the image analysis pipelines.
+
+    Images that are not 8bit are converted to 8bit using min-max scaling (see
+    `rescale_to_8bit`), unless `keep_16bit` is set and the image is 16bit, in
+    which case it is returned as is. This native 16bit path is intended for
+    analyses that work with 16bit values and histograms (e.g. intensity-
+    weighted centroids, Otsu thresholding, or intensity profiles) and so do
+    not need to pay for (or lose precision through) the conversion.
+
+    Parameters
+    ----------
+    raw : numpy array
+        Input image.
+    warn_8bit : bool, optional, default True
+        Whether to emit a warning when the image is converted to 8bit.
+    keep_16bit : bool, optional, default False
+        If True, uint16 images are not down-converted.
+    value_range : tuple of scalars or None, optional, default None
+        Minimum and maximum to use for the conversion (see `rescale_to_8bit`).
+    out : numpy array of uint8 or None, optional, default None
+        Preallocated output for the conversion (see `rescale_to_8bit`); unused
+        if the image is not converted.
+
+    Returns
+    -------
+    raw : numpy array of uint8 (or uint16 if `keep_16bit` is True)
+        Converted image; the input itself if no conversion was needed.
+    """
+
+    # Pass through images that are already in a suitable format
+    if raw.dtype == np.uint8:
+        return raw
+    if keep_16bit and raw.dtype == np.uint16:
+        return raw
+
+    # Convert to 8bit
+    # NOTE: This conversion scales min to 0 and max to 255!
+    if warn_8bit:
+        warn("Image converted down to 8bit using min-max scaling!")
+    return rescale_to_8bit(raw, value_range, out)
+
+
+def gaussian_smooth(img, sigma, workers=1, out=None):
+    """Gaussian smoothing of an image, multithreaded over slabs of the image.
+
+    The image is split into slabs along its longest axis other than the last
+    (usually y for 3D prescans, which tend to have few z-slices). Each slab is
+    extended by a halo of the filter's radius (`int(4 * sigma + 0.5)`, as per
+    the defaults of `ndi.gaussian_filter`) along the split axis, filtered on a
+    pool of threads (`ndi.gaussian_filter` releases the GIL), and written into
+    a preallocated output without its halo.
+
+    Since only the pass along the split axis mixes values across slabs and the
+    halo covers its full reach, the output is bit-identical to that of
+    `ndi.gaussian_filter(img, sigma=sigma)`, including the rounding of the
+    intermediate results for integer images.
+
+    Parameters
+    ----------
+    img : numpy array
+        Input image (2D or 3D); may be a (read-only) memory-mapped array.
+    sigma : float or sequence of floats
+        Standard deviation of the Gaussian kernel, either for all axes or for
+        each axis.
+    workers : int, optional, default 1
+        Number of threads (and slabs). Images that are too small to be split
+        are filtered in one go. Only use more than one thread if the image
+        analyses do not already run in parallel (e.g. in the manager's worker
+        threads or processes), which would oversubscribe the CPUs.
+    out : numpy array or None, optional, default None
+        Preallocated output of the same shape and dtype as `img` (e.g. from a
+        `BufferPool`); must not overlap with `img`. If None, a new array is
+        allocated.
+
+    Returns
+    -------
+    img_smooth : numpy array
+        Smoothed image of the same shape and dtype as `img`; `out` if given.
+    """
+
+    # Prep
+    sigmas = np.broadcast_to(np.asarray(sigma, dtype=float), (img.ndim,))
+
+    # Pick the split axis and the halo needed along it
+    axis = int(np.argmax(img.shape[:-1])) if img.ndim > 1 else 0
+    halo = int(4.0 * sigmas[axis] + 0.5) if sigmas[axis] > 1e-15 else 0
+
+    # Filter small images in one go
+    n_slabs = min(workers, img.shape[axis] // max(halo, 1))
+    if n_slabs <= 1:
+        return ndi.gaussian_filter(img, sigma=sigma, output=out)
+
+    # Prep slabs and output
+    bounds = np.linspace(0, img.shape[axis], n_slabs + 1).astype(int)
+    if out is None:
+        img_smooth = np.empty(img.shape, dtype=img.dtype)
+    else:
+        img_smooth = out
+
+    def smooth_slab(start, stop):
+        outer = slice(max(start - halo, 0), min(stop + halo, img.shape[axis]))
+        inner = slice(start - outer.start, stop - outer.start)
+        index = (slice(None),) * axis
+        slab = ndi.gaussian_filter(img[index + (outer,)], sigma=sigma)
+        img_smooth[index + (slice(start, stop),)] = slab[index + (inner,)]
+
+    # Filter slabs on a thread pool
+    with ThreadPoolExecutor(max_workers=n_slabs) as pool:
+        list(pool.map(smooth_slab, bounds[:-1], bounds[1:]))
+
+    return img_smooth
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for projection-first analysis of 3D images, where y and
+            x are found on a 2D projection and z only on a narrow column of
+            voxels around the resulting position.
+"""
+
+import numpy as np
+
+
+def project_stack(stack, projection="max"):
+    """Project a 3D image along z.
+
+    Parameters
+    ----------
+    stack : numpy array
+        Input image (3D).
+    projection : str, optional, default "max"
+        Type of projection; either "max" or "mean".
+
+    Returns
+    -------
+    proj : numpy array
+        2D projection of the same dtype as `stack`; mean projections of
+        integer images are rounded.
+    """
+    if projection == "max":
+        return np.max(stack, axis=0)
+    elif projection == "mean":
+        proj = np.mean(stack, axis=0, dtype=np.float64)
+        if np.issubdtype(stack.dtype, np.integer):
+            proj = np.rint(proj)
+        return proj.astype(stack.dtype)
+    else:
+        raise ValueError("Invalid `projection`; must be 'max' or 'mean'.")
+
+
+def column_z_position(stack, yx, radius=10):
+    """Get the z position of an object from a column of voxels around its yx
+    position.
+
+    The column's mean intensity profile along z is background-subtracted
+    (by its minimum) and its intensity-weighted centroid is returned.
+
+    Parameters
+    ----------
+    stack : numpy array
+        Input image (3D).
+    yx : sequence of floats
+        Position of the object in y and x.
+    radius : int, optional, default 10
+        Half-width of the column in y and x, in pixels.
+
+    Returns
+    -------
+    z_pos : float
+        Position of the object in z. If the profile is flat, the center of
+        the stack is returned.
+    """
+
+    # Get the column's z profile
+    y, x = (int(round(c)) for c in yx)
+    column = stack[
+        :,
+        max(y - radius, 0) : y + radius + 1,
+        max(x - radius, 0) : x + radius + 1,
+    ]
+    profile = np.mean(column, axis=(1, 2), dtype=np.float64)
+    profile -= profile.min()
+
+    # Get its centroid
+    if profile.sum() == 0:
+        return (stack.shape[0] - 1) / 2.0
+    return float(profile @ np.arange(profile.size) / profile.sum())
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for ROI-restricted analysis, where only a region of
+            interest (ROI) in y and x around the expected position of the
+            tracked object is analyzed, based on its bounding box in the
+            previous frame.
+"""
+
+import numpy as np
+
+
+def crop_to_roi(img, roi):
+    """Crop an image to an ROI in y and x.
+
+    Parameters
+    ----------
+    img : numpy array
+        Image (2D or 3D).
+    roi : tuple of tuples of int
+        Start and stop of the ROI in y and x, as `((y0, y1), (x0, x1))`.
+
+    Returns
+    -------
+    img_roi : numpy array
+        View of the image cropped to the ROI.
+    """
+    (y0, y1), (x0, x1) = roi
+    return img[..., y0:y1, x0:x1]
+
+
+def touches_roi_border(bbox, mask_shape, roi, frame_shape):
+    """Check if an object touches a border of the ROI it was found in that is
+    not also a border of the full frame.
+
+    Parameters
+    ----------
+    bbox : tuple of slices
+        Bounding box of the object in y and x (see `component_stats`).
+    mask_shape : tuple of int
+        Shape of the mask in which the object was found.
+    roi : tuple of tuples of int
+        ROI in y and x in pixels of the full frame (see `crop_to_roi`).
+    frame_shape : tuple of int
+        Shape of the full frame.
+
+    Returns
+    -------
+    touches : bool
+        True if the object touches an inner border of the ROI.
+    """
+    for index, size, (start, stop), frame_size in zip(
+        bbox, mask_shape[-2:], roi, frame_shape[-2:]
+    ):
+        if index.start == 0 and start > 0:
+            return True
+        if index.stop == size and stop < frame_size:
+            return True
+    return False
+
+
+def next_roi(bbox, factors, roi, pos, frame_shape, margin):
+    """Get the ROI in which to look for an object in the next frame.
+
+    The object's bounding box is converted to pixels of the full frame and
+    shifted by the movement of the field of view, assuming that the scope
+    centers the next frame on the new coordinates. It is then expanded by a
+    margin on each side and clipped to the frame.
+
+    Parameters
+    ----------
+    bbox : tuple of slices
+        Bounding box of the object in y and x (see `component_stats`), possibly
+        in a binned image and/or within an ROI.
+    factors : tuple of int
+        Binning factor for y and x (see `get_bin_factors`).
+    roi : tuple of tuples of int or None
+        ROI within which the object was found (see `crop_to_roi`), or None if
+        it was found in the full frame.
+    pos : tuple of floats
+        New y and x coordinates for the next acquisition.
+    frame_shape : tuple of int
+        Shape of the full frame.
+    margin : float
+        Margin added on each side, as a fraction of the frame size.
+
+    Returns
+    -------
+    roi : tuple of tuples of int or None
+        Start and stop of the ROI in y and x, or None if the expected position
+        of the object is outside of the next frame.
+    """
+    next_roi = []
+    for axis, (index, f, p, size) in enumerate(
+        zip(bbox, factors, pos, frame_shape[-2:])
+    ):
+        offset = roi[axis][0] if roi is not None else 0
+        shift = p - (size - 1) / 2.0
+        pad = margin * size
+        start = max(int(np.floor(index.start * f + offset - shift - pad)), 0)
+        stop = min(int(np.ceil(index.stop * f + offset - shift + pad)), size)
+        if stop <= start:
+            return None
+        next_roi.append((start, stop))
+    return tuple(next_roi)
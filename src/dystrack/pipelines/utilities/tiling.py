@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Utilities for analyzing large images tile by tile, such that only
+            about one tile (rather than several full-size copies of the image)
+            has to be held in memory at a time.
+"""
+
+from warnings import simplefilter, warn
+
+simplefilter("always", UserWarning)
+
+import numpy as np
+import scipy.ndimage as ndi
+from skimage.filters import threshold_otsu
+
+from dystrack.pipelines.utilities.components import object_moments
+from dystrack.pipelines.utilities.preprocessing import (
+    convert_image,
+    gaussian_smooth,
+    min_max,
+)
+
+
+def iter_tiles(shape, tile_size, halo=0):
+    """Split an image into tiles in y and x (the last two axes); any leading
+    axes (i.e. z) are kept whole.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the image (2D or 3D).
+    tile_size : int
+        Size of the tiles in y and x, without halo.
+    halo : int, optional, default 0
+        Overlap by which each tile is extended on all sides (where possible).
+
+    Yields
+    ------
+    tile_index : tuple of int
+        Position of the tile in the grid of tiles (y, x).
+    inner : tuple of slices
+        Index of the tile in the image, without halo.
+    outer : tuple of slices
+        Index of the tile in the image, with halo.
+    local : tuple of slices
+        Index of the tile without halo within the tile with halo.
+    """
+    lead = (slice(None),) * (len(shape) - 2)
+    size_y, size_x = shape[-2:]
+    for iy, y0 in enumerate(range(0, size_y, tile_size)):
+        for ix, x0 in enumerate(range(0, size_x, tile_size)):
+            y1, x1 = min(y0 + tile_size, size_y), min(x0 + tile_size, size_x)
+            oy0, ox0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            oy1, ox1 = min(y1 + halo, size_y), min(x1 + halo, size_x)
+            inner = lead + (slice(y0, y1), slice(x0, x1))
+            outer = lead + (slice(oy0, oy1), slice(ox0, ox1))
+            local = lead + (
+                slice(y0 - oy0, y1 - oy0),
+                slice(x0 - ox0, x1 - ox0),
+            )
+            yield (iy, ix), inner, outer, local
+
+
+def iter_smoothed_tiles(
+    raw, gauss_sigma, tile_size, warn_8bit=True, keep_16bit=False
+):
+    """Convert and smooth an image tile by tile.
+
+    Each tile is read with a halo of the Gaussian filter's radius, converted
+    to 8bit (using the minimum and maximum of the full image, see
+    `convert_image`), smoothed, and cropped back to its inner region. The
+    result is thus identical to converting and smoothing the full image and
+    then cutting it into tiles.
+
+    Parameters
+    ----------
+    raw : numpy array
+        Input image (2D or 3D); ideally a memory-mapped array, so that only
+        the current tile is read into memory.
+    gauss_sigma : float
+        Sigma for Gaussian filter.
+    tile_size : int
+        Size of the tiles in y and x.
+    warn_8bit : bool, optional, default True
+        Whether to emit a warning (once) if the image is converted to 8bit.
+    keep_16bit : bool, optional, default False
+        If True, uint16 images are not down-converted.
+
+    Yields
+    ------
+    tile_index : tuple of int
+        Position of the tile in the grid of tiles (y, x).
+    inner : tuple of slices
+        Index of the tile in the image.
+    tile : numpy array
+        Converted and smoothed tile.
+    """
+
+    # Get the value range of the full image for 8bit conversion
+    value_range = None
+    if raw.dtype != np.uint8 and not (keep_16bit and raw.dtype == np.uint16):
+        if warn_8bit:
+            warn("Image converted down to 8bit using min-max scaling!")
+        value_range = min_max(raw)
+
+    # Process tiles
+    halo = int(4.0 * gauss_sigma + 0.5)
+    for tile_index, inner, outer, local in iter_tiles(
+        raw.shape, tile_size, halo
+    ):
+        tile = convert_image(
+            np.asarray(raw[outer]),
+            warn_8bit=False,
+            keep_16bit=keep_16bit,
+            value_range=value_range,
+        )
+        tile = gaussian_smooth(tile, gauss_sigma)
+        yield tile_index, inner, tile[local]
+
+
+def _tile_coords(inner, shape):
+    """Get the global coordinates of a tile's voxels along each axis."""
+    return [
+        np.arange(index.start or 0, (index.start or 0) + size, dtype=float)
+        for index, size in zip(inner, shape)
+    ]
+
+
+def _find(parents, label):
+    """Find the root of a label in a union-find forest (with path halving)."""
+    while parents[label] != label:
+        parents[label] = parents[parents[label]]
+        label = parents[label]
+    return label
+
+
+def tiled_center_of_mass(
+    raw,
+    method="intensity",
+    gauss_sigma=3.0,
+    tile_size=1024,
+    warn_8bit=True,
+    keep_16bit=False,
+    verbose=False,
+):
+    """Compute the center of mass of an image tile by tile, with the same
+    result as the full-image analysis of the `center_of_mass` pipeline.
+
+    Tiles are converted and smoothed with overlap (see `iter_smoothed_tiles`)
+    and reduced to small summaries that are combined into the final result:
+
+        - "intensity": Intensity-weighted moments are summed across tiles.
+        - "otsu": A histogram is summed across tiles to get the Otsu threshold.
+          In a second pass, each tile is masked and labeled, and the sizes and
+          moments of its objects are recorded. Objects that touch across tile
+          borders are merged (union-find), and the centroid of the largest
+          merged object is returned.
+
+    The "objct" method is not supported (a ValueError is raised), since its
+    object counts would require merging the objects across tile borders for
+    every threshold.
+
+    Parameters
+    ----------
+    raw : numpy array
+        Input image (2D or 3D); ideally a memory-mapped array, so that only
+        the current tile is read into memory.
+    method : str, optional, default "intensity"
+        Masking method; either "intensity" or "otsu".
+    gauss_sigma : float, optional, default 3.0
+        Sigma for Gaussian filter prior to masking.
+    tile_size : int, optional, default 1024
+        Size of the tiles in y and x.
+    warn_8bit : bool, optional, default True
+        Whether to emit a warning if the image is converted to 8bit.
+    keep_16bit : bool, optional, default False
+        If True, uint16 images are not down-converted. Only applies to the
+        "otsu" method, as the "intensity" method relies on the conversion
+        subtracting the minimum.
+    verbose : bool, optional, default False
+        If True, more information is printed.
+
+    Returns
+    -------
+    cen : tuple of floats
+        Center of mass (in voxels of `raw`), as returned by
+        `ndi.center_of_mass`.
+    """
+
+    # Prep
+    if method not in ("intensity", "otsu"):
+        raise ValueError(
+            "Invalid `method` for tiled mode; must be 'intensity' or 'otsu'."
+        )
+    keep_16bit = keep_16bit and method == "otsu"
+    tile_args = (raw, gauss_sigma, tile_size, warn_8bit, keep_16bit)
+
+    ### Method "intensity": sum intensity-weighted moments
+
+    if method == "intensity":
+        total, moments = 0.0, np.zeros(raw.ndim)
+        for _, inner, tile in iter_smoothed_tiles(*tile_args):
+            total += tile.sum(dtype=np.float64)
+            for axis, coords in enumerate(_tile_coords(inner, tile.shape)):
+                other_axes = tuple(a for a in range(tile.ndim) if a != axis)
+                profile = tile.sum(axis=other_axes, dtype=np.float64)
+                moments[axis] += profile @ coords
+        return tuple(moments / total)
+
+    ### Method "otsu", pass 1: sum histograms to get the threshold
+
+    hist = np.zeros(1, dtype=np.int64)
+    for _, _, tile in iter_smoothed_tiles(*tile_args):
+        tile_hist = np.bincount(tile.ravel())
+        if tile_hist.size > hist.size:
+            tile_hist[: hist.size] += hist
+            hist = tile_hist
+        else:
+            hist[: tile_hist.size] += tile_hist
+    img_min = int(np.flatnonzero(hist)[0])
+    hist = hist[img_min:]
+    threshold = threshold_otsu(
+        hist=(hist, np.arange(img_min, img_min + hist.size))
+    )
+    if verbose:
+        print("      Detected treshold:", threshold)
+
+    ### Method "otsu", pass 2: label tiles and merge objects across borders
+
+    # Per-object statistics (index 0 is the background) and union-find forest
+    sizes, moments = [np.zeros(1)], [np.zeros((1, raw.ndim))]
+    n_labels = 0
+    parents = [0]
+
+    # Labels along the right edge of the previous tile in the row, and along
+    # the bottom edge of each tile in the previous row
+    right_edge, bottom_edges = None, {}
+
+    # Label each tile
+    for (iy, ix), inner, tile in iter_smoothed_tiles(*tile_args):
+        labels, n_tile = ndi.label(tile >= threshold)
+
+        # Record object sizes and moments
+        tile_sizes, tile_moments = object_moments(
+            labels, n_tile, _tile_coords(inner, labels.shape)
+        )
+        sizes.append(tile_sizes)
+        moments.append(tile_moments)
+
+        # Give the objects globally unique labels
+        np.add(labels, n_labels, out=labels, where=labels > 0)
+        parents.extend(range(n_labels + 1, n_labels + n_tile + 1))
+        n_labels += n_tile
+
+        # Merge objects touching across the left and top borders
+        pairs = []
+        if ix > 0:
+            pairs.append((right_edge, labels[..., :, 0]))
+        if iy > 0:
+            pairs.append((bottom_edges[ix], labels[..., 0, :]))
+        for edge_a, edge_b in pairs:
+            touching = (edge_a > 0) & (edge_b > 0)
+            for a, b in set(zip(edge_a[touching], edge_b[touching])):
+                root_a, root_b = _find(parents, a), _find(parents, b)
+                if root_a != root_b:
+                    parents[max(root_a, root_b)] = min(root_a, root_b)
+
+        # Keep the edges needed for the next tiles
+        right_edge = labels[..., :, -1].copy()
+        bottom_edges[ix] = labels[..., -1, :].copy()
+
+    # Combine statistics of merged objects
+    if n_labels == 0:
+        raise Exception("No object found in mask! Image analysis run aborted.")
+    roots = np.array([_find(parents, label) for label in range(n_labels + 1)])
+    sizes = np.bincount(roots, weights=np.concatenate(sizes))
+    moments = np.concatenate(moments)
+    moments = np.stack(
+        [
+            np.bincount(roots, weights=moments[:, axis])
+            for axis in range(raw.ndim)
+        ],
+        axis=1,
+    )
+
+    # Get the centroid of the largest object
+    largest_obj = np.argmax(sizes[1:]) + 1
+    return tuple(moments[largest_obj] / sizes[largest_obj])
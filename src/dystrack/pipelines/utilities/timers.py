@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  High-resolution timers for the stages of processing a target file
+            (detection, waiting for the write to finish, decoding, analysis,
+            transmission). Timings are recorded per frame in a thread-local
+            record, so that code deep inside image analysis pipelines (such as
+            the image loader) can contribute its stages without having to pass
+            timers around.
+"""
+
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+import numpy as np
+
+# Stages reported at the end of a DySTrack session (in this order)
+STAGES = [
+    "detect",
+    "queue",
+    "wait_write",
+    "decode",
+    "analysis",
+    "transmit",
+    "total",
+]
+
+_local = threading.local()
+
+
+def start_frame():
+    """Start recording stage timings for a new frame in the current thread."""
+    _local.stages = {}
+
+
+def stop_frame():
+    """Stop recording stage timings in the current thread.
+
+    Returns
+    -------
+    stages : dict
+        Seconds spent in each stage since `start_frame` was called. Empty if
+        no frame was being recorded.
+    """
+    stages = getattr(_local, "stages", None)
+    _local.stages = None
+    return stages if stages is not None else {}
+
+
+def record_stage(stage, seconds):
+    """Add `seconds` to the time spent in `stage` for the current frame. Does
+    nothing if no frame is being recorded in the current thread."""
+    stages = getattr(_local, "stages", None)
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage_timer(stage):
+    """Context manager that records the time spent inside it as `stage`."""
+    time_start = perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, perf_counter() - time_start)
+
+
+def summarize_stages(frame_timings, stages=STAGES):
+    """Compute the median, 95th percentile and maximum of each stage.
+
+    Parameters
+    ----------
+    frame_timings : list of dict
+        Stage timings (in seconds) of each frame.
+    stages : list of str, optional, default STAGES
+        Stages to summarize. Stages not recorded for any frame are skipped.
+
+    Returns
+    -------
+    summary : dict
+        For each stage, a dict with the keys "p50", "p95" and "max" (seconds).
+    """
+    summary = {}
+    for stage in stages:
+        values = [ft[stage] for ft in frame_timings if stage in ft]
+        if values:
+            summary[stage] = {
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "max": float(np.max(values)),
+            }
+    return summary
@@ -178,17 +178,20 @@ def test_run_dystrack_manager():
         with open(stdout_fpath, "r") as infile:
             check_captured = infile.read()
 
-        # Drop total checks made from reference
-        # Note: The exact number here is unstable due to runtime variations!
+        # Drop total checks made and stage latencies from reference
+        # Note: The exact numbers here are unstable due to runtime variations!
+        unstable = ["Total checks made:", " ms (p50)"]
         check_captured = check_captured.split("\n")
         check_captured = [
-            cc for cc in check_captured if "Total checks made:" not in cc
+            cc for cc in check_captured if not any(u in cc for u in unstable)
         ]
         check_captured = "\n".join(check_captured)
 
-        # Drop total checks made from capture
+        # Drop total checks made and stage latencies from capture
         captured = captured.split("\n")
-        captured = [cc for cc in captured if "Total checks made:" not in cc]
+        captured = [
+            cc for cc in captured if not any(u in cc for u in unstable)
+        ]
         captured = "\n".join(captured)
 
         assert captured == check_captured
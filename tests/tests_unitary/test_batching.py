@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `batching.py`.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+from skimage.filters import threshold_otsu
+
+from dystrack.pipelines.utilities import batching
+from dystrack.pipelines.utilities.components import (
+    component_stats,
+    largest_component,
+)
+
+
+@pytest.mark.parametrize("shape", [(4, 40, 50), (3, 6, 40, 50)])
+def test_batch_analysis(shape):
+
+    # Smoothed random images
+    rng = np.random.default_rng(42)
+    stack = (rng.random(shape) * 255).astype(np.uint8)
+    stack = ndi.gaussian_filter(stack, [0] + [2] * (stack.ndim - 1))
+
+    # Intensity centroids
+    assert np.allclose(
+        batching.batch_centroids(stack),
+        [ndi.center_of_mass(img) for img in stack],
+    )
+
+    # Otsu thresholds
+    thresholds = batching.batch_otsu_thresholds(stack)
+    assert np.array_equal(thresholds, [threshold_otsu(img) for img in stack])
+
+    # Labels are not connected across the batch axis
+    mask = stack >= thresholds.reshape((-1,) + (1,) * (stack.ndim - 1))
+    labels, n_objects = batching.batch_label(mask)
+    assert n_objects == sum(ndi.label(m)[1] for m in mask)
+
+    # Centroids of the largest objects
+    centroids = batching.batch_largest_centroids(mask)
+    for m, cen in zip(mask, centroids):
+        stats = component_stats(m)[0]
+        assert np.allclose(cen, stats["centroid"][largest_component(stats)])
+
+
+def test_batch_edge_cases():
+
+    # Constant images
+    stack = np.zeros((2, 5, 5), dtype=np.uint8)
+    stack[1] = 7
+    assert np.array_equal(batching.batch_otsu_thresholds(stack), [0, 7])
+
+    # Masks without objects
+    mask = np.zeros((3, 5, 5), dtype=bool)
+    mask[0, 1, 1] = mask[2, 3, 3] = True
+    with pytest.raises(Exception, match="batch image 1"):
+        batching.batch_largest_centroids(mask)
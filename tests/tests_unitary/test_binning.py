@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `binning.py`.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+
+from dystrack.pipelines.utilities import binning
+
+
+def test_get_bin_factors():
+
+    # Scalar factors only apply to y and x
+    assert binning.get_bin_factors(2, 3) == (1, 2, 2)
+    assert binning.get_bin_factors(4, 2) == (4, 4)
+
+    # Per-axis factors
+    assert binning.get_bin_factors((2, 4, 4), 3) == (2, 4, 4)
+
+    # Invalid factors
+    with pytest.raises(ValueError, match="Invalid `downsample`"):
+        binning.get_bin_factors((2, 2), 3)
+    with pytest.raises(ValueError, match="Invalid `downsample`"):
+        binning.get_bin_factors(0, 2)
+
+
+def test_bin_image(mocker):
+
+    # Block means (rounded for integers), dropping incomplete blocks
+    rng = np.random.default_rng(42)
+    img = (rng.random((9, 50, 71)) * 255).astype(np.uint8)
+    expected = img[:8, :48, :69].reshape(4, 2, 16, 3, 23, 3)
+    expected = np.rint(expected.mean(axis=(1, 3, 5))).astype(np.uint8)
+    img_binned = binning.bin_image(img, (2, 3, 3))
+    assert img_binned.dtype == np.uint8
+    assert np.array_equal(img_binned, expected)
+
+    # Same result in small chunks
+    mocker.patch("dystrack.pipelines.utilities.binning.CHUNK_SIZE", 100)
+    assert np.array_equal(binning.bin_image(img, (2, 3, 3)), expected)
+
+    # No binning
+    assert binning.bin_image(img, (1, 1, 1)) is img
+
+
+def test_unbin_coords():
+    assert binning.unbin_coords((0.0, 0.0), (1, 1)) == (0.0, 0.0)
+    assert binning.unbin_coords((0.0, 2.0), (2, 4)) == (0.5, 9.5)
+
+
+def test_refine_centroid():
+
+    # Off-center blob
+    img = np.zeros((60, 80), dtype=np.uint8)
+    img[21:36, 30:47] = 200
+    threshold = 100
+    mask_full = ndi.gaussian_filter(img, 2.0) >= threshold
+
+    # Bounding box of the coarse mask from the binned image
+    factors = (4, 4)
+    img_binned = ndi.gaussian_filter(binning.bin_image(img, factors), 0.5)
+    bbox = ndi.find_objects((img_binned >= threshold).astype(np.uint8))[0]
+
+    # Refinement recovers the full-resolution centroid
+    cen = binning.refine_centroid(img, bbox, factors, threshold, 2.0)
+    assert np.allclose(cen, ndi.center_of_mass(mask_full))
+
+    # No object at full resolution
+    with pytest.raises(Exception, match="found no object"):
+        binning.refine_centroid(img, bbox, factors, 255, 2.0)
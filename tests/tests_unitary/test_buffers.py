@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `buffers.py`.
+"""
+
+import numpy as np
+
+from dystrack.pipelines.utilities import buffers
+
+
+def test_buffer_pool_take_give():
+
+    pool = buffers.BufferPool()
+
+    # New buffers are allocated if the pool is empty
+    buf_a = pool.take((4, 5), np.uint8)
+    buf_b = pool.take((4, 5), np.uint8)
+    assert buf_a.shape == (4, 5) and buf_a.dtype == np.uint8
+    assert buf_a is not buf_b
+    assert pool.nbytes == 0
+
+    # Buffers given back are reused for the same shape and dtype only
+    pool.give(buf_a)
+    assert pool.nbytes == 20
+    assert pool.take((4, 5), bool) is not buf_a
+    assert pool.take((5, 4), np.uint8) is not buf_a
+    assert pool.take((4, 5), np.uint8) is buf_a
+    assert pool.nbytes == 0
+
+    # Borrowed buffers are given back on exit
+    with pool.borrow(((4, 5), np.uint8), ((4, 5), np.int32)) as (a, b):
+        assert b.dtype == np.int32
+    assert pool.take((4, 5), np.int32) is b
+    assert pool.take((4, 5), np.uint8) is a
+
+    # Clearing
+    pool.give(a, b)
+    pool.clear()
+    assert pool.nbytes == 0
+    assert pool.take((4, 5), np.uint8) is not a
+
+
+def test_buffer_pool_max_bytes():
+
+    # The least recently used shapes are dropped beyond the limit
+    pool = buffers.BufferPool(max_bytes=250)
+    buf_a = pool.take((100,), np.uint8)
+    buf_b = pool.take((100,), np.uint8)
+    buf_c = pool.take((120,), np.uint8)
+    pool.give(buf_a, buf_b)
+    assert pool.nbytes == 200
+    pool.give(buf_c)
+    assert pool.nbytes == 120
+    assert pool.take((120,), np.uint8) is buf_c
+    buf = pool.take((100,), np.uint8)
+    assert buf is not buf_a and buf is not buf_b
+
+
+def test_buffer_lease():
+
+    # Taken buffers are given back together
+    pool = buffers.BufferPool()
+    lease = buffers.BufferLease(pool)
+    buf_a = lease.take((3, 3), np.uint8)
+    buf_b = lease.take((3, 3), np.uint8)
+    assert buf_a is not buf_b
+    lease.release()
+    assert pool.nbytes == 18
+    lease.release()
+    assert pool.nbytes == 18
+
+    # Without a pool, nothing is taken
+    lease = buffers.BufferLease(None)
+    assert lease.take((3, 3), np.uint8) is None
+    lease.release()
+
+
+def test_get_buffer_pool():
+    pool = buffers.get_buffer_pool()
+    assert isinstance(pool, buffers.BufferPool)
+    assert buffers.get_buffer_pool() is pool
+
+
+def test_clear_buffer_pool():
+    pool = buffers.get_buffer_pool()
+    pool.give(np.zeros(10, dtype=np.uint8))
+    assert pool.nbytes == 10
+    buffers.clear_buffer_pool()
+    assert pool.nbytes == 0
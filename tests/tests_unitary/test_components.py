@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `components.py`.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+
+from dystrack.pipelines.utilities import components
+
+
+def test_object_moments():
+
+    # Sizes and coordinate sums match ndi's measurements
+    rng = np.random.default_rng(42)
+    labels, n_objects = ndi.label(rng.random((6, 30, 40)) > 0.7)
+    sizes, moments = components.object_moments(labels, n_objects)
+    index = np.arange(1, n_objects + 1)
+    assert np.array_equal(sizes, ndi.sum(labels > 0, labels, index))
+    assert np.allclose(
+        moments / sizes[:, None],
+        ndi.center_of_mass(labels > 0, labels, index),
+    )
+
+    # Shifted coordinates
+    coords = [np.arange(s, dtype=float) + 10 for s in labels.shape]
+    shifted = components.object_moments(labels, n_objects, coords)[1]
+    assert np.allclose(shifted, moments + 10 * sizes[:, None])
+
+
+def test_component_stats():
+
+    # Two objects in 3D (labeled in raster order)
+    mask = np.zeros((4, 30, 40), dtype=bool)
+    mask[1:3, 5:12, 20:31] = True
+    mask[0:4, 20:22, 2:5] = True
+    stats, labels = components.component_stats(mask)
+    assert np.array_equal(stats["size"], [4 * 2 * 3, 2 * 7 * 11])
+    assert np.allclose(stats["centroid"], [[1.5, 20.5, 3], [1.5, 8, 25]])
+    assert stats["bbox"][1] == (slice(1, 3), slice(5, 12), slice(20, 31))
+    assert np.array_equal(stats["extent"], [[4, 2, 3], [2, 7, 11]])
+    assert labels.max() == 2
+
+    # Largest object
+    assert components.largest_component(stats) == 1
+
+    # Empty mask
+    stats, _ = components.component_stats(np.zeros((30, 40), dtype=bool))
+    assert stats["size"].size == 0
+    assert stats["extent"].shape == (0, 2)
+    with pytest.raises(Exception, match="No object found"):
+        components.largest_component(stats)
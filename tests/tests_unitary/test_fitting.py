@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `fitting.py`.
+"""
+
+import numpy as np
+import pytest
+
+from dystrack.pipelines.utilities import fitting
+
+
+def test_image_profiles():
+
+    # Profiles match those from separate reductions
+    rng = np.random.default_rng(42)
+    img = (rng.random((7, 40, 50)) * 255).astype(np.uint8)
+    z_prof, y_prof, yx_sum = fitting.image_profiles(img)
+    norm = fitting.normalize_profile
+    assert np.allclose(z_prof, norm(np.mean(img, axis=(1, 2))))
+    assert np.allclose(y_prof, norm(np.mean(img, axis=(0, 2))))
+    assert np.allclose(
+        fitting.x_profile(yx_sum, 10, 20),
+        norm(np.mean(img[:, 10:20, :], axis=(0, 1))),
+    )
+
+    # 2D
+    z_prof, y_prof, yx_sum = fitting.image_profiles(img[0])
+    assert z_prof is None
+    assert np.allclose(y_prof, norm(np.mean(img[0], axis=1)))
+
+
+def test_estimate_gaussian():
+    locs = np.arange(200)
+    prof = fitting.f_gaussian(locs, 30.0, 80.0, 12.0)
+    assert np.allclose(
+        fitting.estimate_gaussian(prof), [30, 80, 12], rtol=1e-3
+    )
+
+
+def test_estimate_sigmoid():
+    locs = np.arange(200)
+    prof = fitting.f_sigmoid(locs, 0.8, 0.2, 120.0)
+    L, k, x0 = fitting.estimate_sigmoid(prof)
+    assert np.isclose(L, 0.8, atol=0.05)
+    assert np.isclose(x0, 120.0, atol=1.0)
+
+
+def test_fit_profile(mocker):
+
+    # Noisy Gaussian profile, fitted from the closed-form estimate
+    rng = np.random.default_rng(42)
+    locs = np.arange(200)
+    prof = fitting.f_gaussian(locs, 30.0, 80.0, 12.0)
+    prof += rng.normal(0, 0.02, prof.size)
+    p0 = fitting.estimate_gaussian(fitting.normalize_profile(prof))
+    p_fit = fitting.fit_profile("gaussian", prof, p0)
+    assert np.allclose(p_fit[1:], [80.0, 12.0], atol=0.5)
+
+    # Without refinement, the starting parameters are returned (clipped)
+    p_fit = fitting.fit_profile(
+        "sigmoid", prof, [1.0, 0.5, 10.0], ([0, 0, 20], [2, 1, 180]), False
+    )
+    assert np.allclose(p_fit, [1.0, 0.5, 20.0])
+
+    # Non-converging fits raise
+    with pytest.raises(RuntimeError):
+        fitting.fit_profile("gaussian", prof, p0, maxfev=2)
+
+    # ...unless they can be retried from fallback parameters
+    curve_fit = fitting.curve_fit
+
+    def curve_fit_fail_first(*args, **kwargs):
+        if curve_fit_mock.call_count == 1:
+            raise RuntimeError("Optimal parameters not found")
+        return curve_fit(*args, **kwargs)
+
+    curve_fit_mock = mocker.patch.object(
+        fitting, "curve_fit", side_effect=curve_fit_fail_first
+    )
+    with pytest.warns(UserWarning, match="did not converge"):
+        p_fit = fitting.fit_profile(
+            "gaussian", prof, [1.0, 20.0, 3.0], fallback_p0=p0
+        )
+    assert curve_fit_mock.call_count == 2
+    assert np.allclose(curve_fit_mock.call_args.kwargs["p0"], p0)
+    assert np.allclose(p_fit[1:], [80.0, 12.0], atol=0.5)
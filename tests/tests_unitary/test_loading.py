@@ -8,12 +8,34 @@ Created on Thu Aug 15 00:31:36 2025
 """
 
 import os
-from time import sleep
+from time import sleep, time
+from types import SimpleNamespace
 
 import numpy as np
 import pytest
+import tifffile
 
 from dystrack.pipelines.utilities import loading
+from dystrack.pipelines.utilities import timers as tmr
+
+
+class MockBioImage:
+    """Minimal stand-in for `BioImage` that holds a given array."""
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.dims = SimpleNamespace(order="TCZYX"[5 - data.ndim :])
+        self.reader = None
+
+
+@pytest.fixture(autouse=True)
+def reset_reader_cache():
+    """Ensure that readers cached (or mocked) by one test do not leak into
+    other tests."""
+    loading.clear_reader_cache()
+    yield
+    loading.clear_reader_cache()
 
 
 def test_robust_load_success(mocker):
@@ -48,45 +70,294 @@ def test_robust_load_success(mocker):
         assert raw.dtype == fdt
 
 
+def test_robust_load_memmap():
+    """Test memory-mapped loading against regular loading."""
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fnames = [
+        "test-pllp_980_prescan.tif",  # ImageJ .tif
+        "test-pllp_980_prescan.czi",  # ZEISS LSM980 .czi (not mappable)
+        "test-pllp_AXR_prescan.tiff",  # Nikon AX R .tiff
+        "test-pllp_AXR_prescan.nd2",  # Nikon AX R .nd2
+        "test-cnode_early_prescan2D.tiff",  # Big-endian .tiff (not mappable)
+    ]
+    mappable = [True, False, True, True, False]
+
+    # Run tests
+    for fn, fm in zip(fnames, mappable):
+        fpath = os.path.join(testpath, fn)
+        raw = loading.robustly_load_image_after_write(fpath, await_write=0.1)
+        raw_mm = loading.robustly_load_image_after_write(
+            fpath, await_write=0.1, memmap=True
+        )
+        assert raw_mm.shape == raw.shape
+        assert raw_mm.dtype == raw.dtype
+        assert np.array_equal(raw_mm, raw)
+        assert (loading.memmap_image(fpath) is not None) == fm
+        if fm:
+            assert not raw_mm.flags.writeable
+            base = raw_mm
+            while not isinstance(base, np.memmap):
+                base = base.base
+            assert base.filename is not None
+        del raw_mm
+
+
+def test_robust_load_selection():
+    """Test loading of selected channels and z-planes."""
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fnames = [
+        "test-pllp_980_prescan.tif",  # ImageJ .tif
+        "test-pllp_980_prescan.czi",  # ZEISS LSM980 .czi
+        "test-pllp_AXR_prescan.nd2",  # Nikon AX R .nd2
+        "test-pllp_980_prescan2D.tif",  # ImageJ .tif (2D)
+    ]
+
+    # Run tests
+    for fn in fnames:
+        fpath = os.path.join(testpath, fn)
+        raw = loading.robustly_load_image_after_write(fpath, await_write=0.1)
+        for memmap in [False, True]:
+
+            # Channel selection
+            raw_sel = loading.robustly_load_image_after_write(
+                fpath, await_write=0.1, memmap=memmap, channel=0
+            )
+            assert np.array_equal(raw_sel, raw)
+
+            # Z-plane selection (ignored for 2D images)
+            raw_sel = loading.robustly_load_image_after_write(
+                fpath,
+                await_write=0.1,
+                memmap=memmap,
+                z_range=(0, 9),
+                z_stride=4,
+            )
+            if raw.ndim == 3:
+                assert np.array_equal(raw_sel, raw[0:9:4])
+            else:
+                assert np.array_equal(raw_sel, raw)
+
+
+def test_robust_load_selection_errors(mocker, capsys):
+    """Test that invalid selections raise the correct errors right away."""
+
+    # Target
+    fpath = r"./tests/testdata/test-pllp_980_prescan.tif"
+    mock_wait = mocker.patch(
+        "dystrack.pipelines.utilities.loading.wait_for_write_completion"
+    )
+
+    # Invalid channel
+    with pytest.raises(IOError) as err:
+        loading.robustly_load_image_after_write(
+            fpath, await_write=0.1, channel=1
+        )
+    assert "CHANNEL 1 given but image has only 1 channel(s)!" in str(err)
+
+    # Invalid z-range
+    with pytest.raises(IOError) as err:
+        loading.robustly_load_image_after_write(
+            fpath, await_write=0.1, z_range=(30, 40)
+        )
+    assert "image has only 21 z-plane(s)!" in str(err)
+
+    # No retries were made
+    assert mock_wait.call_count == 2
+    assert "Multiple attempts to load" not in capsys.readouterr().out
+
+
+def test_robust_load_selection_warnings(tmp_path):
+    """Test that selecting a channel from an image with many channels warns."""
+
+    # Target with 6 channels
+    fpath = str(tmp_path / "test_6channels.tif")
+    raw = np.arange(600, dtype=np.uint8).reshape((6, 10, 10))
+    tifffile.imwrite(fpath, raw, imagej=True, metadata={"axes": "CYX"})
+
+    # Run test
+    with pytest.warns(UserWarning) as record:
+        raw_sel = loading.robustly_load_image_after_write(
+            fpath, await_write=0.1, channel=2
+        )
+    assert "CHANNEL given but image dim C is of size 6!" in str(
+        record[0].message
+    )
+    assert np.array_equal(raw_sel, raw[2])
+
+
+def test_drop_singleton_dims():
+    """Test that only singleton dimensions other than Y and X are dropped."""
+    raw, dims = loading._drop_singleton_dims(
+        np.zeros((1, 2, 1, 1, 5)), "TCZYX"
+    )
+    assert raw.shape == (2, 1, 5)
+    assert dims == "CYX"
+
+
+def test_open_bioimage(mocker):
+    """Test that the reader resolved for the first file is reused."""
+
+    # Target
+    fpath = r"./tests/testdata/test-pllp_980_prescan.czi"
+
+    # First call resolves the reader, subsequent calls reuse it
+    spy = mocker.spy(loading, "BioImage")
+    img_first = loading.open_bioimage(fpath)
+    img_second = loading.open_bioimage(fpath)
+    assert spy.call_args_list[0].kwargs == {}
+    assert spy.call_args_list[1].kwargs == {"reader": type(img_first.reader)}
+    assert np.array_equal(img_first.data, img_second.data)
+
+
+def test_prefetch_image(mocker):
+    """Test that prefetched images are used by the loader."""
+
+    # Target
+    fpath = r"./tests/testdata/test-pllp_980_prescan.tif"
+    spy = mocker.spy(loading, "_load_image_after_write")
+
+    # Prefetched image is used by a call with the same settings
+    loading.prefetch_image(fpath, await_write=0.1, show=False)
+    raw = loading.robustly_load_image_after_write(fpath, await_write=0.1)
+    assert raw.shape == (21, 200, 500)
+    assert spy.call_count == 1
+
+    # Calls with other settings load the image themselves
+    loading.prefetch_image(fpath, await_write=0.1)
+    raw = loading.robustly_load_image_after_write(fpath, await_write=0.2)
+    assert raw.shape == (21, 200, 500)
+    assert spy.call_count == 3
+
+    # Memory-mapped images are prefetched, too
+    loading.prefetch_image(fpath, await_write=0.1, memmap=True)
+    raw_mm = loading.robustly_load_image_after_write(
+        fpath, await_write=0.1, memmap=True
+    )
+    assert np.array_equal(raw_mm, raw)
+    assert spy.call_count == 4
+    del raw_mm
+
+    # Waiting for a prefetched image is recorded as decoding
+    loading.prefetch_image(fpath, await_write=0.1)
+    tmr.start_frame()
+    loading.robustly_load_image_after_write(fpath, await_write=0.1)
+    stages = tmr.stop_frame()
+    assert "decode" in stages and "wait_write" not in stages
+
+    # Unused prefetches are discarded
+    for await_write in range(loading.MAX_PREFETCHED + 3):
+        loading.prefetch_image(fpath, await_write=0.1 + await_write)
+    assert len(loading._prefetched) == loading.MAX_PREFETCHED
+    loading.discard_prefetch(fpath)
+    assert len(loading._prefetched) == 0
+
+    # Prefetching can be stopped (and restarted)
+    loading.prefetch_image(fpath, await_write=0.1)
+    loading.stop_prefetching()
+    assert len(loading._prefetched) == 0
+    assert loading._prefetch_executor is None
+    loading.prefetch_image(fpath, await_write=0.1)
+    assert len(loading._prefetched) == 1
+    loading.stop_prefetching()
+
+
 def test_robust_load_slowrite(mocker):
-    """Test if loading waits while file size changes, then proceeds when it has
-    stopped changing."""
+    """Test if loading waits while file size changes, then proceeds as soon
+    as it has stopped changing and the file is complete."""
 
     # Target
     testpath = r"./tests/testdata/"
     fname = "test-pllp_980_prescan.tif"
 
     # Patch os.stat to change (apparent) file sizes...
-    fake_size_generator = (i for i in [1000, 1001, 1002, 1003, 1003, 42])
+    fake_size_generator = (i for i in [1000, 1001, 1002, 1003])
     real_stat = os.stat
 
     def mock_stat(*args, **kwargs):
+        stats = real_stat(*args, **kwargs)
         if args[0] == os.path.join(testpath, fname):
-            stats = real_stat(*args, **kwargs)
             st_size_idx = [
                 prop
                 for prop in os.stat(".").__dir__()
                 if prop.startswith("st_")
             ].index("st_size")
             stats = list(stats)
-            stats[st_size_idx] = next(fake_size_generator)
+            stats[st_size_idx] = next(fake_size_generator, stats[st_size_idx])
             return os.stat_result(stats)
         else:
-            return real_stat(*args, **kwargs)
+            return stats
 
     mock_stat = mocker.patch(
         "dystrack.pipelines.utilities.loading.os.stat", wraps=mock_stat
     )
 
     # Run the test
+    time_start = time()
     raw = loading.robustly_load_image_after_write(
-        os.path.join(testpath, fname), await_write=0.1
+        os.path.join(testpath, fname), await_write=5
     )
     assert raw.shape == (21, 200, 500)
     assert raw.dtype == np.uint8
 
-    # Check that file size was checked the correct number of times
-    assert next(fake_size_generator) == 42
+    # Check that all file sizes were seen, but the loader did not wait for
+    # `await_write` once the file was complete
+    assert next(fake_size_generator, 42) == 42
+    assert time() - time_start < 2
+
+
+def test_structural_completeness(tmp_path):
+    """Test that truncated files are detected as incomplete."""
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fnames = [
+        "test-pllp_980_prescan.tif",  # ImageJ .tif
+        "test-pllp_980_prescan.czi",  # ZEISS LSM980 .czi
+        "test-pllp_880_prescan.czi",  # ZEISS LSM880 .czi
+        "test-pllp_AXR_prescan.tiff",  # Nikon AX R .tiff
+        "test-pllp_AXR_prescan.nd2",  # Nikon AX R .nd2
+    ]
+
+    # Run tests
+    for fn in fnames:
+        fpath = os.path.join(testpath, fn)
+        assert loading.check_structural_completeness(fpath)
+        with open(fpath, "rb") as infile:
+            content = infile.read()
+        for frac in [0.0, 0.1, 0.5, 0.99]:
+            tpath = tmp_path / fn
+            with open(tpath, "wb") as outfile:
+                outfile.write(content[: int(len(content) * frac)])
+            assert loading.check_structural_completeness(tpath) is False
+
+    # Unknown file types cannot be checked
+    assert loading.check_structural_completeness("test.unknown") is None
+
+
+def test_wait_for_write_completion(mocker):
+    """Test that waiting falls back to size stability if completeness cannot
+    be determined."""
+
+    # Target
+    fpath = r"./tests/testdata/test-pllp_980_prescan.tif"
+
+    # Complete file returns quickly
+    time_start = time()
+    loading.wait_for_write_completion(fpath, await_write=5)
+    assert time() - time_start < 1
+
+    # Undetermined completeness waits for `await_write`
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.check_structural_completeness",
+        return_value=None,
+    )
+    time_start = time()
+    loading.wait_for_write_completion(fpath, await_write=0.5)
+    assert time() - time_start >= 0.5
 
 
 def test_robust_load_errors_filext(mocker, capsys):
@@ -117,7 +388,7 @@ def test_robust_load_errors_filext(mocker, capsys):
 
     # Test unsupported file ending
     with pytest.raises(ValueError) as err:
-        raw = loading.robustly_load_image_after_write(
+        loading.robustly_load_image_after_write(
             os.path.join(testpath, fname),
             await_write=0.1,  # Short for tests perf
         )
@@ -129,8 +400,8 @@ def test_robust_load_errors_filext(mocker, capsys):
     captured = capsys.readouterr()
     assert "Multiple attempts to load" in captured.out
 
-    # Check number of cycles
-    assert len(mock_stat.call_args_list) == 6
+    # Check number of cycles (at least one size check per attempt)
+    assert len(mock_stat.call_args_list) >= 5
 
 
 def test_robust_load_errors_loadnonnumeric(capsys, mocker):
@@ -144,12 +415,12 @@ def test_robust_load_errors_loadnonnumeric(capsys, mocker):
     # Patch Bioimage to return string array
     mock_bioimage = mocker.patch(
         "dystrack.pipelines.utilities.loading.BioImage",
-        wraps=lambda fp: np.array(["a", "b", "c"]),
+        wraps=lambda fp, **kwargs: MockBioImage(np.array(["a", "b", "c"])),
     )
 
     # Test string array case
     with pytest.raises(IOError) as err:
-        raw = loading.robustly_load_image_after_write(
+        loading.robustly_load_image_after_write(
             os.path.join(testpath, fname),
             await_write=0.1,  # Short for tests perf
         )
@@ -176,12 +447,12 @@ def test_robust_load_errors_loadempty(capsys, mocker):
     # Patch Bioimage to return empty array
     mock_bioimage = mocker.patch(
         "dystrack.pipelines.utilities.loading.BioImage",
-        wraps=lambda fp: np.zeros((0,)),
+        wraps=lambda fp, **kwargs: MockBioImage(np.zeros((0,))),
     )
 
     # Test empty array case
     with pytest.raises(IOError) as err:
-        raw = loading.robustly_load_image_after_write(
+        loading.robustly_load_image_after_write(
             os.path.join(testpath, fname),
             await_write=0.1,  # Short for tests perf
         )
@@ -210,7 +481,7 @@ def test_robust_load_errors_bioimagearbitrary(capsys, mocker):
     )
 
     # Patch Bioimage to raise some arbitrary error
-    def arbitary_error(fp):
+    def arbitary_error(fp, **kwargs):
         raise Exception("Some arbitrary error.")
 
     mock_bioimage = mocker.patch(
@@ -219,9 +490,7 @@ def test_robust_load_errors_bioimagearbitrary(capsys, mocker):
 
     # Test arbitrary error case
     with pytest.raises(Exception) as err:
-        raw = loading.robustly_load_image_after_write(
-            os.path.join(testpath, fname)
-        )
+        loading.robustly_load_image_after_write(os.path.join(testpath, fname))
 
     # Check error message
     assert "Some arbitrary error." == str(err.value)
@@ -7,6 +7,12 @@ Created on Mon Jun 09 11:38:17 2025
 @descript:  Unit tests against `manager.py`.
 """
 
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import pytest
 
 import dystrack.manager.manager as mng
@@ -163,6 +169,368 @@ def test_trigger_coords_transmission(mocker, capsys):
     assert "invalid `transmission_method`" in str(err)
 
 
+def test_finalize_target(mocker, capsys):
+
+    # Prep
+    mocker.patch("dystrack.manager.transmitters.send_coords_txt")
+    session = {
+        "coordinates": [],
+        "img_cache": {},
+        "positions": {},
+        "img_success_counter": 0,
+        "tra_success_counter": 0,
+    }
+
+    # Test successful image analysis
+    mng._finalize_target((1, 2, 3, "OK", {"a": 1}), None, session, ".")
+    assert session["coordinates"] == [[1, 2, 3]]
+    assert session["positions"][None]["img_cache"] == {"a": 1}
+    assert session["img_cache"] == {}
+    assert session["img_success_counter"] == 1
+    assert session["tra_success_counter"] == 1
+    assert "Coords pushed." in capsys.readouterr().out
+
+    # Test fallback to previous coordinates
+    img_err = Exception("test error")
+    img_out = (None, None, None, "Image analysis failed!", {"a": 1})
+    mng._finalize_target(img_out, img_err, session, ".")
+    assert session["coordinates"] == [[1, 2, 3], [1, 2, 3]]
+    assert session["img_success_counter"] == 1
+    assert session["tra_success_counter"] == 2
+    assert "reusing previous position" in capsys.readouterr().out
+
+    # Test that fallbacks use the history of the same position
+    mng._finalize_target(
+        (4, 5, 6, "OK", {}), None, session, ".", position="pos2"
+    )
+    mng._finalize_target(img_out, img_err, session, ".", position="pos2")
+    assert session["positions"]["pos2"]["coordinates"] == [[4, 5, 6]] * 2
+    assert session["coordinates"][-1] == [4, 5, 6]
+    with pytest.raises(Exception) as err:
+        mng._finalize_target(img_out, img_err, session, ".", position="pos3")
+    assert "test error" in str(err)
+
+    # Test hard failure without fallback
+    with pytest.raises(Exception) as err:
+        mng._finalize_target(
+            img_out, img_err, session, ".", img_err_fallback=False
+        )
+    assert "test error" in str(err)
+
+
+def test_finalize_target_deadline_missed(mocker, capsys):
+
+    # Prep
+    mocker.patch("dystrack.manager.transmitters.send_coords_txt")
+    session = {
+        "coordinates": [],
+        "img_cache": {},
+        "positions": {},
+        "img_success_counter": 0,
+        "tra_success_counter": 0,
+        "deadline_missed_counter": 0,
+    }
+    mng._finalize_target((1, 2, 3, "OK", {"a": 1}), None, session, ".")
+
+    # Previous coordinates are sent, and the cache is kept
+    img_out = (None, None, None, "WARN:DEADLINE-MISSED", {"a": 0})
+    img_err = TimeoutError("test timeout")
+    mng._finalize_target(
+        img_out,
+        img_err,
+        session,
+        ".",
+        img_err_fallback=False,
+        deadline_missed=True,
+    )
+    assert session["coordinates"] == [[1, 2, 3], [1, 2, 3]]
+    assert session["positions"][None]["img_cache"] == {"a": 1}
+    assert session["img_success_counter"] == 1
+    assert session["tra_success_counter"] == 2
+    assert session["deadline_missed_counter"] == 1
+    assert "missed its deadline" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("late_result", ["log", "prior"])
+def test_analyze_with_deadline(late_result):
+
+    # Mock image analysis that runs until it is released
+    def img_ana_func(target_path, n_calls=0):
+        calls.append(target_path)
+        release.wait(timeout=5)
+        return 1, 2, 3, "OK", {"n_calls": n_calls + 1}
+
+    # Prep
+    calls, release = [], threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    session = {"img_cache": {"n_calls": 0}, "positions": {}}
+    commit_cond = threading.Condition()
+    job = {"target_path": "0", "position": None, "time_detected": 0.0}
+    analysis_args = ("0", img_ana_func, {}, {"n_calls": 0})
+    kwargs = dict(deadline=0.0, late_result=late_result, executor=executor)
+
+    # A deadline requires an executor
+    with pytest.raises(ValueError, match="executor"):
+        mng._analyze_with_deadline(
+            job, analysis_args, session, commit_cond, deadline=0.0
+        )
+
+    # Without previous coordinates, the result is awaited despite a deadline
+    release.set()
+    out = mng._analyze_with_deadline(
+        job, analysis_args, session, commit_cond, **kwargs
+    )
+    assert out[0] == (1, 2, 3, "OK", {"n_calls": 1})
+    assert out[1] is None and out[3] is False
+
+    # With previous coordinates, the deadline is enforced
+    release.clear()
+    session["positions"][None]["coordinates"].append([0, 0, 0])
+    out = mng._analyze_with_deadline(
+        job, analysis_args, session, commit_cond, **kwargs
+    )
+    assert out[0][3] == "WARN:DEADLINE-MISSED"
+    assert isinstance(out[1], TimeoutError)
+    assert out[3] is True
+    assert list(session["late_jobs"].values()) == [job]
+
+    # While the late analysis is running, the position is not analyzed again
+    out = mng._analyze_with_deadline(
+        job, analysis_args, session, commit_cond, **kwargs
+    )
+    assert out[3] is True
+    assert "still running" in str(out[1])
+
+    # The late result is recorded (and used as prior) once it arrives
+    # Note: The executor's single thread runs the callback of the late result
+    #       before it picks up the next call
+    release.set()
+    executor.submit(int).result(timeout=5)
+    assert len(calls) == 2
+    assert len(session["late_results"]) == 1
+    assert session["late_results"][0]["coords"] == [1, 2, 3]
+    assert session["late_jobs"] == {}
+    img_cache = session["positions"][None]["img_cache"]
+    if late_result == "prior":
+        assert img_cache == {"n_calls": 1}
+    else:
+        assert img_cache == {"n_calls": 0}
+
+    # Without a deadline, the analysis just runs
+    out = mng._analyze_with_deadline(job, analysis_args, session, commit_cond)
+    assert out[0][:4] == (1, 2, 3, "OK") and out[3] is False
+    executor.shutdown()
+
+
+def test_record_late_result_error(capsys):
+
+    # Late analysis whose call failed outside of the analysis function (e.g.
+    # because the process pool broke)
+    future = Future()
+    future.set_exception(RuntimeError("Broken pool"))
+    job = {"target_path": "prescan_1.czi", "position": "A"}
+    job["time_detected"] = time.perf_counter()
+    session = {"img_cache": {}, "positions": {}, "late_jobs": {future: job}}
+    commit_cond = threading.Condition()
+
+    # The error is recorded, and the position is analyzed again afterwards
+    mng._record_late_result(future, job, session, commit_cond, "prior")
+    assert session["late_jobs"] == {}
+    assert len(session["late_results"]) == 1
+    assert session["late_results"][0]["coords"] == [None, None, None]
+    assert "Broken pool" in str(session["late_results"][0]["img_error"])
+    assert "Late image analysis of prescan_1.czi failed." in (
+        capsys.readouterr().out
+    )
+
+    # Jobs that have already been handled are ignored
+    mng._record_late_result(future, job, session, commit_cond, "prior")
+    assert len(session["late_results"]) == 1
+
+
+def test_analysis_worker_order(mocker):
+
+    # Mock image analysis where the first target takes longest to analyze
+    def img_ana_func(target_path, n_calls=0):
+        time.sleep(0.3 - 0.1 * int(target_path))
+        return int(target_path), 0, 0, "OK", {"n_calls": n_calls + 1}
+
+    # Record finalized coordinates in order
+    mocker.patch("dystrack.manager.transmitters.send_coords_txt")
+    finalized = []
+
+    def tra_mock(z_pos, *args):
+        finalized.append(z_pos)
+
+    # Prep worker threads
+    job_queue, done_queue = queue.Queue(), queue.Queue()
+    commit_cond = threading.Condition()
+    session = {
+        "coordinates": [],
+        "img_cache": {},
+        "positions": {},
+        "img_success_counter": 0,
+        "tra_success_counter": 0,
+        "next_seq": 0,
+        "error": None,
+        "stage_timings": [],
+    }
+    finalize_kwargs = {"target_dir": ".", "tra_method": tra_mock}
+    workers = [
+        threading.Thread(
+            target=mng._analysis_worker,
+            args=(
+                job_queue,
+                done_queue,
+                commit_cond,
+                session,
+                img_ana_func,
+                {},
+                finalize_kwargs,
+            ),
+        )
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Run jobs
+    def make_job(seq, target_path, position, prev_seq):
+        return {
+            "seq": seq,
+            "target_path": target_path,
+            "position": position,
+            "prev_seq": prev_seq,
+            "time_detected": time.perf_counter(),
+            "stage_times": {"detect": 0.0},
+        }
+
+    for seq, target_path in enumerate(["0", "1", "2"]):
+        job_queue.put(make_job(seq, target_path, None, None))
+    for worker in workers:
+        job_queue.put(None)
+    time_start = time.time()
+    for worker in workers:
+        worker.join(timeout=5)
+
+    # Analyses overlapped, but results were finalized in order of detection
+    assert time.time() - time_start < 0.55
+    assert finalized == [0, 1, 2]
+    assert session["coordinates"] == [[0, 0, 0], [1, 0, 0], [2, 0, 0]]
+    assert session["tra_success_counter"] == 3
+    assert session["error"] is None
+    assert done_queue.qsize() == 3
+
+    # Stage timings were recorded for each job
+    assert len(session["stage_timings"]) == 3
+    for stage_times in session["stage_timings"]:
+        for stage in ["detect", "queue", "analysis", "transmit", "total"]:
+            assert stage in stage_times
+        assert stage_times["analysis"] >= 0.1
+        assert stage_times["total"] >= stage_times["analysis"]
+
+    # With positions, jobs of the same position start from the previous cache
+    job_queue, done_queue = queue.Queue(), queue.Queue()
+    finalized.clear()
+    session.update(coordinates=[], positions={}, next_seq=0)
+    workers = [
+        threading.Thread(
+            target=mng._analysis_worker,
+            args=(
+                job_queue,
+                done_queue,
+                commit_cond,
+                session,
+                img_ana_func,
+                {},
+                finalize_kwargs,
+            ),
+        )
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    jobs = [(0, "2", "A", None), (1, "2", "B", None), (2, "2", "A", 0)]
+    for job in jobs:
+        job_queue.put(make_job(*job))
+    for worker in workers:
+        job_queue.put(None)
+    for worker in workers:
+        worker.join(timeout=5)
+    assert session["positions"]["A"]["img_cache"] == {"n_calls": 2}
+    assert session["positions"]["B"]["img_cache"] == {"n_calls": 1}
+
+
+def test_analysis_worker_executor_error(mocker, capsys):
+
+    # Mock executor that fails to run the analysis (e.g. a broken pool)
+    class BrokenExecutor:
+        def submit(self, *args):
+            raise RuntimeError("Broken pool")
+
+    # Prep
+    mocker.patch("dystrack.manager.transmitters.send_coords_txt")
+    job_queue, done_queue = queue.Queue(), queue.Queue()
+    commit_cond = threading.Condition()
+    session = {
+        "coordinates": [],
+        "img_cache": {},
+        "positions": {None: {"img_cache": {}, "coordinates": [[1, 2, 3]]}},
+        "img_success_counter": 0,
+        "tra_success_counter": 0,
+        "next_seq": 0,
+        "error": None,
+        "stage_timings": [],
+    }
+    finalize_kwargs = {"target_dir": ".", "tra_method": lambda *args: None}
+    for seq in range(2):
+        job_queue.put(
+            {
+                "seq": seq,
+                "target_path": f"prescan_{seq}.czi",
+                "position": None,
+                "prev_seq": None,
+                "time_detected": time.perf_counter(),
+                "stage_times": {},
+            }
+        )
+    job_queue.put(None)
+
+    # The error is handled like an image analysis error and all jobs finish
+    worker = threading.Thread(
+        target=mng._analysis_worker,
+        args=(
+            job_queue,
+            done_queue,
+            commit_cond,
+            session,
+            None,
+            {},
+            finalize_kwargs,
+            BrokenExecutor(),
+        ),
+    )
+    worker.start()
+    worker.join(timeout=5)
+    assert not worker.is_alive()
+    assert session["next_seq"] == 2
+    assert session["error"] is None
+    assert session["coordinates"] == [[1, 2, 3], [1, 2, 3]]
+    assert done_queue.qsize() == 2
+    out = capsys.readouterr().out
+    assert "Running image analysis of prescan_1.czi..." in out
+    assert "Broken pool" in out
+
+
+def test_get_position():
+    fname = "prescan_3_pos_7.czi"
+    assert mng._get_position(fname, "") is None
+    assert mng._get_position(fname, r"pos_(\d+)") == "7"
+    assert mng._get_position(fname, r"(\d+)_pos_(?P<pos>\d+)") == "7"
+    assert mng._get_position(fname, r"pos_\d+") == "pos_7"
+    assert mng._get_position(fname, r"tile_(\d+)") is None
+
+
 def NOtest_run_dystrack_manager_success():
     """NOtest: Test not implemented; covered by integration test."""
 
@@ -174,6 +542,250 @@ def NOtest_run_dystrack_manager_success():
     pass
 
 
+# Helpers for running `run_dystrack_manager` on files written by the tests
+class ListWatcher:
+    """Mock file watcher that reports one of the given batches of paths as new
+    files at each check."""
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def start(self):
+        pass
+
+    def check(self):
+        if self.batches:
+            return self.batches.pop(0), []
+        return [], []
+
+    def wait(self, timeout):
+        pass
+
+    def refresh(self, path):
+        pass
+
+    def stop(self):
+        pass
+
+
+def read_coords_func(target_path, history=()):
+    """Mock image analysis that reads coordinates (and optionally a delay)
+    from the target file and records the files it has seen in `img_cache`.
+    Defined at module level so it can be sent to worker processes."""
+    with open(target_path) as infile:
+        values = [float(value) for value in infile.read().split()]
+    if len(values) > 3:
+        time.sleep(values[3])
+    fname = os.path.split(target_path)[-1]
+    return *values[:3], "OK", {"history": history + (fname,)}
+
+
+def write_targets(target_dir, targets):
+    """Write target files `{fname: "z y x [delay]"}` and return their paths."""
+    paths = []
+    for fname, content in targets.items():
+        paths.append(os.path.join(target_dir, fname))
+        with open(paths[-1], "w") as outfile:
+            outfile.write(content)
+    return paths
+
+
+def read_coords_txt(target_dir):
+    """Read the coordinates and messages recorded in dystrack_coords.txt."""
+    with open(os.path.join(target_dir, "dystrack_coords.txt")) as infile:
+        return [line.split() for line in infile.readlines()[1:]]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_run_dystrack_manager_positions(mocker, tmp_path, workers):
+
+    # Two positions; the first file of position "A" takes longest to analyze
+    paths = write_targets(
+        tmp_path,
+        {
+            "prescan_t0_pos_A.txt": "1 1 1 0.3",
+            "prescan_t0_pos_B.txt": "2 2 2",
+            "prescan_t1_pos_A.txt": "3 3 3",
+            "prescan_t1_pos_B.txt": "4 4 4",
+        },
+    )
+    mocker.patch.object(
+        mng.wtc,
+        "get_watcher",
+        return_value=ListWatcher([paths[:2], paths[2:]]),
+    )
+    finalize_spy = mocker.spy(mng, "_finalize_target")
+
+    # Run
+    coords, stats = mng.run_dystrack_manager(
+        tmp_path,
+        read_coords_func,
+        max_triggers=4,
+        end_on_esc=False,
+        delay=0.0,
+        file_start="prescan_",
+        workers=workers,
+        position_regex=r"pos_(\w)",
+    )
+
+    # Coordinates are transmitted and recorded in the order of detection
+    expected = [[1, 1, 1], [2, 2, 2], [3, 3, 3], [4, 4, 4]]
+    assert coords == expected
+    assert read_coords_txt(tmp_path) == [
+        [f"{c:.4f}" for c in cs] + ["OK"] for cs in expected
+    ]
+    assert stats["target_counter"] == 4
+    assert stats["img_success_counter"] == 4
+    assert stats["tra_success_counter"] == 4
+    assert stats["position_coordinates"] == {
+        "A": [[1, 1, 1], [3, 3, 3]],
+        "B": [[2, 2, 2], [4, 4, 4]],
+    }
+    assert len(stats["stage_timings"]) == 4
+
+    # Each position only saw its own img_cache
+    histories = {
+        call.kwargs["position"]: call.args[0][4]["history"]
+        for call in finalize_spy.call_args_list
+    }
+    assert histories == {
+        "A": ("prescan_t0_pos_A.txt", "prescan_t1_pos_A.txt"),
+        "B": ("prescan_t0_pos_B.txt", "prescan_t1_pos_B.txt"),
+    }
+
+
+def test_run_dystrack_manager_process_workers(mocker, tmp_path):
+
+    # Targets of two positions, analyzed in a pool of worker processes
+    paths = write_targets(
+        tmp_path,
+        {
+            "prescan_t0_pos_A.txt": "1 1 1 0.3",
+            "prescan_t0_pos_B.txt": "2 2 2",
+            "prescan_t1_pos_A.txt": "3 3 3",
+        },
+    )
+    mocker.patch.object(
+        mng.wtc,
+        "get_watcher",
+        return_value=ListWatcher([paths[:2], paths[2:]]),
+    )
+    shutdown_spy = mocker.spy(mng.ProcessPoolExecutor, "shutdown")
+    finalize_spy = mocker.spy(mng, "_finalize_target")
+
+    # The module-level analysis function, its kwargs and the img_cache are
+    # sent to the processes, and results come back in order of detection
+    coords, stats = mng.run_dystrack_manager(
+        tmp_path,
+        read_coords_func,
+        max_triggers=3,
+        end_on_esc=False,
+        delay=0.0,
+        img_cache={"history": ("initial",)},
+        workers=2,
+        worker_type="process",
+        position_regex=r"pos_(\w)",
+    )
+    assert coords == [[1, 1, 1], [2, 2, 2], [3, 3, 3]]
+    assert stats["img_success_counter"] == 3
+    assert stats["position_coordinates"]["A"] == [[1, 1, 1], [3, 3, 3]]
+    assert [line[:3] for line in read_coords_txt(tmp_path)] == [
+        [f"{c:.4f}"] * 3 for c in (1, 2, 3)
+    ]
+    assert finalize_spy.call_args.args[0][4] == {
+        "history": ("initial", "prescan_t0_pos_A.txt", "prescan_t1_pos_A.txt")
+    }
+
+    # The pool is shut down at the end of the session
+    assert shutdown_spy.call_count == 1
+
+
+# Released by the tests to let `blocking_coords_func` finish
+release_analysis = threading.Event()
+
+
+def blocking_coords_func(target_path, history=()):
+    """As `read_coords_func`, but analyses of files with "block" in their name
+    only finish once `release_analysis` is set."""
+    if "block" in target_path:
+        release_analysis.wait(timeout=5)
+    return read_coords_func(target_path, history)
+
+
+def join_analysis_threads():
+    """Wait for the manager's analysis threads to finish."""
+    for thread in threading.enumerate():
+        if thread.name.startswith("dystrack-analysis"):
+            thread.join(timeout=5)
+
+
+@pytest.mark.parametrize("release", [True, False])
+def test_run_dystrack_manager_deadline(mocker, tmp_path, capsys, release):
+
+    # The second file misses its deadline and is still running at the end
+    paths = write_targets(
+        tmp_path, {"prescan_t0.txt": "1 1 1", "prescan_t1_block.txt": "2 2 2"}
+    )
+    mocker.patch.object(
+        mng.wtc,
+        "get_watcher",
+        return_value=ListWatcher([paths[:1], paths[1:]]),
+    )
+    release_analysis.clear()
+
+    # Record transmissions; optionally release the late analysis once its
+    # fallback coordinates have been transmitted
+    transmitted = []
+
+    def tra_func(z_pos, y_pos, x_pos, img_msg, *args):
+        transmitted.append(([z_pos, y_pos, x_pos], img_msg))
+        if img_msg == "WARN:DEADLINE-MISSED" and release:
+            release_analysis.set()
+
+    # Run
+    coords, stats = mng.run_dystrack_manager(
+        tmp_path,
+        blocking_coords_func,
+        max_triggers=2,
+        end_on_esc=False,
+        delay=0.0,
+        tra_method=tra_func,
+        write_txt=False,
+        deadline=0.2,
+    )
+    stdout = capsys.readouterr().out
+
+    # The previous coordinates were transmitted for the second file
+    assert coords == [[1, 1, 1], [1, 1, 1]]
+    assert transmitted == [
+        ([1, 1, 1], "OK"),
+        ([1, 1, 1], "WARN:DEADLINE-MISSED"),
+    ]
+    assert stats["deadline_missed_counter"] == 1
+    assert stats["img_success_counter"] == 1
+    assert "No. deadlines missed:      1" in stdout
+
+    # The late analysis was awaited (or dropped) before the session ended
+    assert len(stats["late_results"]) == 1
+    late = stats["late_results"][0]
+    assert late["target_path"] == paths[1]
+    if release:
+        assert late["coords"] == [2, 2, 2]
+        assert late["img_msg"] == "OK"
+        report = "Late image analysis result for prescan_t1_block.txt"
+    else:
+        assert late["coords"] == [None, None, None]
+        assert late["img_msg"] == "WARN:LATE-RESULT-DROPPED"
+        report = "Late image analysis of prescan_t1_block.txt dropped"
+    assert stdout.index(report) < stdout.index("SESSION TERMINATED")
+
+    # Nothing arrives after the session has ended
+    release_analysis.set()
+    join_analysis_threads()
+    assert len(stats["late_results"]) == 1
+    assert "Late image analysis" not in capsys.readouterr().out
+
+
 def test_run_dystrack_manager_errors_noexit():
     with pytest.raises(ValueError) as err:
         mng.run_dystrack_manager(
@@ -186,6 +798,28 @@ def test_run_dystrack_manager_errors_noexit():
     assert "No ending condition for DySTrack event loop set" in str(err)
 
 
+def test_run_dystrack_manager_errors_prefetch():
+    with pytest.raises(ValueError) as err:
+        mng.run_dystrack_manager(
+            "test_dir",
+            lambda x: None,
+            max_checks=1,
+            workers=2,
+            worker_type="process",
+            prefetch=True,
+        )
+    assert "cannot be used with `worker_type='process'`" in str(err)
+    with pytest.raises(ValueError) as err:
+        mng.run_dystrack_manager(
+            "test_dir",
+            lambda x: None,
+            max_checks=1,
+            img_kwargs={"tile_size": 512},
+            prefetch=True,
+        )
+    assert "cannot be used with tiled analysis" in str(err)
+
+
 def NOtest_run_dystrack_manager_errors_OTHER():
     """NOtest: Test not implemented. [low-priority]"""
 
@@ -194,3 +828,11 @@ def NOtest_run_dystrack_manager_errors_OTHER():
     #       and is currently nice-to-have/low-priority.
 
     pass
+
+
+def test_run_dystrack_manager_errors_late_result():
+    with pytest.raises(ValueError) as err:
+        mng.run_dystrack_manager(
+            "test_dir", lambda x: None, max_checks=1, late_result="drop"
+        )
+    assert "Invalid `late_result`" in str(err)
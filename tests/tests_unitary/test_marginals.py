@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `marginals.py`.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+
+from dystrack.pipelines.utilities.marginals import Marginals
+
+
+@pytest.mark.parametrize("shape", [(40, 50), (7, 40, 50)])
+def test_marginals(shape):
+
+    # Random image
+    rng = np.random.default_rng(42)
+    img = (rng.random(shape) * 255).astype(np.uint8)
+    marginals = Marginals(img)
+
+    # Single and multiple axes match numpy's reductions
+    axes = [0, 1, -1, (0, 1)] + ([(1, 2), (0, 2), (0, 1, 2)] * (img.ndim > 2))
+    for axis in axes:
+        assert np.allclose(marginals.sum(axis), np.sum(img, axis=axis))
+        assert np.allclose(marginals.mean(axis), np.mean(img, axis=axis))
+        assert np.array_equal(marginals.max(axis), np.max(img, axis=axis))
+    assert marginals.max(0).dtype == np.uint8
+
+    # Profiles
+    assert np.allclose(
+        marginals.profile(0, "mean"),
+        np.mean(img, axis=tuple(range(1, img.ndim))),
+    )
+
+    # Centroid matches `ndi.center_of_mass`
+    assert np.allclose(marginals.centroid(), ndi.center_of_mass(img))
+
+
+def test_marginals_memoized(mocker):
+
+    # Only the requested reductions are computed in the first pass, others
+    # are computed when first needed
+    img = np.arange(3 * 4 * 5, dtype=np.uint8).reshape((3, 4, 5))
+    marginals = Marginals(img, reductions=("sum",))
+    spy = mocker.spy(marginals, "_project")
+    marginals.sum(0)
+    marginals.sum((1, 2))
+    marginals.centroid()
+    spy.assert_called_once_with(["sum"])
+    marginals.max(1)
+    assert spy.call_count == 2
+    spy.assert_called_with(["max"])
+
+    # Results are memoized
+    assert marginals.sum((0, 1)) is marginals.sum((1, 0))
+
+
+def test_marginals_invalid():
+    with pytest.raises(ValueError, match="2D or 3D"):
+        Marginals(np.zeros(5))
+    with pytest.raises(ValueError, match="Invalid reduction"):
+        Marginals(np.zeros((5, 5)), reductions=("min",))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `preprocessing.py`.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+
+from dystrack.pipelines.utilities import preprocessing
+from dystrack.pipelines.utilities.loading import (
+    robustly_load_image_after_write,
+)
+
+
+def test_min_max(mocker):
+
+    # Random images, incl. ones split into several chunks
+    mocker.patch.object(preprocessing, "CHUNK_SIZE", 64)
+    rng = np.random.default_rng(42)
+    for shape in [(1,), (7,), (9, 11), (4, 5, 6), (100, 3)]:
+        img = rng.integers(-1000, 1000, shape).astype(np.int16)
+        assert preprocessing.min_max(img) == (img.min(), img.max())
+
+
+def test_rescale_to_8bit(mocker):
+
+    # Reference implementation
+    def rescale(img):
+        return (
+            (img.astype(float) - img.min()) / (img.max() - img.min()) * 255
+        ).astype(np.uint8)
+
+    # Random images of various dtypes, incl. ones split into several chunks
+    mocker.patch.object(preprocessing, "CHUNK_SIZE", 64)
+    rng = np.random.default_rng(42)
+    for shape, dtype in [
+        ((9, 11), np.uint16),
+        ((4, 5, 6), np.uint16),
+        ((100, 3), np.float32),
+        ((50,), np.int16),
+    ]:
+        img = (rng.random(shape) * 30000).astype(dtype)
+        img_8bit = preprocessing.rescale_to_8bit(img)
+        assert img_8bit.dtype == np.uint8
+        assert np.array_equal(img_8bit, rescale(img))
+
+    # Example image (read-only memory-map)
+    mocker.stopall()
+    raw = robustly_load_image_after_write(
+        "./tests/testdata/test-pllp_AXR_prescan.tiff",
+        await_write=0.1,
+        memmap=True,
+    )
+    assert raw.dtype == np.uint16
+    assert np.array_equal(preprocessing.rescale_to_8bit(raw), rescale(raw))
+
+    # Constant and empty images
+    img = np.full((5, 5), 7, dtype=np.uint16)
+    assert np.array_equal(preprocessing.rescale_to_8bit(img), np.zeros((5, 5)))
+    assert preprocessing.rescale_to_8bit(np.zeros((0, 5))).shape == (0, 5)
+
+
+def test_convert_image():
+
+    # 8bit images are passed through
+    img = np.arange(10, dtype=np.uint8)
+    assert preprocessing.convert_image(img) is img
+
+    # Other images are converted, with warning
+    img = np.arange(10, dtype=np.uint16)
+    with pytest.warns(UserWarning, match="Image converted down to 8bit"):
+        img_8bit = preprocessing.convert_image(img)
+    assert img_8bit.dtype == np.uint8
+    assert img_8bit.max() == 255
+
+    # Native 16bit path
+    assert preprocessing.convert_image(img, keep_16bit=True) is img
+    with pytest.warns(UserWarning, match="Image converted down to 8bit"):
+        img_8bit = preprocessing.convert_image(
+            img.astype(np.float32), keep_16bit=True
+        )
+    assert img_8bit.dtype == np.uint8
+
+
+def test_gaussian_smooth(mocker):
+
+    # Random images of various shapes, dtypes, and sigmas
+    rng = np.random.default_rng(42)
+    for shape, dtype, sigma in [
+        ((21, 200, 100), np.uint8, 3.0),
+        ((200, 100), np.uint8, 3.0),
+        ((9, 80, 60), np.uint16, (1.0, 3.0, 2.0)),
+        ((5, 40, 30), np.float32, 2.5),
+        ((30, 30), np.uint8, 0.0),
+    ]:
+        img = (rng.random(shape) * 200).astype(dtype)
+        img_ref = ndi.gaussian_filter(img, sigma=sigma)
+        for workers in [1, 2, 3, 7, 64]:
+            img_smooth = preprocessing.gaussian_smooth(img, sigma, workers)
+            assert img_smooth.dtype == img.dtype
+            assert np.array_equal(img_smooth, img_ref)
+
+    # Slabs are split along the longest axis other than x
+    spy = mocker.spy(preprocessing.ndi, "gaussian_filter")
+    img = np.zeros((10, 100, 20), dtype=np.uint8)
+    preprocessing.gaussian_smooth(img, 3.0, workers=4)
+    assert spy.call_count == 4
+    assert all(c.args[0].shape[1] < 100 for c in spy.call_args_list)
+    assert all(c.args[0].shape[0] == 10 for c in spy.call_args_list)
+
+    # By default, the image is filtered in one go (single-threaded)
+    spy.reset_mock()
+    preprocessing.gaussian_smooth(img, 3.0)
+    assert spy.call_count == 1
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `projection.py`.
+"""
+
+import numpy as np
+import pytest
+
+from dystrack.pipelines.utilities import projection
+
+
+def test_project_stack():
+
+    # Max and (rounded) mean projections
+    stack = np.zeros((4, 5, 6), dtype=np.uint8)
+    stack[1, 2, 3] = 10
+    stack[2, 2, 3] = 1
+    proj_max = projection.project_stack(stack, "max")
+    proj_mean = projection.project_stack(stack, "mean")
+    assert proj_max.shape == proj_mean.shape == (5, 6)
+    assert proj_max.dtype == proj_mean.dtype == np.uint8
+    assert proj_max[2, 3] == 10
+    assert proj_mean[2, 3] == 3
+
+    # Invalid projection
+    with pytest.raises(ValueError, match="Invalid `projection`"):
+        projection.project_stack(stack, "min")
+
+
+def test_column_z_position():
+
+    # Object in a column at (z=6, y=20, x=30) on a constant background
+    stack = np.full((12, 40, 50), 5, dtype=np.uint8)
+    stack[5:8, 18:23, 28:33] = 100
+    stack[1, 0:5, 0:5] = 200  # Outside of the column
+    z_pos = projection.column_z_position(stack, (20.2, 29.8), radius=3)
+    assert np.isclose(z_pos, 6.0)
+
+    # Flat profile
+    stack = np.ones((11, 20, 20), dtype=np.uint8)
+    assert projection.column_z_position(stack, (10, 10)) == 5.0
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `roi.py`.
+"""
+
+import numpy as np
+
+from dystrack.pipelines.utilities import roi
+
+
+def test_crop_to_roi():
+    img = np.arange(4 * 30 * 40).reshape(4, 30, 40)
+    img_roi = roi.crop_to_roi(img, ((5, 12), (20, 31)))
+    assert img_roi.shape == (4, 7, 11)
+    assert np.array_equal(img_roi, img[:, 5:12, 20:31])
+
+
+def test_touches_roi_border():
+
+    # Object within a 20x20 ROI of a 100x100 frame
+    frame_shape = (100, 100)
+    roi_yx = ((40, 60), (40, 60))
+    bbox = (slice(5, 15), slice(5, 15))
+    assert not roi.touches_roi_border(bbox, (20, 20), roi_yx, frame_shape)
+
+    # Object touching an inner border of the ROI
+    bbox = (slice(5, 15), slice(5, 20))
+    assert roi.touches_roi_border(bbox, (20, 20), roi_yx, frame_shape)
+
+    # Object touching a border of the ROI that is also the frame's border
+    roi_yx = ((40, 60), (80, 100))
+    assert not roi.touches_roi_border(bbox, (20, 20), roi_yx, frame_shape)
+
+
+def test_next_roi():
+
+    # Object at the center of the frame, which remains in place
+    bbox = (slice(40, 60), slice(30, 70))
+    roi_next = roi.next_roi(bbox, (1, 1), None, (49.5, 49.5), (100, 100), 0.1)
+    assert roi_next == ((30, 70), (20, 80))
+
+    # Frame moves by 10 pixels in x; binned and within an ROI
+    bbox = (slice(10, 15), slice(5, 15))
+    roi_next = roi.next_roi(
+        bbox, (2, 2), ((20, 80), (20, 80)), (49.5, 59.5), (100, 100), 0.0
+    )
+    assert roi_next == ((40, 50), (20, 40))
+
+    # Object leaves the frame
+    roi_next = roi.next_roi(bbox, (1, 1), None, (49.5, 200.0), (100, 100), 0)
+    assert roi_next is None
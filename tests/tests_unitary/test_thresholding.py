@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `thresholding.py`.
+"""
+
+import os
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+
+from dystrack.pipelines.utilities import thresholding
+from dystrack.pipelines.utilities.loading import (
+    robustly_load_image_after_write,
+)
+
+
+def test_object_counts_engines():
+    """Test that the tree engine gives the same counts as `ndi.label`."""
+
+    # Random images of various shapes (incl. edge cases)
+    rng = np.random.default_rng(42)
+    for shape in [(1, 1), (7,), (9, 11), (4, 5, 6), (30, 40)]:
+        img = rng.integers(0, 256, shape).astype(np.uint8)
+        counts_tree = thresholding.object_counts(img, engine="tree")
+        counts_label = thresholding.object_counts(img, engine="label")
+        assert counts_tree.shape == (256,)
+        assert np.array_equal(counts_tree, counts_label)
+
+    # Constant image and thresholds outside the range of values
+    img = np.full((10, 10), 7, dtype=np.uint8)
+    thresholds = np.array([0, 7, 8, 300])
+    counts = thresholding.object_counts(img, thresholds)
+    assert np.array_equal(counts, [1, 1, 0, 0])
+
+    # Smoothed example image
+    raw = robustly_load_image_after_write(
+        "./tests/testdata/test-pllp_980_prescan.tif", await_write=0.1
+    )
+    raw = ndi.gaussian_filter(raw, sigma=3)
+    assert np.array_equal(
+        thresholding.object_counts(raw, engine="tree"),
+        thresholding.object_counts(raw, engine="label"),
+    )
+
+    # Threaded label engine
+    assert np.array_equal(
+        thresholding.object_counts(raw, engine="tree"),
+        thresholding.object_counts(raw, engine="label", workers=4),
+    )
+
+
+def test_object_counts_errors():
+    with pytest.raises(ValueError) as err:
+        thresholding.object_counts(np.zeros((5, 5)), engine="bad_engine")
+    assert "Invalid `engine`" in str(err)
+
+
+def test_objct_threshold(mocker):
+
+    # Smoothed example image
+    raw = robustly_load_image_after_write(
+        "./tests/testdata/test-pllp_980_prescan.tif", await_write=0.1
+    )
+    raw = ndi.gaussian_filter(raw, sigma=3)
+
+    # Full threshold series
+    threshold, counts, counts_smooth, prior = thresholding.objct_threshold(
+        raw, engine="label", window=10
+    )
+    assert prior["threshold"] == threshold
+    assert np.array_equal(counts, thresholding.object_counts(raw))
+    assert np.array_equal(counts_smooth, ndi.gaussian_filter1d(counts, 3))
+
+    # Warm start with the prior only evaluates up to the window and agrees
+    spy = mocker.spy(thresholding, "object_counts")
+    output = thresholding.objct_threshold(
+        raw, engine="label", prior=prior, window=20
+    )
+    assert output[0] == threshold
+    assert np.array_equal(output[1], counts)
+    assert spy.call_count == 1
+    assert len(spy.call_args.args[1]) == threshold + 21
+
+    # Stale prior counts cannot affect the result, as all counts the selection
+    # depends on are evaluated anew
+    stale_prior = dict(prior, counts=np.full(256, 1000))
+    output = thresholding.objct_threshold(
+        raw, engine="label", prior=stale_prior, window=20
+    )
+    assert output[0] == threshold
+    assert np.array_equal(
+        output[1][: threshold + 21], counts[: threshold + 21]
+    )
+
+    # If the selection may depend on counts above the window, they are
+    # evaluated as well
+    spy.reset_mock()
+    low_prior = dict(stale_prior, threshold=threshold - 10)
+    output = thresholding.objct_threshold(
+        raw, engine="label", prior=low_prior, window=10
+    )
+    assert output[0] == threshold
+    assert np.array_equal(output[1], counts)
+    assert spy.call_count == 2
+    assert len(spy.call_args.args[1]) == 256 - (threshold + 1)
+
+    # Windowing is skipped with the tree engine, which returns no prior
+    spy.reset_mock()
+    output = thresholding.objct_threshold(raw, prior=prior, window=10)
+    assert output[0] == threshold
+    assert spy.call_count == 1
+    assert len(spy.call_args.args[1]) == 256
+    assert output[3] is None
+
+    # No prior is returned without a window either
+    output = thresholding.objct_threshold(raw, engine="label", window=None)
+    assert output[3] is None
+
+
+def test_objct_threshold_coarse_to_fine(mocker):
+
+    # Smoothed example images
+    for fname in ["test-pllp_980_prescan.tif", "test-pllp_980_prescan2D.tif"]:
+        raw = robustly_load_image_after_write(
+            os.path.join("./tests/testdata/", fname), await_write=0.1
+        )
+        raw = ndi.gaussian_filter(raw, sigma=3)
+        threshold = thresholding.objct_threshold(raw)[0]
+
+        # Coarse-to-fine gives the same threshold with fewer label calls
+        spy = mocker.spy(thresholding.ndi, "label")
+        output = thresholding.objct_threshold(
+            raw, engine="label", coarse_step=8, workers=2
+        )
+        assert output[0] == threshold
+        assert spy.call_count < 256 / 2
+
+        # The curve is exact up to the threshold
+        counts = thresholding.object_counts(raw)
+        assert np.array_equal(
+            output[1][: threshold + 1], counts[: threshold + 1]
+        )
+        mocker.stopall()
+
+
+def test_objct_threshold_coarse_to_fine_tree():
+
+    # The selection reaches the smoothing kernel radius plus one beyond the
+    # threshold
+    assert thresholding.SELECTION_REACH == 13
+
+    # Coarse-to-fine is skipped (with a warning) with the tree engine
+    raw = robustly_load_image_after_write(
+        "./tests/testdata/test-pllp_980_prescan2D.tif", await_write=0.1
+    )
+    raw = ndi.gaussian_filter(raw, sigma=3)
+    threshold = thresholding.objct_threshold(raw)[0]
+    with pytest.warns(UserWarning, match="`coarse_step` has no effect"):
+        output = thresholding.objct_threshold(raw, coarse_step=8)
+    assert output[0] == threshold
+
+
+def test_objct_threshold_errors():
+    with pytest.raises(Exception) as err:
+        thresholding.objct_threshold(np.zeros((20, 20), dtype=np.uint8))
+    assert "THRESHOLD DETECTION FAILED" in str(err)
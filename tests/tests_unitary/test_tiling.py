@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `tiling.py`.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+from skimage.filters import threshold_otsu
+
+from dystrack.pipelines.utilities import tiling
+from dystrack.pipelines.utilities.loading import (
+    robustly_load_image_after_write,
+)
+from dystrack.pipelines.utilities.preprocessing import convert_image
+
+
+def test_iter_tiles():
+
+    # Tiles cover the image exactly once
+    shape = (3, 50, 70)
+    covered = np.zeros(shape, dtype=int)
+    for tile_index, inner, outer, local in tiling.iter_tiles(shape, 32, 5):
+        covered[inner] += 1
+        assert np.array_equal(
+            np.arange(70)[outer[-1]][local[-1]], np.arange(70)[inner[-1]]
+        )
+    assert np.all(covered == 1)
+    assert tile_index == (1, 2)
+
+
+def test_iter_smoothed_tiles():
+
+    # Tiles of the smoothed 8bit image match the full image
+    rng = np.random.default_rng(42)
+    raw = (rng.random((5, 90, 110)) * 4000).astype(np.uint16)
+    with pytest.warns(UserWarning, match="converted down to 8bit"):
+        tiles = list(tiling.iter_smoothed_tiles(raw, 3.0, 40))
+    smooth = ndi.gaussian_filter(convert_image(raw, warn_8bit=False), 3.0)
+    for _, inner, tile in tiles:
+        assert tile.dtype == np.uint8
+        assert np.array_equal(tile, smooth[inner])
+
+    # Native 16bit
+    for _, inner, tile in tiling.iter_smoothed_tiles(
+        raw, 3.0, 40, keep_16bit=True
+    ):
+        assert np.array_equal(tile, ndi.gaussian_filter(raw, 3.0)[inner])
+
+
+def test_tiled_center_of_mass():
+
+    # Smoothed example image
+    raw = robustly_load_image_after_write(
+        "./tests/testdata/test-pllp_AXR_prescan.tiff",
+        await_write=0.1,
+        memmap=True,
+    )
+    smooth = ndi.gaussian_filter(convert_image(raw, warn_8bit=False), 3.0)
+
+    # Intensity method
+    cen = ndi.center_of_mass(smooth)
+    for tile_size in [50, 128, 1024]:
+        cen_tiled = tiling.tiled_center_of_mass(
+            raw, "intensity", tile_size=tile_size, warn_8bit=False
+        )
+        assert np.allclose(cen_tiled, cen)
+
+    # Otsu method
+    mask = smooth >= threshold_otsu(smooth)
+    labels = ndi.label(mask)[0]
+    largest_obj = np.argmax(np.bincount(labels.ravel())[1:]) + 1
+    cen = ndi.center_of_mass(labels == largest_obj)
+    for tile_size in [50, 128, 1024]:
+        cen_tiled = tiling.tiled_center_of_mass(
+            raw, "otsu", tile_size=tile_size, warn_8bit=False
+        )
+        assert np.allclose(cen_tiled, cen)
+
+    # Object spanning several tiles in a U-shape (merged via two borders),
+    # next to a smaller separate object
+    img = np.zeros((60, 60), dtype=np.uint8)
+    img[10:50, 5:15] = img[10:50, 45:55] = img[40:50, 5:55] = 200
+    img[20:25, 25:30] = 255
+    cen = tiling.tiled_center_of_mass(img, "otsu", 1.0, tile_size=16)
+    smooth = ndi.gaussian_filter(img, 1.0)
+    labels = ndi.label(smooth >= threshold_otsu(smooth))[0]
+    assert labels.max() == 2
+    assert np.allclose(cen, ndi.center_of_mass(labels == labels[45, 30]))
+
+
+def test_tiled_center_of_mass_errors():
+    with pytest.raises(ValueError) as err:
+        tiling.tiled_center_of_mass(np.zeros((20, 20)), "objct")
+    assert "Invalid `method` for tiled mode" in str(err)
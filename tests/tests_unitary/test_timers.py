@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests for the stage latency timers.
+"""
+
+import time
+
+import dystrack.pipelines.utilities.timers as tmr
+
+
+def test_stage_timer():
+
+    # Stages are recorded (and accumulated) within a frame
+    tmr.start_frame()
+    with tmr.stage_timer("decode"):
+        time.sleep(0.05)
+    with tmr.stage_timer("decode"):
+        time.sleep(0.05)
+    tmr.record_stage("analysis", 1.0)
+    stages = tmr.stop_frame()
+    assert set(stages.keys()) == {"decode", "analysis"}
+    assert stages["decode"] >= 0.1
+    assert stages["analysis"] == 1.0
+
+    # Outside of a frame, nothing is recorded
+    with tmr.stage_timer("decode"):
+        pass
+    assert tmr.stop_frame() == {}
+
+
+def test_summarize_stages():
+    frame_timings = [{"detect": float(i), "total": 2.0} for i in range(101)]
+    frame_timings.append({"total": 2.0})
+    summary = tmr.summarize_stages(frame_timings)
+    assert list(summary.keys()) == ["detect", "total"]
+    assert summary["detect"] == {"p50": 50.0, "p95": 95.0, "max": 100.0}
+    assert summary["total"] == {"p50": 2.0, "p95": 2.0, "max": 2.0}
+    assert tmr.summarize_stages([]) == {}
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+@descript:  Unit tests against `watchers.py`.
+"""
+
+import os
+import time
+
+import pytest
+
+from dystrack.manager import watchers
+
+
+def test_polling_watcher(tmp_path):
+
+    # Files present before the start are not reported
+    with open(tmp_path / "old_file.txt", "w") as f:
+        f.write("old")
+    watcher = watchers.get_watcher("poll", str(tmp_path))
+    watcher.start()
+    assert watcher.check() == ([], [])
+
+    # New files are reported exactly once
+    new_path = os.path.join(str(tmp_path), "new_file.txt")
+    with open(new_path, "w") as f:
+        f.write("new")
+    assert watcher.check() == ([new_path], [])
+    assert watcher.check() == ([], [])
+
+    # Overwritten files are reported as changed
+    with open(new_path, "w") as f:
+        f.write("overwritten")
+    assert watcher.check() == ([], [new_path])
+
+    # Refreshing absorbs changes that happened in the meantime
+    with open(new_path, "a") as f:
+        f.write(" again")
+    watcher.refresh(new_path)
+    assert watcher.check() == ([], [])
+
+    # Deleted and re-created files count as new
+    os.remove(new_path)
+    assert watcher.check() == ([], [])
+    with open(new_path, "w") as f:
+        f.write("new again")
+    assert watcher.check() == ([new_path], [])
+    watcher.stop()
+
+
+def test_polling_watcher_recurse(tmp_path, mocker):
+
+    os.makedirs(tmp_path / "subdir" / "subsubdir")
+    watcher = watchers.get_watcher("poll", str(tmp_path), recurse=True)
+    watcher.start()
+
+    # New files in nested subdirs are found
+    new_path = os.path.join(str(tmp_path), "subdir", "subsubdir", "new.txt")
+    with open(new_path, "w") as f:
+        f.write("new")
+    assert watcher.check() == ([new_path], [])
+
+    # Subdirs with unchanged mtime are not listed again (but still visited)
+    mock_scandir = mocker.patch(
+        "dystrack.manager.watchers.os.scandir", wraps=os.scandir
+    )
+    assert watcher.check() == ([], [])
+    assert [c.args[0] for c in mock_scandir.call_args_list] == [str(tmp_path)]
+
+
+def test_event_watcher(tmp_path):
+    pytest.importorskip("watchdog")
+
+    # Files present before the start are not reported
+    with open(tmp_path / "old_file.txt", "w") as f:
+        f.write("old")
+    watcher = watchers.get_watcher("events", str(tmp_path))
+    watcher.start()
+    try:
+        assert watcher.check() == ([], [])
+
+        # Waiting returns early once a new file appears
+        with open(tmp_path / "new_file.txt", "w") as f:
+            f.write("new")
+        time_start = time.time()
+        watcher.wait(10.0)
+        assert time.time() - time_start < 5.0
+
+        # The new file is reported exactly once (despite multiple events)
+        time.sleep(0.2)
+        new_path = os.path.join(str(tmp_path), "new_file.txt")
+        assert watcher.check() == ([new_path], [])
+        assert watcher.check() == ([], [])
+
+        # Overwritten files are reported as changed
+        with open(tmp_path / "new_file.txt", "a") as f:
+            f.write("more")
+        time.sleep(0.2)
+        assert watcher.check() == ([], [new_path])
+
+    finally:
+        watcher.stop()
+
+
+def test_get_watcher_errors(tmp_path):
+    with pytest.raises(ValueError) as err:
+        watchers.get_watcher("unsupported", str(tmp_path))
+    assert "Invalid `watcher`" in str(err)
@@ -14,8 +14,10 @@ from time import sleep
 
 import numpy as np
 import pytest
+import tifffile
 
 from dystrack.pipelines import center_of_mass
+from dystrack.pipelines.utilities.buffers import get_buffer_pool
 
 
 def test_analyze_image_3D_intensity_success(mocker, capsys):
@@ -83,6 +85,201 @@ def test_analyze_image_3D_otsu_success(mocker, capsys):
         assert eso in stdout
 
 
+def test_analyze_image_3D_otsu_tiled_success(mocker, capsys):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllo_cyto_880_prescan.czi"
+
+    # Expectations (same as without tiling)
+    expected_output = ["12.6970", "96.4890", "91.2903", "OK", {}]
+    expected_stdouts = [
+        "Loaded image of shape: (25, 200, 200)",
+        "Detected treshold: 54",
+        "Resulting coords (zyx): 12.6970, 96.4890, 91.2903",
+    ]
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Run test
+    output = center_of_mass.analyze_image(
+        os.path.join(testpath, fname),
+        method="otsu",
+        tile_size=64,
+        verbose=True,
+    )
+    output = list(output)
+    output[:3] = [f"{c:.4f}" for c in output[:3]]
+    stdout = capsys.readouterr().out
+
+    # Compare results
+    assert output == expected_output
+    for eso in expected_stdouts:
+        assert eso in stdout
+
+
+def test_analyze_image_3D_otsu_downsample(mocker, capsys):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllo_cyto_880_prescan.czi"
+
+    # Expectations (refined result same as without binning)
+    expected_output = ["12.6970", "96.4890", "91.2903", "OK", {}]
+    expected_stdouts = [
+        "Binned image to shape: (25, 100, 100)",
+        "Detected treshold: 54",
+    ]
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Run with refinement
+    output = center_of_mass.analyze_image(
+        os.path.join(testpath, fname),
+        method="otsu",
+        downsample=2,
+        downsample_refine=True,
+        verbose=True,
+    )
+    output = list(output)
+    output[:3] = [f"{c:.4f}" for c in output[:3]]
+    stdout = capsys.readouterr().out
+
+    # Compare results
+    assert output == expected_output
+    for eso in expected_stdouts:
+        assert eso in stdout
+
+    # Without refinement, results should still be close
+    output = center_of_mass.analyze_image(
+        os.path.join(testpath, fname), method="otsu", downsample=4
+    )
+    assert np.allclose(output[:3], [12.6970, 96.4890, 91.2903], atol=0.5)
+
+
+def test_analyze_image_3D_projection(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllo_cyto_880_prescan.czi"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Results should be close to those of the full volume
+    for method, expected in [
+        ("intensity", [12.8727, 95.5593, 93.5039]),
+        ("otsu", [12.6970, 96.4890, 91.2903]),
+        ("objct", [12.6445, 96.9214, 91.4378]),
+    ]:
+        output = center_of_mass.analyze_image(
+            os.path.join(testpath, fname), method=method, projection="mean"
+        )
+        assert np.allclose(output[:3], expected, atol=1.0)
+        assert output[3] == "OK"
+
+
+def test_analyze_image_3D_otsu_roi(mocker, capsys):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllo_cyto_880_prescan.czi"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Full frame analysis stores the ROI for the next frame
+    output = center_of_mass.analyze_image(
+        os.path.join(testpath, fname), method="otsu", roi_margin=0.1
+    )
+    assert output[4] == {"roi_prior": {"roi": ((55, 146), (50, 155))}}
+
+    # Analysis within the ROI
+    output_roi = center_of_mass.analyze_image(
+        os.path.join(testpath, fname),
+        method="otsu",
+        roi_margin=0.1,
+        verbose=True,
+        **output[4],
+    )
+    stdout = capsys.readouterr().out
+    assert "Cropped image to ROI: ((55, 146), (50, 155))" in stdout
+    assert "ROI analysis failed" not in stdout
+    assert np.allclose(output_roi[:3], output[:3], atol=0.5)
+
+    # Fallback to the full frame if the object touches the ROI's border
+    # (reusing the image that was loaded for the ROI analysis)
+    load_spy = mocker.spy(center_of_mass, "robustly_load_image_after_write")
+    output_fallback = center_of_mass.analyze_image(
+        os.path.join(testpath, fname),
+        method="otsu",
+        verbose=True,
+        roi_prior={"roi": ((90, 160), (30, 150))},
+    )
+    stdout = capsys.readouterr().out
+    assert "Object touches the border of the ROI!" in stdout
+    assert load_spy.call_count == 1
+    assert output_fallback == output[:4] + ({},)
+
+
+def test_analyze_image_3D_reuse_buffers(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllo_cyto_880_prescan.czi"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Results are the same with and without buffer reuse, and the buffers of
+    # the first frame are reused for the second
+    pool = get_buffer_pool()
+    for kwargs in [
+        {"method": "otsu"},
+        {"method": "objct", "objct_engine": "label", "objct_window": None},
+    ]:
+        pool.clear()
+        expected = center_of_mass.analyze_image(
+            os.path.join(testpath, fname), **kwargs
+        )
+        output = center_of_mass.analyze_image(
+            os.path.join(testpath, fname), reuse_buffers=True, **kwargs
+        )
+        assert output[:4] == expected[:4]
+        assert pool.nbytes > 0
+        free = {id(buf) for bufs in pool._free.values() for buf in bufs}
+        output = center_of_mass.analyze_image(
+            os.path.join(testpath, fname), reuse_buffers=True, **kwargs
+        )
+        assert output[:4] == expected[:4]
+        assert free == {
+            id(buf) for bufs in pool._free.values() for buf in bufs
+        }
+
+    # Buffers are also given back if the analysis fails
+    pool.clear()
+    mocker.patch.object(
+        center_of_mass, "largest_component", side_effect=Exception("failed")
+    )
+    with pytest.raises(Exception, match="failed"):
+        center_of_mass.analyze_image(
+            os.path.join(testpath, fname), method="otsu", reuse_buffers=True
+        )
+    assert pool.nbytes > 0
+
+
 def test_analyze_image_3D_objct_success(mocker, capsys):
 
     # Targets
@@ -90,7 +287,7 @@ def test_analyze_image_3D_objct_success(mocker, capsys):
     fname = "test-pllo_mem_980_prescan.czi"
 
     # Expectations
-    expected_output = ["10.6192", "105.3974", "93.0783", "OK", {}]
+    expected_output = ["10.6192", "105.3974", "93.0783", "OK"]
     expected_stdouts = [
         "Loaded image of shape: (21, 200, 200)",
         "Detected treshold: 9",
@@ -104,14 +301,20 @@ def test_analyze_image_3D_objct_success(mocker, capsys):
 
     # Run test
     output = center_of_mass.analyze_image(
-        os.path.join(testpath, fname), method="objct", verbose=True
+        os.path.join(testpath, fname),
+        method="objct",
+        objct_engine="label",
+        verbose=True,
     )
     output = list(output)
+    img_cache = output.pop()
     output[:3] = [f"{c:.4f}" for c in output[:3]]
     stdout = capsys.readouterr().out
 
     # Compare results
     assert output == expected_output
+    assert img_cache["objct_prior"]["threshold"] == 9
+    assert img_cache["objct_prior"]["counts"].shape == (256,)
     for eso in expected_stdouts:
         assert eso in stdout
 
@@ -188,7 +391,7 @@ def test_analyze_image_2D_objct_success(mocker, capsys):
     fname = "test-pllo_cyto_880_prescan2D.tif"
 
     # Expectations
-    expected_output = ["0.0000", "96.1637", "91.7534", "OK", {}]
+    expected_output = ["0.0000", "96.1637", "91.7534", "OK"]
     expected_stdouts = [
         "Loaded image of shape: (200, 200)",
         "Detected treshold: 103",
@@ -202,24 +405,86 @@ def test_analyze_image_2D_objct_success(mocker, capsys):
 
     # Run test
     output = center_of_mass.analyze_image(
-        os.path.join(testpath, fname), method="objct", verbose=True
+        os.path.join(testpath, fname),
+        method="objct",
+        objct_engine="label",
+        verbose=True,
     )
     output = list(output)
+    img_cache = output.pop()
     output[:3] = [f"{c:.4f}" for c in output[:3]]
     stdout = capsys.readouterr().out
 
     # Compare results
     assert output == expected_output
+    assert img_cache["objct_prior"]["threshold"] == 103
+    assert img_cache["objct_prior"]["counts"].shape == (256,)
     for eso in expected_stdouts:
         assert eso in stdout
 
 
+def test_analyze_image_3D_otsu_keep_16bit(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllp_AXR_prescan.tiff"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Run with native 16bit (no conversion warning) and with 8bit
+    with warnings.catch_warnings(record=True) as w:
+        output_16bit = center_of_mass.analyze_image(
+            os.path.join(testpath, fname), method="otsu", keep_16bit=True
+        )
+    assert not any("converted down to 8bit" in str(wi.message) for wi in w)
+    with pytest.warns(UserWarning, match="converted down to 8bit"):
+        output_8bit = center_of_mass.analyze_image(
+            os.path.join(testpath, fname), method="otsu"
+        )
+
+    # Results should be very similar
+    assert np.allclose(output_16bit[:3], output_8bit[:3], atol=1.0)
+    assert output_16bit[3] == "OK"
+
+
+@pytest.mark.parametrize("tile_size", [None, 64])
+def test_analyze_image_3D_intensity_keep_16bit(mocker, tile_size):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllp_AXR_prescan.tiff"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # The "intensity" method ignores `keep_16bit`, as its centroid depends on
+    # the minimum being subtracted by the 8bit conversion
+    outputs = []
+    for keep_16bit in [True, False]:
+        with pytest.warns(UserWarning, match="converted down to 8bit"):
+            outputs.append(
+                center_of_mass.analyze_image(
+                    os.path.join(testpath, fname),
+                    method="intensity",
+                    tile_size=tile_size,
+                    keep_16bit=keep_16bit,
+                )
+            )
+    assert np.allclose(outputs[0][:3], outputs[1][:3])
+    assert np.allclose(outputs[0][:3], (3.50, 108.19, 240.54), atol=0.01)
+
+
 def test_analyze_image_errors_inputchecks(mocker):
 
     # Too many dimensions
     mocker.patch(
         "dystrack.pipelines.center_of_mass.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1, 1, 1, 1, 1)),
+        wraps=lambda fp, **kwargs: np.zeros((1, 1, 1, 1, 1)),
     )
     with pytest.raises(IOError) as err:
         center_of_mass.analyze_image("test_path.tiff")
@@ -228,40 +493,37 @@ def test_analyze_image_errors_inputchecks(mocker):
     # Too few dimensions
     mocker.patch(
         "dystrack.pipelines.center_of_mass.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1,)),
+        wraps=lambda fp, **kwargs: np.zeros((1,)),
     )
     with pytest.raises(IOError) as err:
         center_of_mass.analyze_image("test_path.tiff")
     assert "Image dimensionality <2" in str(err)
 
-    # Too few dimensions with channel
-    mocker.patch(
-        "dystrack.pipelines.center_of_mass.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1, 1)),
-    )
+    # Channel not in image (raised by the loader, without retries)
+    mocker.stopall()
+    fpath = r"./tests/testdata/test-pllp_980_prescan.tif"
     with pytest.raises(IOError) as err:
-        center_of_mass.analyze_image("test_path.tiff", channel=0)
-    assert "CHANNEL given but image dimensionality is <3!" in str(err)
+        center_of_mass.analyze_image(fpath, channel=1, await_write=0.1)
+    assert "CHANNEL 1 given but image has only 1 channel(s)!" in str(err)
 
 
-def test_analyze_image_warnings_inputchecks(mocker):
+def test_analyze_image_warnings_inputchecks(mocker, tmp_path):
     # Note: Error wrapping is done for perf (to halt function at warning)
 
-    # Channel given but large first dimension
-    mocker.patch(
-        "dystrack.pipelines.center_of_mass.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((10, 1, 1, 1)),
-    )
+    # Channel given but many channels in image
+    fpath = str(tmp_path / "test_6channels.tif")
+    raw = np.zeros((6, 5, 5), dtype=np.uint8)
+    tifffile.imwrite(fpath, raw, imagej=True, metadata={"axes": "CYX"})
     with pytest.raises(Exception) as err:
         with warnings.catch_warnings():
             warnings.simplefilter(action="error")
-            center_of_mass.analyze_image("test_path.tiff", channel=0)
-    assert "CHANNEL given but image dim 0 is of size 10!" in str(err)
+            center_of_mass.analyze_image(fpath, channel=0, await_write=0.1)
+    assert "CHANNEL given but image dim C is of size 6!" in str(err)
 
     # Conversion to 8bit
     mocker.patch(
         "dystrack.pipelines.center_of_mass.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((3, 5, 5), dtype=np.uint16),
+        wraps=lambda fp, **kwargs: np.zeros((3, 5, 5), dtype=np.uint16),
     )
     with pytest.raises(Exception) as err:
         with warnings.catch_warnings():
@@ -274,7 +536,7 @@ def test_analyze_image_errors_nothresh(mocker):
 
     mocker.patch(
         "dystrack.pipelines.center_of_mass.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((100, 100), dtype=np.uint8),
+        wraps=lambda fp, **kwargs: np.zeros((100, 100), dtype=np.uint8),
     )
     with pytest.raises(Exception) as err:
         center_of_mass.analyze_image("test_path.tiff", method="objct")
@@ -285,8 +547,76 @@ def test_analyze_image_errors_invalidmethod(mocker):
 
     mocker.patch(
         "dystrack.pipelines.center_of_mass.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((100, 100), dtype=np.uint8),
+        wraps=lambda fp, **kwargs: np.zeros((100, 100), dtype=np.uint8),
     )
     with pytest.raises(NotImplementedError) as err:
         center_of_mass.analyze_image("test_path.tiff", method="bad_method")
     assert "bad_method is not a valid method for center_of_mass." in str(err)
+
+    # Tiled mode is rejected up front for methods that do not support it
+    mock_load = mocker.patch(
+        "dystrack.pipelines.center_of_mass.robustly_load_image_after_write"
+    )
+    with pytest.raises(ValueError) as err:
+        center_of_mass.analyze_image(
+            "test_path.tiff", method="objct", tile_size=64
+        )
+    assert "Invalid `method` for tiled mode" in str(err)
+    assert mock_load.call_count == 0
+
+
+@pytest.mark.parametrize("method", ["intensity", "otsu"])
+def test_analyze_batch(mocker, method):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    batches = [
+        [
+            "test-pllp_980_prescan.czi",
+            "test-pllp_980_prescan.tif",
+            "test-pllp_980_prescan.czi",
+        ],
+        ["test-cnode_early_prescan2D.tiff", "test-cnode_late_prescan2D.tiff"],
+    ]
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Results match those of separate calls
+    for fnames in batches:
+        paths = [os.path.join(testpath, fname) for fname in fnames]
+        outputs = center_of_mass.analyze_batch(
+            paths, method=method, warn_8bit=False
+        )
+        assert len(outputs) == len(paths)
+        for path, output in zip(paths, outputs):
+            expected = center_of_mass.analyze_image(
+                path, method=method, warn_8bit=False
+            )
+            assert np.allclose(output[:3], expected[:3], rtol=0, atol=1e-9)
+            assert output[3:] == ("OK", {})
+
+
+def test_analyze_batch_errors(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Images of different shapes
+    paths = [
+        os.path.join(testpath, "test-pllp_980_prescan.czi"),
+        os.path.join(testpath, "test-pllo_cyto_880_prescan.czi"),
+    ]
+    with pytest.raises(ValueError, match="same shape"):
+        center_of_mass.analyze_batch(paths)
+
+    # Unsupported method
+    with pytest.raises(ValueError, match="Invalid `method`"):
+        center_of_mass.analyze_batch(paths[:1], method="objct")
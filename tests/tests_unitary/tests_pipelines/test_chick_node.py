@@ -13,8 +13,10 @@ from time import sleep
 
 import numpy as np
 import pytest
+import tifffile
 
 from dystrack.pipelines import chick_node
+from dystrack.pipelines.utilities import fitting
 
 
 # Helper function
@@ -32,11 +34,13 @@ def analyze_image_success(
         os.path.join(testpath, fname), warn_8bit=False, verbose=True
     )
     output = list(output)
+    img_cache = output.pop()
     output[:3] = [f"{c:.4f}" for c in output[:3]]
     stdout = capsys.readouterr().out
 
     # Compare results
     assert output == expected_output
+    assert set(img_cache["fit_prior"]) <= {"z", "y", "x"}
     for eso in expected_stdouts:
         assert eso in stdout
 
@@ -48,7 +52,7 @@ def test_analyze_image_3D_success_early(mocker, capsys):
     fname = "test-cnode_early_prescan.tiff"
 
     # Expectations
-    expected_output = ["9.1426", "258.2661", "369.8943", "OK", {}]
+    expected_output = ["9.1426", "258.2661", "369.8943", "OK"]
     expected_stdouts = [
         "Loaded image of shape: (21, 512, 512)",
         "Resulting coords (zyx): 9.1426, 258.2661, 369.8943",
@@ -67,7 +71,7 @@ def test_analyze_image_3D_success_late(mocker, capsys):
     fname = "test-cnode_late_prescan.tiff"
 
     # Expectations
-    expected_output = ["9.5583", "269.4593", "373.6161", "OK", {}]
+    expected_output = ["9.5583", "269.4593", "373.6161", "OK"]
     expected_stdouts = [
         "Loaded image of shape: (21, 512, 512)",
         "Resulting coords (zyx): 9.5583, 269.4593, 373.6161",
@@ -86,10 +90,10 @@ def test_analyze_image_2D_success_early(mocker, capsys):
     fname = "test-cnode_early_prescan2D.tiff"
 
     # Expectations
-    expected_output = ["0.0000", "261.3771", "349.0650", "OK", {}]
+    expected_output = ["0.0000", "261.3771", "349.0666", "OK"]
     expected_stdouts = [
         "Loaded image of shape: (512, 512)",
-        "Resulting coords (zyx): 0.0000, 261.3771, 349.0650",
+        "Resulting coords (zyx): 0.0000, 261.3771, 349.0666",
     ]
 
     # Run test and compare results
@@ -105,10 +109,10 @@ def test_analyze_image_2D_success_late(mocker, capsys):
     fname = "test-cnode_late_prescan2D.tiff"
 
     # Expectations
-    expected_output = ["0.0000", "270.4000", "342.7758", "OK", {}]
+    expected_output = ["0.0000", "270.3999", "342.7760", "OK"]
     expected_stdouts = [
         "Loaded image of shape: (512, 512)",
-        "Resulting coords (zyx): 0.0000, 270.4000, 342.7758",
+        "Resulting coords (zyx): 0.0000, 270.3999, 342.7760",
     ]
 
     # Run test and compare results
@@ -117,12 +121,92 @@ def test_analyze_image_2D_success_late(mocker, capsys):
     )
 
 
+def test_analyze_image_2D_downsample(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-cnode_early_prescan2D.tiff"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Run with and without binning
+    output_full = chick_node.analyze_image(
+        os.path.join(testpath, fname), warn_8bit=False
+    )
+    output_binned = chick_node.analyze_image(
+        os.path.join(testpath, fname), downsample=2, warn_8bit=False
+    )
+
+    # Results should be close, in full-res pixels
+    assert np.allclose(output_binned[:3], output_full[:3], atol=3.0)
+    assert output_binned[3] == "OK"
+
+
+def test_analyze_image_2D_fit_modes(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-cnode_late_prescan2D.tiff"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Warm start from the previous fit gives the same result
+    output = chick_node.analyze_image(
+        os.path.join(testpath, fname), warn_8bit=False
+    )
+    output_warm = chick_node.analyze_image(
+        os.path.join(testpath, fname), warn_8bit=False, **output[4]
+    )
+    assert np.allclose(output_warm[:3], output[:3], atol=0.01)
+
+    # Warm-started fits that do not converge are retried from the closed-form
+    # estimates, so the previous parameters are neither reported nor cached
+    stale = {"y": [1.0, 10.0, 2.0], "x": [0.5, 0.5, 100.0]}
+    curve_fit = fitting.curve_fit
+
+    def curve_fit_fail_stale(*args, **kwargs):
+        if any(np.allclose(kwargs["p0"], p) for p in stale.values()):
+            raise RuntimeError("Optimal parameters not found")
+        return curve_fit(*args, **kwargs)
+
+    mocker.patch.object(fitting, "curve_fit", curve_fit_fail_stale)
+    with pytest.warns(UserWarning, match="did not converge"):
+        output_stale = chick_node.analyze_image(
+            os.path.join(testpath, fname), warn_8bit=False, fit_prior=stale
+        )
+    assert np.allclose(output_stale[:3], output[:3], atol=0.01)
+    for axis in stale:
+        assert np.allclose(
+            output_stale[4]["fit_prior"][axis],
+            output[4]["fit_prior"][axis],
+            rtol=1e-3,
+        )
+
+    # Closed-form estimates alone are close
+    output_closed = chick_node.analyze_image(
+        os.path.join(testpath, fname), fit_mode="closed", warn_8bit=False
+    )
+    assert np.allclose(output_closed[:3], output[:3], atol=10.0)
+
+    # Invalid fit mode
+    with pytest.raises(ValueError, match="Invalid `fit_mode`"):
+        chick_node.analyze_image(
+            os.path.join(testpath, fname), fit_mode="exact", warn_8bit=False
+        )
+
+
 def test_analyze_image_errors_inputchecks(mocker):
 
     # Too many dimensions
     mocker.patch(
         "dystrack.pipelines.chick_node.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1, 1, 1, 1, 1)),
+        wraps=lambda fp, **kwargs: np.zeros((1, 1, 1, 1, 1)),
     )
     with pytest.raises(IOError) as err:
         chick_node.analyze_image("test_path.tiff")
@@ -131,40 +215,37 @@ def test_analyze_image_errors_inputchecks(mocker):
     # Too few dimensions
     mocker.patch(
         "dystrack.pipelines.chick_node.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1,)),
+        wraps=lambda fp, **kwargs: np.zeros((1,)),
     )
     with pytest.raises(IOError) as err:
         chick_node.analyze_image("test_path.tiff")
     assert "Image dimensionality <2" in str(err)
 
-    # Too few dimensions with channel
-    mocker.patch(
-        "dystrack.pipelines.chick_node.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1, 1)),
-    )
+    # Channel not in image (raised by the loader, without retries)
+    mocker.stopall()
+    fpath = r"./tests/testdata/test-pllp_980_prescan.tif"
     with pytest.raises(IOError) as err:
-        chick_node.analyze_image("test_path.tiff", channel=0)
-    assert "CHANNEL given but image dimensionality is <3!" in str(err)
+        chick_node.analyze_image(fpath, channel=1, await_write=0.1)
+    assert "CHANNEL 1 given but image has only 1 channel(s)!" in str(err)
 
 
-def test_analyze_image_warnings_inputchecks(mocker):
+def test_analyze_image_warnings_inputchecks(mocker, tmp_path):
     # Note: Error wrapping is done for perf (to halt function at warning)
 
-    # Channel given but large first dimension
-    mocker.patch(
-        "dystrack.pipelines.chick_node.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((10, 1, 1, 1)),
-    )
+    # Channel given but many channels in image
+    fpath = str(tmp_path / "test_6channels.tif")
+    raw = np.zeros((6, 5, 5), dtype=np.uint8)
+    tifffile.imwrite(fpath, raw, imagej=True, metadata={"axes": "CYX"})
     with pytest.raises(Exception) as err:
         with warnings.catch_warnings():
             warnings.simplefilter(action="error")
-            chick_node.analyze_image("test_path.tiff", channel=0)
-    assert "CHANNEL given but image dim 0 is of size 10!" in str(err)
+            chick_node.analyze_image(fpath, channel=0, await_write=0.1)
+    assert "CHANNEL given but image dim C is of size 6!" in str(err)
 
     # Conversion to 8bit
     mocker.patch(
         "dystrack.pipelines.chick_node.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((3, 5, 5), dtype=np.uint16),
+        wraps=lambda fp, **kwargs: np.zeros((3, 5, 5), dtype=np.uint16),
     )
     with pytest.raises(Exception) as err:
         with warnings.catch_warnings():
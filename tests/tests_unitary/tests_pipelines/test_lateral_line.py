@@ -14,8 +14,10 @@ from time import sleep
 
 import numpy as np
 import pytest
+import tifffile
 
 from dystrack.pipelines import lateral_line
+from dystrack.pipelines.utilities.buffers import get_buffer_pool
 
 
 def test_analyze_image_3D_success(mocker, capsys):
@@ -25,7 +27,7 @@ def test_analyze_image_3D_success(mocker, capsys):
     fname = "test-pllp_AXR_prescan.tiff"
 
     # Expectations
-    expected_output = ["3.4705", "107.8477", "258.4000", "OK", {}]
+    expected_output = ["3.4705", "107.8477", "258.4000", "OK"]
     expected_stdouts = [
         "Loaded image of shape: (9, 212, 512)",
         "Detected treshold: 13",
@@ -46,15 +48,130 @@ def test_analyze_image_3D_success(mocker, capsys):
             os.path.join(testpath, fname), verbose=True
         )
     output = list(output)
+    img_cache = output.pop()
     output[:3] = [f"{c:.4f}" for c in output[:3]]
     stdout = capsys.readouterr().out
 
     # Compare results
     assert output == expected_output
+    assert "objct_prior" not in img_cache  # Not used by the "tree" engine
     for eso in expected_stdouts:
         assert eso in stdout
 
 
+def test_analyze_image_3D_downsample(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllp_AXR_prescan.tiff"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Run test
+    output = lateral_line.analyze_image(
+        os.path.join(testpath, fname), downsample=2, warn_8bit=False
+    )
+
+    # Results should be close to those without binning, in full-res pixels
+    assert np.allclose(output[:3], [3.4705, 107.8477, 258.4000], atol=1.0)
+    assert output[3] == "OK"
+
+
+def test_analyze_image_3D_reuse_buffers(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllp_AXR_prescan.tiff"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Results are the same with and without buffer reuse
+    expected = lateral_line.analyze_image(
+        os.path.join(testpath, fname), warn_8bit=False
+    )
+    get_buffer_pool().clear()
+    for _ in range(2):
+        output = lateral_line.analyze_image(
+            os.path.join(testpath, fname), warn_8bit=False, reuse_buffers=True
+        )
+        assert output[:4] == expected[:4]
+        assert get_buffer_pool().nbytes > 0
+
+
+def test_analyze_image_3D_projection(mocker):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllp_980_prescan.czi"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Run with and without projection
+    output_full = lateral_line.analyze_image(os.path.join(testpath, fname))
+    output_proj = lateral_line.analyze_image(
+        os.path.join(testpath, fname), projection="mean"
+    )
+
+    # Results should be close
+    assert np.allclose(output_proj[:3], output_full[:3], atol=1.5)
+    assert output_proj[3] == "OK"
+
+
+def test_analyze_image_3D_roi(mocker, capsys):
+
+    # Targets
+    testpath = r"./tests/testdata/"
+    fname = "test-pllp_AXR_prescan.tiff"
+
+    # For performance, patch loading's sleep
+    mocker.patch(
+        "dystrack.pipelines.utilities.loading.sleep", lambda t: sleep(0.1)
+    )
+
+    # Full frame analysis stores the ROI for the next frame
+    output = lateral_line.analyze_image(
+        os.path.join(testpath, fname), roi_margin=0.1, warn_8bit=False
+    )
+    assert output[4]["roi_prior"] == {"roi": ((51, 163), (0, 462))}
+
+    # Analysis within the ROI
+    output_roi = lateral_line.analyze_image(
+        os.path.join(testpath, fname),
+        roi_margin=0.1,
+        warn_8bit=False,
+        verbose=True,
+        **output[4],
+    )
+    stdout = capsys.readouterr().out
+    assert "Cropped image to ROI: ((51, 163), (0, 462))" in stdout
+    assert "ROI analysis failed" not in stdout
+    assert np.allclose(output_roi[:3], output[:3], atol=1.5)
+    assert output_roi[3] == "OK"
+
+    # Fallback to the full frame if the mask touches the ROI's border
+    # (reusing the image that was loaded for the ROI analysis)
+    load_spy = mocker.spy(lateral_line, "robustly_load_image_after_write")
+    output_fallback = lateral_line.analyze_image(
+        os.path.join(testpath, fname),
+        warn_8bit=False,
+        verbose=True,
+        roi_prior={"roi": ((50, 170), (100, 400))},
+    )
+    stdout = capsys.readouterr().out
+    assert "Mask touches the border of the ROI!" in stdout
+    assert load_spy.call_count == 1
+    assert output_fallback[:4] == output[:4]
+
+
 def test_analyze_image_2D_success(mocker, capsys):
 
     # Targets
@@ -62,7 +179,7 @@ def test_analyze_image_2D_success(mocker, capsys):
     fname = "test-pllp_980_prescan2D.tif"
 
     # Expectations
-    expected_output = ["0.0000", "106.7561", "348.0000", "OK", {}]
+    expected_output = ["0.0000", "106.7561", "348.0000", "OK"]
     expected_stdouts = [
         "Loaded image of shape: (200, 500)",
         "Detected treshold: 11",
@@ -76,14 +193,17 @@ def test_analyze_image_2D_success(mocker, capsys):
 
     # Run test
     output = lateral_line.analyze_image(
-        os.path.join(testpath, fname), verbose=True
+        os.path.join(testpath, fname), objct_engine="label", verbose=True
     )
     output = list(output)
+    img_cache = output.pop()
     output[:3] = [f"{c:.4f}" for c in output[:3]]
     stdout = capsys.readouterr().out
 
     # Compare results
     assert output == expected_output
+    assert img_cache["objct_prior"]["threshold"] == 11
+    assert img_cache["objct_prior"]["counts"].shape == (256,)
     for eso in expected_stdouts:
         assert eso in stdout
 
@@ -93,7 +213,7 @@ def test_analyze_image_errors_inputchecks(mocker):
     # Too many dimensions
     mocker.patch(
         "dystrack.pipelines.lateral_line.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1, 1, 1, 1, 1)),
+        wraps=lambda fp, **kwargs: np.zeros((1, 1, 1, 1, 1)),
     )
     with pytest.raises(IOError) as err:
         lateral_line.analyze_image("test_path.tiff")
@@ -102,40 +222,37 @@ def test_analyze_image_errors_inputchecks(mocker):
     # Too few dimensions
     mocker.patch(
         "dystrack.pipelines.lateral_line.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1,)),
+        wraps=lambda fp, **kwargs: np.zeros((1,)),
     )
     with pytest.raises(IOError) as err:
         lateral_line.analyze_image("test_path.tiff")
     assert "Image dimensionality <2" in str(err)
 
-    # Too few dimensions with channel
-    mocker.patch(
-        "dystrack.pipelines.lateral_line.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((1, 1)),
-    )
+    # Channel not in image (raised by the loader, without retries)
+    mocker.stopall()
+    fpath = r"./tests/testdata/test-pllp_980_prescan.tif"
     with pytest.raises(IOError) as err:
-        lateral_line.analyze_image("test_path.tiff", channel=0)
-    assert "CHANNEL given but image dimensionality is <3!" in str(err)
+        lateral_line.analyze_image(fpath, channel=1, await_write=0.1)
+    assert "CHANNEL 1 given but image has only 1 channel(s)!" in str(err)
 
 
-def test_analyze_image_warnings_inputchecks(mocker):
+def test_analyze_image_warnings_inputchecks(mocker, tmp_path):
     # Note: Error wrapping is done for perf (to halt function at warning)
 
-    # Channel given but large first dimension
-    mocker.patch(
-        "dystrack.pipelines.lateral_line.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((10, 1, 1, 1)),
-    )
+    # Channel given but many channels in image
+    fpath = str(tmp_path / "test_6channels.tif")
+    raw = np.zeros((6, 5, 5), dtype=np.uint8)
+    tifffile.imwrite(fpath, raw, imagej=True, metadata={"axes": "CYX"})
     with pytest.raises(Exception) as err:
         with warnings.catch_warnings():
             warnings.simplefilter(action="error")
-            lateral_line.analyze_image("test_path.tiff", channel=0)
-    assert "CHANNEL given but image dim 0 is of size 10!" in str(err)
+            lateral_line.analyze_image(fpath, channel=0, await_write=0.1)
+    assert "CHANNEL given but image dim C is of size 6!" in str(err)
 
     # Conversion to 8bit
     mocker.patch(
         "dystrack.pipelines.lateral_line.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((3, 5, 5), dtype=np.uint16),
+        wraps=lambda fp, **kwargs: np.zeros((3, 5, 5), dtype=np.uint16),
     )
     with pytest.raises(Exception) as err:
         with warnings.catch_warnings():
@@ -148,7 +265,7 @@ def test_analyze_image_errors_nothresh(mocker):
 
     mocker.patch(
         "dystrack.pipelines.lateral_line.robustly_load_image_after_write",
-        wraps=lambda fp, await_write: np.zeros((100, 100), dtype=np.uint8),
+        wraps=lambda fp, **kwargs: np.zeros((100, 100), dtype=np.uint8),
     )
     with pytest.raises(Exception) as err:
         lateral_line.analyze_image("test_path.tiff")